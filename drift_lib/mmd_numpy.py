@@ -7,6 +7,12 @@ from __future__ import annotations
 
 import numpy as np
 
+# Максимум элементов в пачке индикаторов перестановок (B × (n+m)) в ref_vs_test_sq_dists
+_PERMUTATION_CHUNK_ELEMENTS = 1 << 20
+# Допуск сравнения с наблюдаемой MMD²: перестановки, дающие то же разбиение
+# (для малых выборок — частый случай), считаются ≥ независимо от ошибок округления
+_TIE_ATOL = 1e-12
+
 
 def _rbf_kernel_sq_norms(x: np.ndarray, y: np.ndarray, gamma: float) -> np.ndarray:
     """Матрица exp(-gamma * ||x_i - y_j||^2), x (n,d), y (m,d)."""
@@ -17,20 +23,6 @@ def _rbf_kernel_sq_norms(x: np.ndarray, y: np.ndarray, gamma: float) -> np.ndarr
     return np.exp(-gamma * d2, dtype=np.float64)
 
 
-def _median_gamma(x: np.ndarray, y: np.ndarray, rng: np.random.Generator, max_points: int = 400) -> float:
-    z = np.vstack([x.astype(np.float64), y.astype(np.float64)])
-    n = z.shape[0]
-    if n > max_points:
-        idx = rng.choice(n, size=max_points, replace=False)
-        z = z[idx]
-    n = z.shape[0]
-    d2 = ((z[:, None, :] - z[None, :, :]) ** 2).sum(axis=-1)
-    tri = np.triu_indices(n, k=1)
-    dist = np.sqrt(np.maximum(d2[tri], 1e-18))
-    med = float(np.median(dist))
-    return 1.0 / (2.0 * med * med + 1e-18)
-
-
 def _mmd2_biased_rbf(x: np.ndarray, y: np.ndarray, gamma: float) -> float:
     """
     Смещённая (но неотрицательная в пределе) оценка MMD² для RBF-ядра:
@@ -52,6 +44,76 @@ def _mmd2_biased_rbf(x: np.ndarray, y: np.ndarray, gamma: float) -> float:
     return max(mmd2, 0.0)
 
 
+def _median_gamma_sq_dists(d2: np.ndarray, rng: np.random.Generator, max_points: int = 400) -> float:
+    """Эвристика медианы: gamma = 1 / (2·median²) по попарным расстояниям объединённой выборки (подвыборка до max_points)."""
+    n = d2.shape[0]
+    if n > max_points:
+        idx = rng.choice(n, size=max_points, replace=False)
+        d2 = d2[np.ix_(idx, idx)]
+        n = max_points
+    tri = np.triu_indices(n, k=1)
+    dist = np.sqrt(np.maximum(d2[tri], 1e-18))
+    med = float(np.median(dist))
+    return 1.0 / (2.0 * med * med + 1e-18)
+
+
+def _mmd2_biased_batch(k: np.ndarray, row_sums: np.ndarray, total_sum: float, a: np.ndarray, n: int) -> np.ndarray:
+    """
+    ``_mmd2_biased_rbf`` для пачки разбиений объединённой выборки по её матрице ядра.
+
+    ``a`` (B, n+m) — индикаторы reference-части. Для индикатора ``a``:
+    ``sum K_XX = aᵀKa``, ``sum K_XY = aᵀK1 - aᵀKa``, ``sum K_YY = 1ᵀK1 - 2·aᵀK1 + aᵀKa``,
+    так что на всю пачку нужен один матричный продукт ``a @ K``.
+    """
+    m = k.shape[0] - n
+    s_xx = np.einsum("bi,bi->b", a @ k, a)
+    s_x1 = a @ row_sums
+    s_xy = s_x1 - s_xx
+    s_yy = total_sum - 2.0 * s_x1 + s_xx
+    mmd2 = s_xx / (n * n) + s_yy / (m * m) - 2.0 * s_xy / (n * m)
+    return np.maximum(mmd2, 0.0)
+
+
+def ref_vs_test_sq_dists(
+    d2: np.ndarray,
+    n_ref: int,
+    p_val: float = 0.05,
+    n_permutations: int = 200,
+    random_state: int = 0,
+) -> tuple[float, float, int]:
+    """
+    ``ref_vs_test`` по матрице квадратов расстояний объединённой выборки (n+m, n+m):
+    первые ``n_ref`` строк — reference, остальные — test.
+
+    Онлайн-детектор поддерживает эту матрицу инкрементально, поэтому здесь нет
+    работы порядка размерности эмбеддингов: ядро — один ``exp`` по готовой матрице.
+    """
+    rng = np.random.default_rng(random_state)
+    d2 = np.maximum(np.asarray(d2, dtype=np.float64), 0.0)
+    gamma = _median_gamma_sq_dists(d2, rng)
+    k = np.exp(-gamma * d2)
+    total = d2.shape[0]
+    row_sums = k.sum(axis=1)
+    total_sum = float(row_sums.sum())
+
+    a = np.zeros((1, total), dtype=np.float64)
+    a[0, :n_ref] = 1.0
+    obs = float(_mmd2_biased_batch(k, row_sums, total_sum, a, n_ref)[0])
+
+    # Перестановки пачками: память ограничена _PERMUTATION_CHUNK_ELEMENTS индикаторов
+    chunk = max(1, min(n_permutations, _PERMUTATION_CHUNK_ELEMENTS // total))
+    ge = 1
+    for start in range(0, n_permutations, chunk):
+        size = min(chunk, n_permutations - start)
+        a = np.zeros((size, total), dtype=np.float64)
+        for i in range(size):
+            a[i, rng.permutation(total)[:n_ref]] = 1.0
+        ge += int((_mmd2_biased_batch(k, row_sums, total_sum, a, n_ref) >= obs - _TIE_ATOL).sum())
+    p = ge / (n_permutations + 1)
+    is_drift = int(p < p_val)
+    return obs, float(p), is_drift
+
+
 def ref_vs_test(
     x_ref: np.ndarray,
     x_test: np.ndarray,
@@ -62,20 +124,12 @@ def ref_vs_test(
     """
     Возвращает (mmd², p_value, is_drift) в том же духе, что и alibi MMDDrift.predict.
     """
-    rng = np.random.default_rng(random_state)
     x_ref = np.asarray(x_ref, dtype=np.float64)
     x_test = np.asarray(x_test, dtype=np.float64)
-    gamma = _median_gamma(x_ref, x_test, rng)
-    obs = _mmd2_biased_rbf(x_ref, x_test, gamma)
-    n, m = x_ref.shape[0], x_test.shape[0]
     z = np.vstack([x_ref, x_test])
-    ge = 1
-    for t in range(n_permutations):
-        perm = rng.permutation(n + m)
-        px = z[perm[:n]]
-        py = z[perm[n:]]
-        if _mmd2_biased_rbf(px, py, gamma) >= obs:
-            ge += 1
-    p = ge / (n_permutations + 1)
-    is_drift = int(p < p_val)
-    return obs, float(p), is_drift
+    # Ядро объединённой выборки не зависит от перестановки: расстояния считаются один раз
+    z2 = (z * z).sum(axis=1)
+    d2 = z2[:, None] + z2[None, :] - 2.0 * (z @ z.T)
+    return ref_vs_test_sq_dists(
+        d2, x_ref.shape[0], p_val=p_val, n_permutations=n_permutations, random_state=random_state
+    )
@@ -1,12 +1,11 @@
 from __future__ import annotations
 
-from collections import deque
 from dataclasses import dataclass
-from typing import Deque, List, Literal, Optional
+from typing import List, Literal, Optional
 
 import numpy as np
 
-from .mmd_numpy import ref_vs_test as mmd_ref_vs_test_numpy
+from .mmd_numpy import ref_vs_test_sq_dists as mmd_ref_vs_test_sq_dists_numpy
 
 MmdBackend = Literal["auto", "alibi", "numpy"]
 
@@ -40,6 +39,12 @@ class OnlineMMDDriftDetector:
 
     Cold start: пока ``len(buffer) < cold_start_min``, детектор неактивен.
 
+    Буфер — заранее выделенный кольцевой массив ``(max_buffer, d)``. Для окна из
+    ``ref_size + test_size`` последних точек поддерживается матрица квадратов попарных
+    расстояний: новая точка пересчитывает только свои строку и столбец (O(окно·d)),
+    вытесняемая из окна точка просто перезаписывается. NumPy-бэкенд считает MMD и
+    перестановочный тест по этой матрице, без повторной работы по размерности.
+
     Self-calibrating (опционально): после ``calibration_warmup`` активных шагов без дрейфа
     накапливаются значения MMD; порог = ``quantile(mmd_history, calibration_quantile)``.
     Если задан ``use_calibration_threshold``, дрейф = ``mmd > threshold``, иначе — по p-value из alibi.
@@ -66,6 +71,8 @@ class OnlineMMDDriftDetector:
                 "cold_start_min должен быть >= ref_size + test_size, "
                 "чтобы оба окна были полными."
             )
+        if max_buffer < cold_start_min:
+            raise ValueError("max_buffer должен быть >= cold_start_min.")
         self.ref_size = ref_size
         self.test_size = test_size
         self.cold_start_min = cold_start_min
@@ -74,7 +81,13 @@ class OnlineMMDDriftDetector:
         self.calibration_quantile = calibration_quantile
         self.calibration_warmup = calibration_warmup
         self.calibration_max_history = calibration_max_history
-        self._buf: Deque[np.ndarray] = deque(maxlen=max_buffer)
+        self.max_buffer = max_buffer
+        # Кольцевой буфер эмбеддингов (выделяется при первом push, когда известна размерность)
+        self._data: Optional[np.ndarray] = None
+        self._count = 0
+        # Квадраты расстояний между точками окна; точка с номером i живёт в слоте i % window
+        self._window = ref_size + test_size
+        self._win_d2 = np.zeros((self._window, self._window), dtype=np.float64)
         self._mmd_history: List[float] = []
         self._steps_since_start = 0
         self.mmd_backend: MmdBackend = mmd_backend
@@ -82,9 +95,9 @@ class OnlineMMDDriftDetector:
 
     def push(self, embedding: np.ndarray) -> DriftStepResult:
         e = np.asarray(embedding, dtype=np.float32).ravel()
-        self._buf.append(e)
+        self._append(e)
         self._steps_since_start += 1
-        n = len(self._buf)
+        n = len(self)
         if n < self.cold_start_min:
             return DriftStepResult(
                 active=False,
@@ -96,11 +109,7 @@ class OnlineMMDDriftDetector:
                 test_size=self.test_size,
             )
 
-        arr = np.stack(list(self._buf), axis=0)
-        x_test = arr[-self.test_size :]
-        x_ref = arr[-(self.test_size + self.ref_size) : -self.test_size]
-
-        mmd_dist, p_val, is_drift_alibi = self._mmd_predict(x_ref, x_test)
+        mmd_dist, p_val, is_drift_alibi = self._mmd_predict()
 
         drift_flag: Optional[bool] = bool(is_drift_alibi)
         if self.use_calibration_threshold and self._steps_since_start > self.calibration_warmup:
@@ -123,32 +132,66 @@ class OnlineMMDDriftDetector:
             test_size=self.test_size,
         )
 
+    def __len__(self) -> int:
+        return min(self._count, self.max_buffer)
+
+    def _append(self, e: np.ndarray) -> None:
+        if self._data is None:
+            self._data = np.empty((self.max_buffer, e.shape[0]), dtype=np.float32)
+        elif e.shape[0] != self._data.shape[1]:
+            raise ValueError(
+                f"Размерность эмбеддинга {e.shape[0]} не совпадает с буфером ({self._data.shape[1]})."
+            )
+        # Строка и столбец новой точки против предыдущих (до window - 1) точек окна
+        prev = np.arange(self._count - 1, max(self._count - self._window, -1), -1)
+        slot = self._count % self._window
+        row = np.zeros(self._window, dtype=np.float64)
+        if prev.size:
+            diff = self._data[prev % self.max_buffer].astype(np.float64) - e.astype(np.float64)
+            row[prev % self._window] = (diff * diff).sum(axis=1)
+        self._win_d2[slot, :] = row
+        self._win_d2[:, slot] = row
+        self._data[self._count % self.max_buffer] = e
+        self._count += 1
+
+    def _window_order(self) -> np.ndarray:
+        """Слоты окна в хронологическом порядке: сначала reference, затем test."""
+        return np.arange(self._count - self._window, self._count) % self._window
+
+    def _windows(self) -> tuple[np.ndarray, np.ndarray]:
+        """(x_ref, x_test) из кольцевого буфера."""
+        idx = np.arange(self._count - self._window, self._count) % self.max_buffer
+        arr = self._data[idx]
+        return arr[: self.ref_size], arr[self.ref_size :]
+
     def _calibration_threshold(self) -> Optional[float]:
         if len(self._mmd_history) < 50:
             return None
         return float(np.quantile(np.array(self._mmd_history), self.calibration_quantile))
 
-    def _mmd_predict(
-        self, x_ref: np.ndarray, x_test: np.ndarray
-    ) -> tuple[float, Optional[float], int]:
+    def _mmd_predict(self) -> tuple[float, Optional[float], int]:
         if self._use_numpy_mmd or self.mmd_backend == "numpy":
-            dist, p_val, is_drift = mmd_ref_vs_test_numpy(
-                x_ref, x_test, p_val=self.p_val, random_state=self._steps_since_start
-            )
-            return dist, p_val, is_drift
+            return self._mmd_predict_numpy()
 
         if self.mmd_backend == "alibi":
-            return self._mmd_predict_alibi(x_ref, x_test)
+            return self._mmd_predict_alibi(*self._windows())
 
         # auto: alibi, при первой же ошибке — только numpy
         try:
-            return self._mmd_predict_alibi(x_ref, x_test)
+            return self._mmd_predict_alibi(*self._windows())
         except Exception:
             self._use_numpy_mmd = True
-            dist, p_val, is_drift = mmd_ref_vs_test_numpy(
-                x_ref, x_test, p_val=self.p_val, random_state=self._steps_since_start
-            )
-            return dist, p_val, is_drift
+            return self._mmd_predict_numpy()
+
+    def _mmd_predict_numpy(self) -> tuple[float, Optional[float], int]:
+        order = self._window_order()
+        dist, p_val, is_drift = mmd_ref_vs_test_sq_dists_numpy(
+            self._win_d2[np.ix_(order, order)],
+            self.ref_size,
+            p_val=self.p_val,
+            random_state=self._steps_since_start,
+        )
+        return dist, p_val, is_drift
 
     def _mmd_predict_alibi(
         self, x_ref: np.ndarray, x_test: np.ndarray
@@ -4,64 +4,252 @@ import time
 import logging
 import sys
 import signal
-from typing import Dict, Any, Optional
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Any, Optional, List
 from abc import ABC, abstractmethod
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .context_cache import ConversationContextCache
+from .kv_cache import ConversationKVCache
+from .inference_engine import InferenceEngine
+from .model_registry import get_engine, load_model
+
+class TaskProgressWriter:
+    """Buffers text streamed for a task and posts it to the API at most every interval seconds"""
+
+    def __init__(self, agent: "BaseAgent", task_id: str, interval: float = 0.2):
+        self.agent = agent
+        self.task_id = task_id
+        self.interval = interval
+        self._buffer: List[str] = []
+        self._last_flush = 0.0
+        self._posts: List[Future] = []
+
+    def write(self, text: str):
+        self._buffer.append(text)
+        now = time.monotonic()
+        if now - self._last_flush >= self.interval:
+            self.flush(now)
+
+    def flush(self, now: Optional[float] = None):
+        if not self._buffer:
+            return
+        delta = "".join(self._buffer)
+        self._buffer = []
+        self._last_flush = now or time.monotonic()
+        # Single-threaded executor, so chunks arrive in order
+        self._posts.append(self.agent._progress_io.submit(self.agent.post_progress, self.task_id, delta))
+
+    def close(self):
+        """Send what is buffered and wait for it, before the task is completed"""
+        self.flush()
+        for post in self._posts:
+            post.result()
 
 class BaseAgent(ABC):
-    def __init__(self, name: str):
+    # Agents whose result is the assistant reply of the task conversation;
+    # it is then stored with POST /tasks/{id}/complete in one transaction
+    result_is_reply = False
+    # Load the model before every task; agents that may not generate load it on first use
+    load_model_before_task = True
+
+    def __init__(self, name: str, poll_wait: float = 25.0, context_cache_mb: float = 64.0,
+                 kv_cache_mb: float = 0.0, kv_cache_cpu_mb: float = 0.0, max_batch_size: int = 1,
+                 model_path: Optional[str] = None, model_options: Optional[Dict[str, Any]] = None):
         self.name = name
+        # Loaded on the first task (see _load_model), so the agent starts polling right away
+        self.model_path = model_path
+        self.model_options = model_options or {}
+        self.model = None
+        self.tokenizer = None
+        # Long-poll wait passed to /agent/poll; 0 falls back to interval polling
+        self.poll_wait = poll_wait
+        # Conversations seen so far, synced incrementally from the API
+        self.context_cache = ConversationContextCache(int(context_cache_mb * 1024 * 1024))
+        self.context_page_size = 500
+        # Past key/values per conversation for generate_reply (0 disables reuse)
+        self.kv_cache = ConversationKVCache(
+            int(kv_cache_mb * 1024 * 1024), int(kv_cache_cpu_mb * 1024 * 1024)
+        )
+        # Tasks leased and generated together; the engine batches their generate calls
+        self.max_batch_size = max(1, max_batch_size)
+        self.engine: Optional[InferenceEngine] = None
+        self.http = self._create_http_session()
+        # Writes that do not block generation (see add_to_conversation)
+        self._io = ThreadPoolExecutor(max_workers=4, thread_name_prefix=f"{name}-io")
+        self._pending_writes: List[Future] = []
+        self._progress_io = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{name}-progress")
         self.logger = logging.getLogger(self.name)
         logging.basicConfig(
             level=logging.INFO,
             format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
         )
 
+    @staticmethod
+    def _create_http_session(pool_size: int = 8) -> requests.Session:
+        """Keep-alive session shared by all API calls of the agent.
+
+        Connection errors are retried for every method (nothing reached the
+        server); 5xx responses only for GET, since a POST such as /agent/poll
+        may already have leased tasks.
+        """
+        retry = Retry(
+            total=3,
+            connect=3,
+            read=0,
+            backoff_factor=0.3,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset({"GET"}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
     def log(self, message: str, level: str = "info"):
         """Logging helper method"""
         getattr(self.logger, level)(message)
 
+    def _load_model(self) -> None:
+        """Deferred model loading, shared with agents hosted on the same model path"""
+        if self.model is not None or self.model_path is None:
+            return
+        try:
+            model, tokenizer = load_model(self.model_path, **self.model_options)
+        except Exception as e:
+            self.logger.error(f"Model {self.model_path} loading failed: {str(e)}")
+            raise
+        # Batched tasks check self.model from other threads, so it is set last
+        self.tokenizer = tokenizer
+        self.model = model
+
     def get_conversation_context(self, conversation_id, last_n=100):
-        """Get recent conversation context"""
-        response = requests.get(f"{self.api_url}/conversations/{conversation_id}")
-        if response.status_code == 200:
+        """Get recent conversation context, fetching only messages not seen yet"""
+        context = self.context_cache.get(conversation_id)
+        cursor = context.cursor
+        new_messages = []
+        while True:
+            params = {"limit": self.context_page_size, "fields": "role,content"}
+            if cursor is not None:
+                params["after"] = cursor
+            response = self.http.get(
+                f"{self.api_url}/conversations/{conversation_id}/messages",
+                params=params
+            )
+            if response.status_code != 200:
+                return None
             data = response.json()
-            messages = [{
-                    "role": d["role"], 
+            new_messages.extend({
+                    "role": d["role"],
                     "content": d["content"]
-                } for d in data["messages"][-last_n:]]  # Get last N messages
-            return messages
-        return None
+                } for d in data["messages"])
+            cursor = data["next_after"]
+            if len(data["messages"]) < self.context_page_size:
+                break
+        if new_messages:
+            self.context_cache.update(conversation_id, context, new_messages, cursor)
+        return context.messages[-last_n:]  # Get last N messages
+
+    def get_prompt_inputs(self, conversation_id, context):
+        """Chat template applied to context and tokenized, cached per conversation"""
+        text = self.tokenizer.apply_chat_template(
+            context,
+            tokenize=False,
+            add_generation_prompt=True,
+        )
+        with self.get_engine().tokenizer_lock:
+            return self.context_cache.prompt_inputs(
+                conversation_id,
+                text,
+                lambda t: self.tokenizer([t], return_tensors="pt").to(self.model.device)
+            )
+
+    def get_engine(self) -> InferenceEngine:
+        """Inference engine of the agent's model, shared with agents hosted on the same model"""
+        if self.engine is None:
+            self.engine = get_engine(
+                self.model, self.tokenizer, max_batch_size=self.max_batch_size, name=self.name
+            )
+        return self.engine
+
+    def generate_reply(self, conversation_id, model_inputs, max_new_tokens=1000, stream_task_id=None):
+        """Generate the next reply through the inference engine of the agent's model.
+
+        With stream_task_id the text is streamed to /tasks/{id}/progress while it is generated.
+        """
+        engine = self.get_engine()
+        if stream_task_id is None:
+            return engine.generate(self.kv_cache, conversation_id, model_inputs, max_new_tokens)
+        progress = TaskProgressWriter(self, stream_task_id)
+        try:
+            return engine.generate(
+                self.kv_cache, conversation_id, model_inputs, max_new_tokens, on_text=progress.write
+            )
+        finally:
+            progress.close()
+
+    def post_progress(self, task_id: str, delta: str):
+        """Append streamed output of a task; failures only cost the live preview"""
+        try:
+            response = self.http.post(
+                f"{self.api_url}/tasks/{task_id}/progress",
+                json={"delta": delta},
+                timeout=5
+            )
+            if response.status_code != 200:
+                self.logger.debug(f"Progress rejected: {response.status_code}")
+        except Exception as e:
+            self.logger.debug(f"Progress error: {str(e)}")
 
     def add_to_conversation(self, conversation_id, role, content, metadata=None):
-        """Add message to conversation"""
-        requests.post(
+        """Add message to conversation.
+
+        Sent in the background so it overlaps with submit_result; run_once
+        waits for it before taking the next task.
+        """
+        future = self._io.submit(
+            self.http.post,
             f"{self.api_url}/conversations/{conversation_id}/messages",
             params={
                 "conversation_id": conversation_id,
                 "role": role,
                 "content": content,
                 "metadata": metadata or {}
-            }
+            },
+            timeout=10
         )
+        self._pending_writes.append(future)
+        return future
+
+    def flush_pending_writes(self):
+        """Wait for background writes and log the failed ones"""
+        pending, self._pending_writes = self._pending_writes, []
+        for future in pending:
+            try:
+                response = future.result()
+                if response.status_code != 200:
+                    self.logger.error(f"Failed to add message: {response.status_code} - {response.text}")
+            except Exception as e:
+                self.logger.error(f"Failed to add message: {str(e)}")
 
     def run(self, interval: float = 2.0):
         self.running = True
-        self.logger.info(f"Agent {self.agent_id} started. Polling interval: {interval}s")
-        heartbeat_interval = 30
-        last_heartbeat = time.time()
-        
+        self.logger.info(
+            f"Agent {self.agent_id} started. Polling interval: {interval}s, long-poll wait: {self.poll_wait}s"
+        )
+        # Every long-poll refreshes the agent heartbeat on the server
         while self.running:
             try:
                 current_time = time.time()
                 
-                if current_time - last_heartbeat > heartbeat_interval:
-                    self.send_heartbeat()
-                    last_heartbeat = current_time
-                
                 processed = self.run_once()
                 
+                # A long-poll already waited on the server; only sleep off
+                # the rest of the interval (e.g. when the API is unreachable)
                 if not processed:
-                    time.sleep(interval)
+                    time.sleep(max(0.0, interval - (time.time() - current_time)))
                     
             except KeyboardInterrupt:
                 self.logger.info("Interrupted by user")
@@ -71,28 +259,57 @@ class BaseAgent(ABC):
                 time.sleep(interval)
 
     def run_once(self):
+        if self.max_batch_size > 1:
+            return self.run_batch_once()
+
         task = self.poll_task()
 
         if task:
             try:
-                result = self.process_task(task)
+                self.handle_task(task)
+            finally:
+                self.flush_pending_writes()
+            return True
+        return False
+
+    def run_batch_once(self):
+        """Lease up to max_batch_size tasks and process them concurrently.
+
+        Every task runs process_task in its own thread; their generate calls
+        meet in the inference engine and are decoded as one batch.
+        """
+        tasks = self.poll_tasks(self.max_batch_size)
+        if not tasks:
+            return False
+        with ThreadPoolExecutor(max_workers=len(tasks), thread_name_prefix=f"{self.name}-task") as pool:
+            list(pool.map(self.handle_task, tasks))
+        self.flush_pending_writes()
+        return True
+
+    def handle_task(self, task):
+        """Process one task and report its result or error"""
+        try:
+            if self.load_model_before_task:
+                self._load_model()
+            result = self.process_task(task)
+            if self.result_is_reply and task.get("conversation_id"):
+                self.complete_task(task["task_id"], result)
+            else:
                 self.submit_result(
                     task["task_id"], 
                     result
                 )
-            except Exception as e:
-                self.logger.error(f"Task processing failed: {str(e)}")
-                self.submit_result(
-                    task["task_id"], 
-                    "", 
-                    error=f"Processing error: {str(e)}"
-                )
-            return True
-        return False
+        except Exception as e:
+            self.logger.error(f"Task processing failed: {str(e)}")
+            self.submit_result(
+                task["task_id"], 
+                "", 
+                error=f"Processing error: {str(e)}"
+            )
     
     def submit_result(self, task_id: str, result: str, error: Optional[str] = None):
         try:
-            response = requests.post(
+            response = self.http.post(
                 f"{self.api_url}/tasks/{task_id}/result",
                 json={
                     "result": result,
@@ -113,25 +330,40 @@ class BaseAgent(ABC):
             self.logger.error(f"Result submission error: {str(e)}")
             raise
     
-    def send_heartbeat(self):
+    def complete_task(self, task_id: str, content: str, metadata: Optional[Dict] = None):
+        """Append the reply to the task conversation and complete the task atomically"""
         try:
-            requests.post(
-                f"{self.api_url}/agent/poll",
-                json={"agent_id": self.agent_id},
-                timeout=5
+            response = self.http.post(
+                f"{self.api_url}/tasks/{task_id}/complete",
+                json={
+                    "content": content,
+                    "metadata": metadata or {},
+                    "agent_id": self.agent_id
+                },
+                timeout=10
             )
-            self.logger.debug("Heartbeat sent")
-        except:
-            pass
+
+            if response.status_code == 200:
+                self.logger.info(f"Task {task_id[:8]} completed")
+            else:
+                self.logger.error(f"Failed to complete task: {response.status_code} - {response.text}")
+
+        except requests.exceptions.ConnectionError:
+            self.logger.error("Cannot connect to API server to complete task")
+            raise
+        except Exception as e:
+            self.logger.error(f"Task completion error: {str(e)}")
+            raise
 
     def poll_task(self) -> Optional[Dict[str, Any]]:
         try:
-            response = requests.post(
+            response = self.http.post(
                 f"{self.api_url}/agent/poll",
                 json={
                     "agent_id": self.agent_id,
+                    "wait": self.poll_wait,
                 },
-                timeout=30
+                timeout=self.poll_wait + 30
             )
 
             if response.status_code == 200:
@@ -140,7 +372,7 @@ class BaseAgent(ABC):
                     self.logger.info(f"Received task: {task_data['task_id'][:8]}")
                     return task_data
                 else:
-                    self.logger.info(f"No tasks available {response}")
+                    self.logger.debug(f"No tasks available {response}")
             else:
                 self.logger.warning(f"Unexpected response: {response.status_code}")
 
@@ -153,8 +385,37 @@ class BaseAgent(ABC):
         sys.stdout.flush()
         return None
 
+    def poll_tasks(self, max_tasks: int) -> List[Dict[str, Any]]:
+        """Lease up to max_tasks tasks in one request (for agents that batch generation)"""
+        try:
+            response = self.http.post(
+                f"{self.api_url}/agent/poll",
+                params={"max_tasks": max_tasks},
+                json={
+                    "agent_id": self.agent_id,
+                    "wait": self.poll_wait,
+                },
+                timeout=self.poll_wait + 30
+            )
+
+            if response.status_code == 200:
+                tasks = response.json() or []
+                if tasks:
+                    self.logger.info(f"Received {len(tasks)} tasks")
+                return tasks
+            self.logger.warning(f"Unexpected response: {response.status_code}")
+
+        except requests.exceptions.Timeout:
+            self.logger.debug("Poll timeout (no tasks)")
+        except requests.exceptions.ConnectionError:
+            self.logger.error("Cannot connect to API server")
+        except Exception as e:
+            self.logger.error(f"Poll error: {str(e)}")
+        return []
+
     def stop(self):
         self.running = False
+        self.flush_pending_writes()
         self.logger.info(f"Agent {self.agent_id} stopped")
 
     @abstractmethod
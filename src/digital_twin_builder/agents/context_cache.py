@@ -0,0 +1,122 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Rough per-message overhead of the dicts and strings held for it
+MESSAGE_OVERHEAD_BYTES = 200
+
+
+class ConversationContext:
+    """Messages of one conversation seen so far and the cursor to sync from"""
+
+    def __init__(self):
+        self.messages: List[Dict[str, str]] = []
+        self.cursor: Optional[str] = None
+        # (prompt text, tokenized inputs) of the last prompt built from messages
+        self.prompt: Optional[Tuple[str, Any]] = None
+        self.size = 0
+
+    def extend(self, messages: List[Dict[str, str]], cursor: Optional[str]):
+        self.messages.extend(messages)
+        self.cursor = cursor
+        self.size = sum(_message_size(m) for m in self.messages) + _prompt_size(self.prompt)
+
+
+def _message_size(message: Dict[str, str]) -> int:
+    return MESSAGE_OVERHEAD_BYTES + sum(len(v.encode("utf-8")) for v in message.values())
+
+
+def _prompt_size(prompt: Optional[Tuple[str, Any]]) -> int:
+    if prompt is None:
+        return 0
+    text, inputs = prompt
+    size = len(text.encode("utf-8"))
+    # BatchEncoding / dict of tensors
+    for value in getattr(inputs, "values", lambda: [])():
+        size += getattr(value, "nbytes", 0)
+    return size
+
+
+class ConversationContextCache:
+    """LRU cache of conversation contexts bounded by an approximate memory budget.
+
+    Agents keep the history of conversations they work on and only fetch the
+    messages added since the last task (see BaseAgent.get_conversation_context).
+    The least recently used conversations are evicted once the budget is exceeded;
+    the one being used is never evicted, it is simply re-synced from scratch later.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, ConversationContext]" = OrderedDict()
+        self._total = 0
+        # Agents processing a batch of tasks use the cache from several threads
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total
+
+    def get(self, conversation_id: str) -> ConversationContext:
+        """Context of a conversation, an empty one if it is not cached"""
+        with self._lock:
+            context = self._entries.get(conversation_id)
+            if context is None:
+                self.misses += 1
+                context = self._entries[conversation_id] = ConversationContext()
+            else:
+                self.hits += 1
+                self._entries.move_to_end(conversation_id)
+            return context
+
+    def update(self, conversation_id: str, context: ConversationContext,
+               messages: List[Dict[str, str]], cursor: Optional[str]):
+        """Append synced messages to the context returned by get() and account for their size"""
+        with self._lock:
+            cached = self._entries.get(conversation_id)
+            if cached is not context:
+                # Evicted (and maybe re-created empty) by another thread since get(),
+                # the caller's context is still the complete one
+                if cached is not None:
+                    self._total -= cached.size
+                self._entries[conversation_id] = context
+                self._total += context.size
+            before = context.size
+            context.extend(messages, cursor)
+            self._total += context.size - before
+            self._evict(keep=conversation_id)
+
+    def prompt_inputs(self, conversation_id: str, text: str, tokenize: Callable[[str], Any]) -> Any:
+        """Tokenized prompt for text, reused when the prompt did not change"""
+        with self._lock:
+            context = self._entries.get(conversation_id)
+            if context is None:
+                return tokenize(text)
+            if context.prompt is not None and context.prompt[0] == text:
+                return context.prompt[1]
+            inputs = tokenize(text)
+            before = context.size
+            context.size += _prompt_size((text, inputs)) - _prompt_size(context.prompt)
+            context.prompt = (text, inputs)
+            self._total += context.size - before
+            self._evict(keep=conversation_id)
+            return inputs
+
+    def invalidate(self, conversation_id: str):
+        with self._lock:
+            context = self._entries.pop(conversation_id, None)
+            if context is not None:
+                self._total -= context.size
+
+    def _evict(self, keep: str):
+        while self._total > self.max_bytes and len(self._entries) > 1:
+            conversation_id = next(iter(self._entries))
+            if conversation_id == keep:
+                self._entries.move_to_end(keep)
+                continue
+            self.invalidate(conversation_id)
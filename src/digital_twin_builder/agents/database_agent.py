@@ -1,28 +1,34 @@
-from transformers import AutoModelForCausalLM, AutoTokenizer
-import torch
 import sys
 import signal
 import os
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../../'))
 from digital_twin_builder.agents import BaseAgent
-from digital_twin_builder.config import API_URL, DB_AGENT_MODEL, DB_AGENT_INDEX
+from digital_twin_builder.config import (
+    API_URL, DB_AGENT_MODEL, DB_AGENT_INDEX, AGENT_CONTEXT_CACHE_MB,
+    AGENT_KV_CACHE_MB, AGENT_KV_CACHE_CPU_MB, AGENT_MAX_BATCH_SIZE,
+    AGENT_MODEL_QUANTIZATION, AGENT_MODEL_MMAP, AGENT_MODEL_WARMUP
+)
 
 class DatabaseAgent(BaseAgent):
+    result_is_reply = True
+
     def __init__(self):
-        super().__init__("DatabaseAgent")
+        super().__init__(
+            "DatabaseAgent",
+            context_cache_mb=AGENT_CONTEXT_CACHE_MB,
+            kv_cache_mb=AGENT_KV_CACHE_MB,
+            kv_cache_cpu_mb=AGENT_KV_CACHE_CPU_MB,
+            max_batch_size=AGENT_MAX_BATCH_SIZE,
+            model_path=DB_AGENT_MODEL,
+            model_options=dict(
+                quantization=AGENT_MODEL_QUANTIZATION,
+                mmap=AGENT_MODEL_MMAP,
+                warmup=AGENT_MODEL_WARMUP,
+            ),
+        )
         self.agent_id = DB_AGENT_INDEX
         self.api_url = API_URL.rstrip('/')
         self.running = False
-        try:
-            # self.model = pipeline("text-generation", model= model)
-            self.tokenizer = AutoTokenizer.from_pretrained(DB_AGENT_MODEL)
-            self.model = AutoModelForCausalLM.from_pretrained(
-                DB_AGENT_MODEL,
-                device_map="auto"
-            )
-        except Exception as e:
-            self.logger.error(f"Model loading failed: {str(e)}")
-            raise
 
     def process_task(self, task):
         conversation_id = task.get("conversation_id", "")
@@ -34,25 +40,15 @@ class DatabaseAgent(BaseAgent):
             context = self.get_conversation_context(conversation_id)
             print(context)
 
-            text = self.tokenizer.apply_chat_template(
-                context,
-                enable_thinking=True,
-                tokenize=False,
-                add_generation_prompt=True,
-            )
-            model_inputs = self.tokenizer([text], return_tensors="pt").to(self.model.device)
-            
-            generated_ids = self.model.generate(**model_inputs, max_new_tokens=params.get("max_tokens", 1000))
+            model_inputs = self.get_prompt_inputs(conversation_id, context)
             
-            output_ids = generated_ids[0][len(model_inputs.input_ids[0]) :]
-            assistant_response = self.tokenizer.decode(output_ids, skip_special_tokens=True)
-
-            self.add_to_conversation(
+            assistant_response = self.generate_reply(
                 conversation_id,
-                role="assistant",
-                content=assistant_response,
+                model_inputs,
+                max_new_tokens=params.get("max_tokens", 1000),
+                stream_task_id=task["task_id"],
             )
-            
+
             return assistant_response
 
         except Exception as e:
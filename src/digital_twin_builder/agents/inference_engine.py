@@ -0,0 +1,269 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List, Optional
+
+from .kv_cache import ConversationKVCache, common_prefix_length
+
+logger = logging.getLogger("InferenceEngine")
+
+
+class GenerationRequest:
+    __slots__ = ("kv_cache", "conversation_id", "input_ids", "max_new_tokens", "on_text", "future")
+
+    def __init__(self, kv_cache: Optional[ConversationKVCache], conversation_id: str,
+                 input_ids, max_new_tokens: int, on_text: Optional[Callable[[str], None]] = None):
+        self.kv_cache = kv_cache
+        self.conversation_id = conversation_id
+        # 1-D prompt token ids on the model device
+        self.input_ids = input_ids
+        self.max_new_tokens = max_new_tokens
+        # Receives decoded text as it is generated
+        self.on_text = on_text
+        self.future: Future = Future()
+
+
+def _callback_streamer(tokenizer, lock: threading.Lock, callback: Callable[[str], None]):
+    """TextStreamer passing finalized text to a callback, decoding under the tokenizer lock"""
+    from transformers import TextStreamer
+
+    class CallbackStreamer(TextStreamer):
+        def put(self, value):
+            with lock:
+                super().put(value)
+
+        def end(self):
+            with lock:
+                super().end()
+
+        def on_finalized_text(self, text: str, stream_end: bool = False):
+            if text:
+                callback(text)
+
+    return CallbackStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+
+
+def _batch_callback_streamer(tokenizer, lock: threading.Lock, requests: List[GenerationRequest]):
+    """Streamer for a left-padded batch: row i's new text goes to requests[i].on_text.
+
+    TextStreamer only supports one sequence; here every row keeps its own
+    tokens, cut at the request's max_new_tokens, and text is passed on once
+    it no longer ends in an incomplete character.
+    """
+    from transformers.generation.streamers import BaseStreamer
+
+    class BatchCallbackStreamer(BaseStreamer):
+        def __init__(self):
+            self.prompt_seen = False
+            self.tokens: List[List[int]] = [[] for _ in requests]
+            self.sent = [0] * len(requests)
+
+        def put(self, value):
+            if not self.prompt_seen:
+                # The first call carries the prompts
+                self.prompt_seen = True
+                return
+            for i, token in enumerate(value.tolist()):
+                if requests[i].on_text is None or len(self.tokens[i]) >= requests[i].max_new_tokens:
+                    continue
+                self.tokens[i].extend(token if isinstance(token, list) else [token])
+                self._flush(i, final=False)
+
+        def end(self):
+            for i in range(len(requests)):
+                self._flush(i, final=True)
+
+        def _flush(self, i: int, final: bool):
+            if requests[i].on_text is None:
+                return
+            with lock:
+                text = tokenizer.decode(self.tokens[i], skip_special_tokens=True)
+            if not final and text.endswith("\ufffd"):
+                return
+            if len(text) > self.sent[i]:
+                requests[i].on_text(text[self.sent[i]:])
+                self.sent[i] = len(text)
+
+    return BatchCallbackStreamer()
+
+
+class InferenceEngine:
+    """Single generation thread per loaded model, batching concurrent requests.
+
+    Agents (possibly several sharing the model) submit
+    prompts from their own threads. The worker collects what is queued
+    within ``batch_wait`` seconds, groups prompts of similar length up to
+    ``max_batch_size`` sequences and ``max_batch_tokens`` padded tokens, and
+    runs one left-padded ``generate`` per group. Requests arriving while a
+    group is decoding are admitted with the next group. Every request
+    streams its text to ``on_text``. Only a group of one goes through the
+    per-conversation KV cache (see ConversationKVCache); batched groups
+    prefill their prompts in full, which is logged once per engine.
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size: int = 4,
+                 max_batch_tokens: int = 16384, batch_wait: float = 0.02, name: str = "engine"):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_batch_tokens = max_batch_tokens
+        self.batch_wait = batch_wait
+        # Fast tokenizers must not be used from several threads at once; agents
+        # hold this lock while encoding prompts, the worker while decoding
+        self.tokenizer_lock = threading.Lock()
+        self.batches = 0
+        self.sequences = 0
+        self._kv_bypass_logged = False
+        self._queue: "queue.Queue[Optional[GenerationRequest]]" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=f"{name}-generate", daemon=True)
+        self._thread.start()
+
+    def submit(self, kv_cache: Optional[ConversationKVCache], conversation_id: str,
+               model_inputs, max_new_tokens: int = 1000,
+               on_text: Optional[Callable[[str], None]] = None) -> Future:
+        """Queue a tokenized single prompt, the future resolves to the decoded reply"""
+        request = GenerationRequest(
+            kv_cache, conversation_id, model_inputs["input_ids"][0], max_new_tokens, on_text
+        )
+        self._queue.put(request)
+        return request.future
+
+    def generate(self, kv_cache: Optional[ConversationKVCache], conversation_id: str,
+                 model_inputs, max_new_tokens: int = 1000,
+                 on_text: Optional[Callable[[str], None]] = None) -> str:
+        return self.submit(kv_cache, conversation_id, model_inputs, max_new_tokens, on_text).result()
+
+    def stop(self):
+        self._queue.put(None)
+
+    def _run(self):
+        while True:
+            request = self._queue.get()
+            if request is None:
+                return
+            batch = [request]
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    request = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if request is None:
+                    self._queue.put(None)
+                    break
+                batch.append(request)
+            for group in self._groups(batch):
+                try:
+                    if len(group) == 1:
+                        replies = [self._generate_single(group[0])]
+                    else:
+                        replies = self._generate_batch(group)
+                except Exception as e:
+                    logger.error(f"Generation failed for {len(group)} requests: {str(e)}")
+                    for r in group:
+                        r.future.set_exception(e)
+                    continue
+                self.batches += 1
+                self.sequences += len(group)
+                for r, reply in zip(group, replies):
+                    r.future.set_result(reply)
+
+    def _groups(self, batch: List[GenerationRequest]) -> List[List[GenerationRequest]]:
+        """Split by prompt length so that padding stays within the token budget"""
+        groups: List[List[GenerationRequest]] = []
+        for request in sorted(batch, key=lambda r: len(r.input_ids)):
+            # Sorted ascending, so the new request is the longest of its group
+            if groups and (len(groups[-1]) + 1) * len(request.input_ids) <= self.max_batch_tokens:
+                groups[-1].append(request)
+            else:
+                groups.append([request])
+        return groups
+
+    def _pad_token_id(self) -> int:
+        if self.tokenizer.pad_token_id is not None:
+            return self.tokenizer.pad_token_id
+        return self.tokenizer.eos_token_id
+
+    def _generate_single(self, request: GenerationRequest) -> str:
+        """Prefill only the tokens not covered by the conversation's KV cache"""
+        import torch
+        from transformers import DynamicCache
+
+        input_ids = request.input_ids
+        input_len = len(input_ids)
+        kv_cache = request.kv_cache
+        cache = None
+        cached = kv_cache.take(request.conversation_id, input_ids.device) if kv_cache else None
+        if cached is not None:
+            cached_ids, cache = cached
+            # At least one prompt token has to go through the model
+            reuse = min(common_prefix_length(cached_ids, input_ids), input_len - 1)
+            if reuse > 0:
+                cache.crop(reuse)
+                kv_cache.reused_tokens += reuse
+            else:
+                cache = None
+        if cache is None:
+            cache = DynamicCache()
+        streamer = None
+        if request.on_text is not None:
+            streamer = _callback_streamer(self.tokenizer, self.tokenizer_lock, request.on_text)
+
+        with torch.inference_mode():
+            generated_ids = self.model.generate(
+                input_ids=input_ids.unsqueeze(0),
+                attention_mask=torch.ones_like(input_ids).unsqueeze(0),
+                past_key_values=cache,
+                max_new_tokens=request.max_new_tokens,
+                pad_token_id=self._pad_token_id(),
+                streamer=streamer,
+            )
+
+        sequence = generated_ids[0]
+        if kv_cache is not None and kv_cache.max_bytes > 0:
+            # The cache lags the sequence by the last sampled token
+            kv_cache.put(request.conversation_id, sequence[:cache.get_seq_length()], cache)
+        with self.tokenizer_lock:
+            return self.tokenizer.decode(sequence[input_len:], skip_special_tokens=True)
+
+    def _generate_batch(self, group: List[GenerationRequest]) -> List[str]:
+        import torch
+
+        pad_token_id = self._pad_token_id()
+        max_len = max(len(r.input_ids) for r in group)
+        device = group[0].input_ids.device
+        input_ids = torch.full((len(group), max_len), pad_token_id, dtype=torch.long, device=device)
+        attention_mask = torch.zeros((len(group), max_len), dtype=torch.long, device=device)
+        for i, r in enumerate(group):
+            # Left padding, so every prompt ends where generation starts
+            input_ids[i, max_len - len(r.input_ids):] = r.input_ids
+            attention_mask[i, max_len - len(r.input_ids):] = 1
+
+        if not self._kv_bypass_logged and any(r.kv_cache is not None and r.kv_cache.max_bytes > 0 for r in group):
+            self._kv_bypass_logged = True
+            logger.warning(
+                "Batched generation does not use the conversation KV cache; "
+                "prompts of batched groups are prefilled in full (set AGENT_MAX_BATCH_SIZE=1 to keep reuse)"
+            )
+        streamer = None
+        if any(r.on_text is not None for r in group):
+            streamer = _batch_callback_streamer(self.tokenizer, self.tokenizer_lock, group)
+
+        with torch.inference_mode():
+            generated_ids = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                max_new_tokens=max(r.max_new_tokens for r in group),
+                pad_token_id=pad_token_id,
+                streamer=streamer,
+            )
+
+        with self.tokenizer_lock:
+            return [
+                self.tokenizer.decode(
+                    generated_ids[i, max_len:max_len + r.max_new_tokens], skip_special_tokens=True
+                )
+                for i, r in enumerate(group)
+            ]
@@ -0,0 +1,132 @@
+from collections import OrderedDict
+from typing import Any, Iterator, Optional, Tuple
+
+
+def _cache_tensors(cache) -> Iterator[Any]:
+    """Key/value tensors of a transformers DynamicCache (old and new layouts)"""
+    import torch
+
+    layers = getattr(cache, "layers", None)
+    if layers is not None:  # transformers >= 4.56
+        for layer in layers:
+            for tensor in (getattr(layer, "keys", None), getattr(layer, "values", None)):
+                if torch.is_tensor(tensor):
+                    yield tensor
+    else:
+        for tensor in list(cache.key_cache) + list(cache.value_cache):
+            if torch.is_tensor(tensor):
+                yield tensor
+
+
+def _move_cache(cache, device):
+    import torch
+
+    layers = getattr(cache, "layers", None)
+    if layers is not None:
+        for layer in layers:
+            if torch.is_tensor(getattr(layer, "keys", None)):
+                layer.keys = layer.keys.to(device)
+                layer.values = layer.values.to(device)
+    else:
+        cache.key_cache = [t.to(device) if torch.is_tensor(t) else t for t in cache.key_cache]
+        cache.value_cache = [t.to(device) if torch.is_tensor(t) else t for t in cache.value_cache]
+
+
+def cache_nbytes(cache) -> int:
+    return sum(t.nbytes for t in _cache_tensors(cache))
+
+
+def common_prefix_length(a, b) -> int:
+    """Number of leading tokens two 1-D token id tensors share"""
+    n = min(len(a), len(b))
+    if n == 0:
+        return 0
+    mismatch = (a[:n].cpu() != b[:n].cpu()).nonzero()
+    return int(mismatch[0]) if len(mismatch) else n
+
+
+class _Entry:
+    __slots__ = ("token_ids", "cache", "size")
+
+    def __init__(self, token_ids, cache, size: int):
+        self.token_ids = token_ids
+        self.cache = cache
+        self.size = size
+
+
+class ConversationKVCache:
+    """Past key/values of the last generation per conversation, LRU within a byte budget.
+
+    The next turn of a conversation starts with the previous prompt plus the
+    previous reply, so only the tokens appended since then need a prefill.
+    Entries evicted from the model device are offloaded to CPU memory while
+    ``cpu_max_bytes`` allows, and moved back on the next hit. On CPU-only
+    machines the device tier already is CPU memory and offloading is skipped.
+    """
+
+    def __init__(self, max_bytes: int, cpu_max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.cpu_max_bytes = cpu_max_bytes
+        self._device: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._cpu: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._device_bytes = 0
+        self._cpu_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+
+    def __len__(self):
+        return len(self._device) + len(self._cpu)
+
+    def take(self, conversation_id: str, device) -> Optional[Tuple[Any, Any]]:
+        """Remove and return (token_ids, cache) of a conversation, on the given device.
+
+        The caller owns the cache while generating (generate extends it in
+        place) and hands it back with put().
+        """
+        entry = self._device.pop(conversation_id, None)
+        if entry is not None:
+            self._device_bytes -= entry.size
+        else:
+            entry = self._cpu.pop(conversation_id, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._cpu_bytes -= entry.size
+            _move_cache(entry.cache, device)
+        self.hits += 1
+        return entry.token_ids, entry.cache
+
+    def put(self, conversation_id: str, token_ids, cache):
+        """Store the cache covering token_ids (1-D, kept on CPU)"""
+        self.drop(conversation_id)
+        entry = _Entry(token_ids.detach().cpu(), cache, cache_nbytes(cache))
+        if entry.size > self.max_bytes:
+            return
+        self._device[conversation_id] = entry
+        self._device_bytes += entry.size
+        while self._device_bytes > self.max_bytes:
+            evicted_id, evicted = self._device.popitem(last=False)
+            self._device_bytes -= evicted.size
+            self._offload(evicted_id, evicted)
+
+    def drop(self, conversation_id: str):
+        entry = self._device.pop(conversation_id, None)
+        if entry is not None:
+            self._device_bytes -= entry.size
+        entry = self._cpu.pop(conversation_id, None)
+        if entry is not None:
+            self._cpu_bytes -= entry.size
+
+    def _offload(self, conversation_id: str, entry: _Entry):
+        if entry.size > self.cpu_max_bytes:
+            return
+        tensor = next(_cache_tensors(entry.cache), None)
+        if tensor is None or tensor.device.type == "cpu":
+            return
+        _move_cache(entry.cache, "cpu")
+        self._cpu[conversation_id] = entry
+        self._cpu_bytes += entry.size
+        while self._cpu_bytes > self.cpu_max_bytes:
+            _, evicted = self._cpu.popitem(last=False)
+            self._cpu_bytes -= evicted.size
@@ -0,0 +1,127 @@
+import logging
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from .inference_engine import InferenceEngine
+
+logger = logging.getLogger("ModelRegistry")
+
+# Models and engines of this process, shared by every agent using the same path
+_models: Dict[Tuple, Tuple[Any, Any]] = {}
+_engines: Dict[int, InferenceEngine] = {}
+# Guards the dicts only; a load holds the lock of its own key, so other models
+# and get_engine() are not blocked for its duration
+_lock = threading.Lock()
+_key_locks: Dict[Tuple, threading.Lock] = {}
+# Model path -> seconds spent loading and warming up, for startup reporting
+load_stats: Dict[str, Dict[str, float]] = {}
+
+QUANTIZATION_MODES = ("", "int8", "4bit")
+
+
+def load_model(model_path: str, quantization: str = "", mmap: bool = False,
+               warmup: bool = False, torch_dtype: Optional[str] = None,
+               **model_kwargs) -> Tuple[Any, Any]:
+    """(model, tokenizer) for a path, loaded once per process.
+
+    Agents hosted together (see agents_starter) that use the same model path
+    and loading options get the same weights and tokenizer. torch and
+    transformers are imported here, on the first load, not with the agents.
+
+    Args:
+        model_path: Hugging Face model id or local path
+        quantization: "" for the checkpoint precision, "int8" or "4bit"
+        mmap: Require safetensors weights, which transformers memory-maps
+        warmup: Run a short generation right after loading
+        torch_dtype: Name of the torch dtype, e.g. "bfloat16"
+    """
+    if quantization not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization {quantization!r}, expected one of {QUANTIZATION_MODES}")
+    options = dict(model_kwargs, quantization=quantization, mmap=mmap, torch_dtype=torch_dtype)
+    key = (model_path, tuple(sorted((k, repr(v)) for k, v in options.items())))
+    with _lock:
+        key_lock = _key_locks.setdefault(key, threading.Lock())
+    with key_lock:
+        with _lock:
+            loaded = _models.get(key)
+        if loaded is None:
+            start = time.perf_counter()
+            model, tokenizer = _load(model_path, quantization, mmap, torch_dtype, model_kwargs)
+            stats = {"load_s": time.perf_counter() - start}
+            logger.info(f"Model {model_path} loaded in {stats['load_s']:.1f}s")
+            if warmup:
+                stats["warmup_s"] = _warm_up(model, tokenizer)
+                logger.info(f"Model {model_path} warmed up in {stats['warmup_s']:.1f}s")
+            with _lock:
+                load_stats[model_path] = stats
+                loaded = _models[key] = (model, tokenizer)
+        else:
+            logger.info(f"Model {model_path} already loaded, sharing it")
+    return loaded
+
+
+def _load(model_path: str, quantization: str, mmap: bool, torch_dtype: Optional[str],
+          model_kwargs: Dict[str, Any]) -> Tuple[Any, Any]:
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    kwargs = dict(model_kwargs)
+    if torch_dtype is not None:
+        kwargs["torch_dtype"] = getattr(torch, torch_dtype)
+    if mmap:
+        # No fallback to .bin weights, which are deserialized whole
+        kwargs["use_safetensors"] = True
+    on_cpu = not torch.cuda.is_available()
+    if quantization == "4bit" or (quantization == "int8" and not on_cpu):
+        from transformers import BitsAndBytesConfig
+
+        if quantization == "4bit":
+            kwargs["quantization_config"] = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=kwargs.get("torch_dtype", torch.bfloat16),
+            )
+        else:
+            kwargs["quantization_config"] = BitsAndBytesConfig(load_in_8bit=True)
+
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    model = AutoModelForCausalLM.from_pretrained(model_path, device_map="auto", **kwargs)
+    if quantization == "int8" and on_cpu:
+        # bitsandbytes int8 needs a GPU; dynamic quantization of the linear
+        # layers gives int8 weights with CPU kernels
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    model.eval()
+    return model, tokenizer
+
+
+def _warm_up(model, tokenizer) -> float:
+    """Seconds taken by a few tokens of generation (kernel selection, allocator, caches)"""
+    import torch
+
+    start = time.perf_counter()
+    inputs = tokenizer(["Hello"], return_tensors="pt").to(model.device)
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    with torch.inference_mode():
+        model.generate(**inputs, max_new_tokens=4, do_sample=False, pad_token_id=pad_token_id)
+    return time.perf_counter() - start
+
+
+def get_engine(model, tokenizer, max_batch_size: int = 1, name: str = "engine") -> InferenceEngine:
+    """The inference engine of a loaded model, so shared weights also share one batch queue"""
+    with _lock:
+        engine = _engines.get(id(model))
+        if engine is None:
+            engine = _engines[id(model)] = InferenceEngine(
+                model, tokenizer, max_batch_size=max_batch_size, name=name
+            )
+        else:
+            engine.max_batch_size = max(engine.max_batch_size, max_batch_size)
+    return engine
+
+
+def stop_engines():
+    with _lock:
+        for engine in _engines.values():
+            engine.stop()
+        _engines.clear()
@@ -4,12 +4,17 @@
 # Оптимизировано под NVIDIA Nemotron-Orchestrator-8B (XML-теги и JSON-схемы инструментов).
 
 from .base_agent import BaseAgent
+from .routing_cache import RoutingCache, bucket_readings, routing_key
+from .tool_call_grammar import ToolCallGrammar, tool_call_logits_processor, tool_call_stopping_criteria
 import json
 import logging
 import os
 import time
 import re
-from typing import Dict, Any, Optional, List, Tuple
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from functools import lru_cache
+from typing import Callable, Dict, Any, Optional, List, Tuple
 
 # --- Описание инструментов в формате JSON Schema (как ожидает Nemotron-Orchestrator-8B) ---
 ORCHESTRATOR_TOOLS_JSON = [
@@ -93,7 +98,7 @@ ORCHESTRATOR_TOOLS_JSON = [
             "type": "object",
             "properties": {
                 "result": {
-                    "type": "string",
+                    "type": ["string", "object"],
                     "description": "Итоговый ответ или вердикт для пользователя ИЛИ высоко-структурированное действие/план в формате JSON."
                 }
             },
@@ -310,6 +315,44 @@ FEWSHOT_DIALOG = [
 
 
 
+@lru_cache(maxsize=1)
+def static_prompt_prefix() -> str:
+    """
+    Неизменная часть промпта оркестратора: system с описанием tools и few-shot диалог.
+    Строится один раз; OrchestratorAgent кэширует её токены и KV-кэш (см. _prefix_state).
+    """
+    tools_json = json.dumps(ORCHESTRATOR_TOOLS_JSON, ensure_ascii=False, indent=2)
+
+    system_prompt = (
+        "You are an expert orchestrator agent managing a factory Digital Twin.\n"
+        "You may call one or more functions to assist with the user query.\n\n"
+        "You are provided with function signatures within <tools></tools> XML tags:\n"
+        "<tools>\n"
+        f"{tools_json}\n"
+        "</tools>\n\n"
+        "For each function call, return a json object with function name and arguments within <tool_call></tool_call> XML tags:\n"
+        "<tool_call>\n"
+        "{\"name\": \"<function-name>\", \"arguments\": <args-json-object>}\n"
+        "</tool_call>\n\n"
+        "Always first think through the problem and plan the sequence of tool calls inside <think>...</think> tags.\n"
+        "Then output one or more <tool_call> blocks with strict JSON (no extra text before or after the JSON object inside the tag).\n"
+        "If you want to return a final, highly structured action plan, call the \"finish\" tool with a JSON object in the \"result\" field.\n"
+    )
+
+    prompt = f"<|im_start|>system\n{system_prompt}<|im_end|>\n"
+
+    # few-shot диалог
+    for m in FEWSHOT_DIALOG:
+        role = m.get("role", "user")
+        content = m.get("content")
+        # Некоторые few-shot примеры содержат только tool_calls (без явного текста).
+        # Такие сообщения пропускаем, чтобы не ломать построение промпта.
+        if not content:
+            continue
+        prompt += f"<|im_start|>{role}\n{content}<|im_end|>\n"
+    return prompt
+
+
 class OrchestratorAgent(BaseAgent):
     """
     Мета-агент: маршрутизирует высокоуровневые запросы между профильными агентами.
@@ -317,10 +360,19 @@ class OrchestratorAgent(BaseAgent):
     """
 
     ORCHESTRATOR_AGENT_ID = 0  # Центральная точка входа
+    # Модель загружается в _generate: шаги из кэша маршрутов обходятся без неё
+    load_model_before_task = False
 
     # Локальный путь к скачанной модели (относительно корня проекта или абсолютный)
     DEFAULT_LOCAL_MODEL_PATH = "nemotron/nemotron-8b"
 
+    # Таймауты инструментов, с; для остальных — tool_timeout
+    TOOL_TIMEOUTS = {
+        "sensor_manager": 10.0,
+        "ipcamera_gige": 15.0,
+        "ipcamera_rtsp": 15.0,
+    }
+
     def __init__(
         self,
         agent_id: int = 0,
@@ -329,6 +381,13 @@ class OrchestratorAgent(BaseAgent):
         model_path: Optional[str] = None,
         max_tool_steps: int = 10,
         use_sensor_manager: bool = False,
+        tool_timeout: float = 300.0,
+        max_parallel_tools: int = 4,
+        constrained_decoding: bool = True,
+        routing_cache_path: Optional[str] = ":memory:",
+        routing_cache_ttl: float = 24 * 3600,
+        routing_cache_size: int = 10000,
+        sensor_bucket: float = 1.0,
     ):
         super().__init__("OrchestratorAgent")
         self.agent_id = agent_id or self.ORCHESTRATOR_AGENT_ID
@@ -337,9 +396,29 @@ class OrchestratorAgent(BaseAgent):
         self.model_path = model_path
         self.model_name = model_name or (model_path if model_path else self.DEFAULT_LOCAL_MODEL_PATH)
         self.max_tool_steps = max_tool_steps
+        # Независимые tool_call одного ответа модели выполняются параллельно
+        self.tool_timeout = tool_timeout
+        self.max_parallel_tools = max(1, max_parallel_tools)
+        self._tool_pool = self._new_tool_pool()
+        # Потоки пула, всё ещё занятые инструментами, которых уже не ждут по таймауту
+        self._stuck_tools: set = set()
+        self._tool_pool_lock = threading.Lock()
         self.running = False
         self._model = None
         self._tokenizer = None
+        # Токены и KV-кэш static_prompt_prefix() для загруженной модели
+        self._prefix_ids = None
+        self._prefix_cache = None
+        self._prefix_lock = threading.Lock()
+        # Внутри <tool_call> модель может выдать только JSON по схемам ORCHESTRATOR_TOOLS_JSON
+        self.constrained_decoding = constrained_decoding
+        self._tool_grammar = ToolCallGrammar(ORCHESTRATOR_TOOLS_JSON)
+        # Кэш планов tool_call по шагам; None отключает, путь к файлу сохраняет между запусками
+        self.routing_cache: Optional[RoutingCache] = None
+        if routing_cache_path is not None:
+            self.routing_cache = RoutingCache(routing_cache_path, routing_cache_ttl, routing_cache_size)
+        # Шаг округления показаний датчиков в ключе кэша
+        self.sensor_bucket = sensor_bucket
         self._sensor_manager: Optional[Any] = None
         self.use_sensor_manager = use_sensor_manager
 
@@ -418,37 +497,11 @@ class OrchestratorAgent(BaseAgent):
         - добавляет описание tools;
         - вшивает few-shot диалог;
         - даёт инструкцию думать в <think> и эмитить JSON tool_call.
+        Всё перечисленное — static_prompt_prefix(); здесь дописывается только изменяемый хвост.
         """
 
-        tools_json = json.dumps(ORCHESTRATOR_TOOLS_JSON, ensure_ascii=False, indent=2)
-
-        system_prompt = (
-            "You are an expert orchestrator agent managing a factory Digital Twin.\n"
-            "You may call one or more functions to assist with the user query.\n\n"
-            "You are provided with function signatures within <tools></tools> XML tags:\n"
-            "<tools>\n"
-            f"{tools_json}\n"
-            "</tools>\n\n"
-            "For each function call, return a json object with function name and arguments within <tool_call></tool_call> XML tags:\n"
-            "<tool_call>\n"
-            "{\"name\": \"<function-name>\", \"arguments\": <args-json-object>}\n"
-            "</tool_call>\n\n"
-            "Always first think through the problem and plan the sequence of tool calls inside <think>...</think> tags.\n"
-            "Then output one or more <tool_call> blocks with strict JSON (no extra text before or after the JSON object inside the tag).\n"
-            "If you want to return a final, highly structured action plan, call the \"finish\" tool with a JSON object in the \"result\" field.\n"
-        )
-
-        prompt = f"<|im_start|>system\n{system_prompt}<|im_end|>\n"
+        prompt = static_prompt_prefix()
 
-        # few-shot диалог
-        for m in FEWSHOT_DIALOG:
-            role = m.get("role", "user")
-            content = m.get("content")
-            # Некоторые few-shot примеры содержат только tool_calls (без явного текста).
-            # Такие сообщения пропускаем, чтобы не ломать построение промпта.
-            if not content:
-                continue
-            prompt += f"<|im_start|>{role}\n{content}<|im_end|>\n"
 
         # История реального диалога
         if messages:
@@ -467,16 +520,32 @@ class OrchestratorAgent(BaseAgent):
         prompt += f"<|im_start|>user\n{current_context}<|im_end|>\n<|im_start|>assistant\n"
         return prompt
 
-    def _generate(self, prompt: str, max_new_tokens: int = 1024) -> str:
+    def _generate(
+        self,
+        prompt: str,
+        max_new_tokens: int = 1024,
+        on_call_closed: Optional[Callable[[str], bool]] = None,
+    ) -> str:
         """
         Инференс Nemotron: ожидается вывод в виде
         <think>...</think>
         <tool_call>{...}</tool_call>
         [<tool_call>{...}</tool_call> ...]
+
+        Промпты из _build_state начинаются со static_prompt_prefix(): его токены
+        и KV-кэш берутся из _prefix_state, кодируется и прогоняется только хвост.
+
+        Генерация останавливается, как только после закрытого </tool_call> модель
+        пишет что-то кроме нового <tool_call>; on_call_closed получает текст
+        при каждом закрытом вызове (см. tool_call_stopping_criteria).
         """
         self._load_model()
         import torch
 
+        prefix = static_prompt_prefix()
+        if prompt.startswith(prefix):
+            return self._generate_with_prefix(prompt[len(prefix):], max_new_tokens, on_call_closed)
+
         device = next(self._model.parameters()).device
         inputs = self._tokenizer(
             prompt,
@@ -493,11 +562,99 @@ class OrchestratorAgent(BaseAgent):
                 do_sample=False,
                 pad_token_id=self._tokenizer.pad_token_id,
                 eos_token_id=self._tokenizer.eos_token_id,
+                **self._decoding_kwargs(input_len, on_call_closed),
             )
 
         new_tokens = outputs[0][input_len:]
         return self._tokenizer.decode(new_tokens, skip_special_tokens=True)
 
+    def _decoding_kwargs(
+        self, prompt_len: int, on_call_closed: Optional[Callable[[str], bool]] = None
+    ) -> Dict[str, Any]:
+        """
+        Параметры generate: ранняя остановка по </tool_call> и, в режиме
+        constrained_decoding, logits processor по схемам инструментов.
+        """
+        from transformers import LogitsProcessorList, StoppingCriteriaList
+
+        kwargs: Dict[str, Any] = {
+            "stopping_criteria": StoppingCriteriaList([
+                tool_call_stopping_criteria(self._tokenizer, prompt_len, on_call_closed)
+            ]),
+        }
+        if self.constrained_decoding:
+            kwargs["logits_processor"] = LogitsProcessorList([
+                tool_call_logits_processor(self._tokenizer, self._tool_grammar, prompt_len)
+            ])
+        return kwargs
+
+    def _prefix_state(self):
+        """Токены (1, L) и KV-кэш static_prompt_prefix(), считаются один раз на загруженную модель."""
+        if self._prefix_ids is None:
+            import torch
+            from transformers import DynamicCache
+
+            device = next(self._model.parameters()).device
+            prefix_ids = self._tokenizer(static_prompt_prefix(), return_tensors="pt").input_ids.to(device)
+            cache = DynamicCache()
+            with torch.inference_mode():
+                self._model(input_ids=prefix_ids, past_key_values=cache, use_cache=True)
+            self._prefix_cache = cache
+            self._prefix_ids = prefix_ids
+            self.log(f"Static prompt prefix cached: {prefix_ids.shape[1]} tokens", "info")
+        return self._prefix_ids, self._prefix_cache
+
+    def _context_length(self) -> int:
+        """Длина контекста модели (max_position_embeddings), 4096 если конфиг её не указывает."""
+        return int(getattr(self._model.config, "max_position_embeddings", None) or 4096)
+
+    def _generate_with_prefix(
+        self, tail: str, max_new_tokens: int, on_call_closed: Optional[Callable[[str], bool]] = None
+    ) -> str:
+        """Генерация по static_prompt_prefix() + tail: prefill только хвоста."""
+        import torch
+
+        with self._prefix_lock:
+            prefix_ids, cache = self._prefix_state()
+            prefix_len = prefix_ids.shape[1]
+            # Префикс заканчивается на "<|im_end|>\n", хвост начинается со спецтокена,
+            # так что раздельная токенизация совпадает с токенизацией всего промпта
+            tail_ids = self._tokenizer(
+                tail,
+                return_tensors="pt",
+                add_special_tokens=False,
+            ).input_ids.to(prefix_ids.device)
+            # Не влезающий в контекст хвост режем слева: конец промпта
+            # (<|im_start|>assistant\n) должен остаться
+            budget = max(1, self._context_length() - max_new_tokens - prefix_len)
+            if tail_ids.shape[1] > budget:
+                self.log(
+                    f"Prompt tail truncated from {tail_ids.shape[1]} to {budget} tokens "
+                    f"(context {self._context_length()}, prefix {prefix_len}, max_new_tokens {max_new_tokens})",
+                    "warning",
+                )
+                tail_ids = tail_ids[:, -budget:]
+            input_ids = torch.cat([prefix_ids, tail_ids], dim=1)
+
+            try:
+                with torch.inference_mode():
+                    outputs = self._model.generate(
+                        input_ids=input_ids,
+                        attention_mask=torch.ones_like(input_ids),
+                        past_key_values=cache,
+                        max_new_tokens=max_new_tokens,
+                        do_sample=False,
+                        pad_token_id=self._tokenizer.pad_token_id,
+                        eos_token_id=self._tokenizer.eos_token_id,
+                        **self._decoding_kwargs(input_ids.shape[1], on_call_closed),
+                    )
+            finally:
+                # generate дописывает кэш на месте; обрезаем его обратно до префикса
+                cache.crop(prefix_len)
+
+        new_tokens = outputs[0][input_ids.shape[1]:]
+        return self._tokenizer.decode(new_tokens, skip_special_tokens=True)
+
     # --- парсер JSON tool_call из ответа модели ---
 
     TOOL_CALL_RE = re.compile(
@@ -580,6 +737,71 @@ class OrchestratorAgent(BaseAgent):
         metadata["latency_ms"] = (time.perf_counter() - t0) * 1000
         return result, metadata
 
+    def _new_tool_pool(self) -> ThreadPoolExecutor:
+        return ThreadPoolExecutor(max_workers=self.max_parallel_tools, thread_name_prefix="OrchestratorAgent-tool")
+
+    def _dispatch_tool(
+        self, tool_call: Dict[str, Any], reasoning: str, context: Dict[str, Any]
+    ) -> Tuple[Dict[str, Any], Future, float]:
+        """Запускает tool_call в пуле инструментов: (tool_call, future, время запуска)."""
+        with self._tool_pool_lock:
+            future = self._tool_pool.submit(self._execute_tool, tool_call, reasoning, context)
+        return tool_call, future, time.perf_counter()
+
+    def _abandon_tool(self, tool_name: str, future: Future):
+        """
+        Учитывает инструмент, не уложившийся в таймаут. Ещё не начатый вызов отменяется;
+        поток Python прервать нельзя, поэтому зависшие потоки считаются, и когда они
+        занимают половину пула, новые вызовы идут в свежий пул, а старый бросается.
+        """
+        if future.cancel():
+            self.log(f"Tool {tool_name} cancelled before it started: the tool pool is busy", "warning")
+            return
+        with self._tool_pool_lock:
+            stuck = self._stuck_tools
+            stuck.add(future)
+            future.add_done_callback(stuck.discard)
+            self.log(
+                f"Tool {tool_name} is still running after its timeout; "
+                f"{len(stuck)}/{self.max_parallel_tools} tool workers are occupied by timed-out calls",
+                "warning",
+            )
+            if len(stuck) >= max(1, self.max_parallel_tools // 2):
+                self.log(f"Replacing the tool pool, abandoning {len(stuck)} stuck workers", "warning")
+                self._tool_pool.shutdown(wait=False)
+                self._tool_pool = self._new_tool_pool()
+                self._stuck_tools = set()
+
+    def _await_tools(
+        self, dispatched: List[Tuple[Dict[str, Any], Future, float]], reasoning: str
+    ) -> List[Tuple[str, Dict[str, Any]]]:
+        """
+        Ждёт запущенные tool_call, каждый со своим таймаутом от момента запуска.
+        Результаты возвращаются в порядке запуска, независимо от порядка завершения.
+        """
+        results: List[Tuple[str, Dict[str, Any]]] = []
+        for tc, future, started_at in dispatched:
+            tool_name = tc.get("name", "").strip()
+            timeout = self.TOOL_TIMEOUTS.get(tool_name, self.tool_timeout)
+            try:
+                results.append(future.result(timeout=max(0.0, timeout - (time.perf_counter() - started_at))))
+            except FutureTimeoutError:
+                self.log(f"Tool {tool_name} timed out after {timeout}s", "warning")
+                self._abandon_tool(tool_name, future)
+                results.append((
+                    f"Ошибка: инструмент {tool_name} не ответил за {timeout:g} с",
+                    {"tool": tool_name, "latency_ms": timeout * 1000, "success": False,
+                     "reasoning": reasoning, "timeout": True},
+                ))
+            except Exception as e:
+                self.log(f"Tool {tool_name} failed: {e}", "error")
+                results.append((
+                    f"Ошибка: инструмент {tool_name} завершился с ошибкой: {e}",
+                    {"tool": tool_name, "latency_ms": (time.perf_counter() - started_at) * 1000,
+                     "success": False, "reasoning": reasoning},
+                ))
+        return results
+
     def compute_reward(
         self,
         tool_metadata: List[Dict],
@@ -633,62 +855,110 @@ class OrchestratorAgent(BaseAgent):
             sensor_readings=sensor_readings,
             task_params={"request": high_level_request, **context},
         )
-
-        self._load_model()
+        # Тот же хвост промпта, но с округлёнными показаниями датчиков — для ключа кэша
+        key_tail = self._build_state(
+            conversation_id=conversation_id,
+            messages=context.get("messages", []),
+            sensor_readings=bucket_readings(sensor_readings, self.sensor_bucket),
+            task_params={"request": high_level_request, **context},
+        )[len(static_prompt_prefix()):]
+        model_id = self._resolve_model_path()
+        decoding = {"max_new_tokens": 1024, "do_sample": False, "constrained": self.constrained_decoding}
 
         final_result = ""
         finished = False
+        cached_steps = 0
 
         for _ in range(self.max_tool_steps):
-            raw_output = self._generate(prompt)
-            self._llm_call_count += 1
+            # tool_call запускаются, как только закрывается их </tool_call>,
+            # пока модель дописывает следующие вызовы
+            dispatched: List[Tuple[Dict[str, Any], Future, float]] = []
+
+            def on_call_closed(text: str) -> bool:
+                reasoning, calls = self._parse_tool_calls(text)
+                for tc in calls[len(dispatched):]:
+                    if tc.get("name") == "finish":
+                        return True
+                    dispatched.append(self._dispatch_tool(tc, reasoning, context))
+                return False
+
+            cache_key = routing_key(key_tail, model_id, decoding, static_prompt_prefix())
+            raw_output = self.routing_cache.get(cache_key) if self.routing_cache is not None else None
+            if raw_output is not None:
+                cached_steps += 1
+            else:
+                raw_output = self._generate(prompt, max_new_tokens=decoding["max_new_tokens"],
+                                            on_call_closed=on_call_closed)
+                self._llm_call_count += 1
+                if self.routing_cache is not None:
+                    self.routing_cache.put(cache_key, raw_output)
 
             # парсим CoT + tool_call
             reasoning, tool_calls = self._parse_tool_calls(raw_output)
 
-            if not tool_calls:
+            if not tool_calls and not dispatched:
                 steps.append({"tool": "none", "result_preview": raw_output, "reasoning": reasoning})
                 break
 
-            # каждый tool_call — отдельный шаг
-            for tc in tool_calls:
-                tool_name = tc.get("name")
-                if tool_name == "finish":
-                    # finish не исполняем как внешний API, просто фиксируем результат и выходим
-                    final_result = tc.get("arguments", {}).get("result", "")
-                    steps.append(
-                        {
-                            "tool": "finish",
-                            "reasoning": reasoning,
-                            "result": final_result,
-                            "success": True,
-                        }
-                    )
-                    finished = True
-                    break
-
-                result_text, meta = self._execute_tool(tc, reasoning, context)
+            # tool_call до первого finish независимы и выполняются параллельно;
+            # каждый — отдельный шаг
+            finish_call = next((tc for tc in tool_calls if tc.get("name") == "finish"), None)
+            if finish_call is not None:
+                tool_calls = tool_calls[:tool_calls.index(finish_call)]
+
+            # Вызовы, не запущенные во время генерации (например, без закрывающего тега в потоке)
+            for tc in tool_calls[len(dispatched):]:
+                dispatched.append(self._dispatch_tool(tc, reasoning, context))
+            results = self._await_tools(dispatched, reasoning)
+            for result_text, meta in results:
                 steps.append({**meta, "result_preview": str(result_text)[:200]})
 
-                # возвращаем результат инструмента в модель в виде <tool_response>
-                prompt += f"{raw_output}<|im_end|>\n"
-                prompt += f"<|im_start|>user\n<tool_response>\n{result_text}\n</tool_response>\n<|im_end|>\n<|im_start|>assistant\n"
-
-            if finished:
+            if finish_call is not None:
+                # finish не исполняем как внешний API, просто фиксируем результат и выходим
+                final_result = finish_call.get("arguments", {}).get("result", "")
+                steps.append(
+                    {
+                        "tool": "finish",
+                        "reasoning": reasoning,
+                        "result": final_result,
+                        "success": True,
+                    }
+                )
+                finished = True
                 break
 
+            # возвращаем результаты инструментов в модель в порядке tool_call, в виде <tool_response>
+            turn = f"{raw_output}<|im_end|>\n<|im_start|>user\n"
+            for result_text, _ in results:
+                turn += f"<tool_response>\n{result_text}\n</tool_response>\n"
+            turn += "<|im_end|>\n<|im_start|>assistant\n"
+            prompt += turn
+            key_tail += turn
+
         reward = self.compute_reward(
             steps,
             sensor_sim_vs_real=sensor_readings,
             outcome_success=finished,
         )
 
-        return {
+        out = {
             "result": final_result or (steps[-1].get("result", steps[-1].get("result_preview", "")) if steps else ""),
             "steps": steps,
             "reward": reward,
             "llm_calls": self._llm_call_count,
+            "cached_steps": cached_steps,
         }
+        if self.routing_cache is not None:
+            out["routing_cache"] = self.routing_cache.stats()
+        return out
+
+    def stop(self):
+        super().stop()
+        with self._tool_pool_lock:
+            self._tool_pool.shutdown(wait=False, cancel_futures=True)
+        if self.routing_cache is not None:
+            self.log(f"Routing cache: {self.routing_cache.stats()}", "info")
+            self.routing_cache.close()
 
     def process_task(self, task: Dict[str, Any]) -> str:
         params = task.get("params", {})
@@ -714,6 +984,10 @@ def main():
     parser.add_argument("--model", default=None, help="HuggingFace model name (e.g. nvidia/Nemotron-Orchestrator-8B)")
     parser.add_argument("--model-path", default=None, help="Локальный путь к модели (например nemotron/nemotron-8b)")
     parser.add_argument("--use-sensors", action="store_true")
+    parser.add_argument("--no-constrained", action="store_true", help="Не ограничивать tool_call грамматикой схем инструментов")
+    parser.add_argument("--routing-cache", default=":memory:",
+                        help="SQLite-файл кэша планов маршрутизации (':memory:' — только в процессе, '' — отключить)")
+    parser.add_argument("--routing-cache-ttl", type=float, default=24 * 3600, help="TTL записей кэша маршрутизации, с")
     parser.add_argument("--poll-interval", type=float, default=2.0)
     parser.add_argument("--test-inference", action="store_true", help="Один прогон инференса с тестовым запросом и выход")
     args = parser.parse_args()
@@ -724,6 +998,9 @@ def main():
         model_name=args.model,
         model_path=args.model_path,
         use_sensor_manager=args.use_sensors,
+        constrained_decoding=not args.no_constrained,
+        routing_cache_path=args.routing_cache or None,
+        routing_cache_ttl=args.routing_cache_ttl,
     )
 
     if args.test_inference:
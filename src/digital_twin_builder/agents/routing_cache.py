@@ -0,0 +1,118 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+
+def normalize_text(text: str) -> str:
+    """Whitespace and case folded, so that near-identical requests share a key"""
+    return " ".join(text.split()).casefold()
+
+
+def bucket_readings(readings: Any, bucket: float) -> Any:
+    """Sensor values rounded to multiples of bucket (nested dicts and lists)"""
+    if isinstance(readings, bool) or bucket <= 0:
+        return readings
+    if isinstance(readings, (int, float)):
+        return round(round(readings / bucket) * bucket, 6)
+    if isinstance(readings, dict):
+        return {k: bucket_readings(v, bucket) for k, v in readings.items()}
+    if isinstance(readings, list):
+        return [bucket_readings(v, bucket) for v in readings]
+    return readings
+
+
+def routing_key(prompt_tail: str, model_id: str, decoding: Dict[str, Any], prompt_prefix: str = "") -> str:
+    prefix_hash = hashlib.sha256(prompt_prefix.encode("utf-8")).hexdigest()
+    payload = json.dumps(
+        [normalize_text(prompt_tail), model_id, decoding, prefix_hash], ensure_ascii=False, sort_keys=True
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class RoutingCache:
+    """Model outputs (tool-call plans) of orchestrator steps, TTL and LRU bounded, in SQLite.
+
+    Keys come from routing_key(): the normalized dynamic prompt tail
+    (rendered with bucketed sensor readings), a hash of the static prompt
+    prefix (tool schemas, few-shot examples), the model and the decoding
+    parameters, so a cached plan is what greedy decoding would produce again.
+    Only the plan is cached; its tools still run on every hit. A file path
+    keeps plans across restarts, ":memory:" only for the process.
+    """
+
+    def __init__(self, path: str = ":memory:", ttl: float = 24 * 3600, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS routing_cache ("
+            " key TEXT PRIMARY KEY,"
+            " plan TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_routing_cache_last_used ON routing_cache (last_used)"
+        )
+        self._conn.commit()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM routing_cache").fetchone()[0]
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT plan, created_at FROM routing_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and now - row[1] > self.ttl:
+                self._conn.execute("DELETE FROM routing_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE routing_cache SET last_used = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, plan: str):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO routing_cache (key, plan, created_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, plan, now, now),
+            )
+            self._conn.execute("DELETE FROM routing_cache WHERE created_at < ?", (now - self.ttl,))
+            # Least recently used beyond the size bound
+            self._conn.execute(
+                "DELETE FROM routing_cache WHERE key IN ("
+                " SELECT key FROM routing_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hit_rate, 4),
+            "entries": len(self),
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
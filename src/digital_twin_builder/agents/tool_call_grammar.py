@@ -0,0 +1,364 @@
+from typing import Any, Callable, Dict, List, Optional
+
+TOOL_CALL_OPEN = "<tool_call>"
+TOOL_CALL_CLOSE = "</tool_call>"
+
+# Prefix check results
+INVALID = "invalid"
+PARTIAL = "partial"
+COMPLETE = "complete"
+
+_WHITESPACE = " \n\r\t"
+# Longer whitespace runs are rejected so that the model cannot stall inside a call
+_MAX_WHITESPACE = 8
+_ESCAPES = '"\\/bfnrtu'
+_DIGITS = "0123456789"
+_HEX = "0123456789abcdefABCDEF"
+_TYPE_BY_FIRST_CHAR = {'"': "string", "{": "object", "[": "array", "t": "boolean", "f": "boolean", "n": "null"}
+
+
+class _Incomplete(Exception):
+    """The text ended before the grammar did: it is a valid prefix"""
+
+
+class _Invalid(Exception):
+    pass
+
+
+class _Cursor:
+    __slots__ = ("text", "pos")
+
+    def __init__(self, text: str):
+        self.text = text
+        self.pos = 0
+
+    def peek(self) -> str:
+        if self.pos >= len(self.text):
+            raise _Incomplete
+        return self.text[self.pos]
+
+    def next(self) -> str:
+        char = self.peek()
+        self.pos += 1
+        return char
+
+    def literal(self, expected: str):
+        for char in expected:
+            if self.next() != char:
+                raise _Invalid
+
+    def whitespace(self):
+        start = self.pos
+        while self.pos < len(self.text) and self.text[self.pos] in _WHITESPACE:
+            self.pos += 1
+        if self.pos - start > _MAX_WHITESPACE:
+            raise _Invalid
+
+
+class ToolCallGrammar:
+    """Prefix validator for the JSON inside <tool_call>...</tool_call>.
+
+    Accepts ``{"name": <tool>, "arguments": {...}}`` followed by the closing
+    tag, where the tool is one of the given function schemas
+    (ORCHESTRATOR_TOOLS_JSON format) and the arguments follow its
+    ``parameters``: only declared properties, each at most once, required
+    ones before the object closes, values of the declared type or enum.
+    Undeclared value types fall back to any JSON value.
+    """
+
+    def __init__(self, tools: List[Dict[str, Any]]):
+        self.tools = {tool["name"]: tool.get("parameters", {}) for tool in tools}
+
+    def check(self, text: str) -> str:
+        """INVALID, PARTIAL (a valid prefix) or COMPLETE (call and closing tag) for the text after <tool_call>"""
+        cursor = _Cursor(text)
+        try:
+            self._call(cursor)
+        except _Incomplete:
+            return PARTIAL
+        except _Invalid:
+            return INVALID
+        rest = text[cursor.pos:]
+        return COMPLETE if not rest.strip(_WHITESPACE) else INVALID
+
+    def _call(self, c: _Cursor):
+        c.whitespace()
+        c.literal("{")
+        c.whitespace()
+        c.literal('"name"')
+        c.whitespace()
+        c.literal(":")
+        c.whitespace()
+        name = self._enum_string(c, list(self.tools))
+        c.whitespace()
+        c.literal(",")
+        c.whitespace()
+        c.literal('"arguments"')
+        c.whitespace()
+        c.literal(":")
+        c.whitespace()
+        self._object(c, self.tools[name])
+        c.whitespace()
+        c.literal("}")
+        c.whitespace()
+        c.literal(TOOL_CALL_CLOSE)
+
+    def _value(self, c: _Cursor, schema: Dict[str, Any]):
+        if "enum" in schema:
+            self._enum_string(c, [str(v) for v in schema["enum"]])
+            return
+        kind = schema.get("type")
+        if isinstance(kind, list):
+            # Union of types: the first character decides which one the value is
+            char = c.peek()
+            kind = _TYPE_BY_FIRST_CHAR.get(char, "number" if char == "-" or char in _DIGITS else None)
+            if kind == "number" and "number" not in schema["type"] and "integer" in schema["type"]:
+                kind = "integer"
+            if kind not in schema["type"]:
+                raise _Invalid
+            self._value(c, {"type": kind})
+            return
+        if kind == "string":
+            self._string(c)
+        elif kind == "integer":
+            self._number(c, fraction=False)
+        elif kind == "number":
+            self._number(c, fraction=True)
+        elif kind == "boolean":
+            self._keyword(c, ("true", "false"))
+        elif kind == "object" and "properties" in schema:
+            self._object(c, schema)
+        else:
+            self._any(c)
+
+    def _object(self, c: _Cursor, schema: Dict[str, Any]):
+        properties = schema.get("properties", {})
+        required = set(schema.get("required", []))
+        seen = set()
+        c.literal("{")
+        c.whitespace()
+        if c.peek() == "}":
+            if not required <= seen:
+                raise _Invalid
+            c.next()
+            return
+        while True:
+            remaining = [key for key in properties if key not in seen]
+            if not remaining:
+                raise _Invalid
+            key = self._enum_string(c, remaining)
+            seen.add(key)
+            c.whitespace()
+            c.literal(":")
+            c.whitespace()
+            self._value(c, properties[key])
+            c.whitespace()
+            char = c.next()
+            if char == "}":
+                if not required <= seen:
+                    raise _Invalid
+                return
+            if char != "," or len(seen) == len(properties):
+                raise _Invalid
+            c.whitespace()
+
+    def _enum_string(self, c: _Cursor, options: List[str]) -> str:
+        """A quoted string equal to one of options (options do not need escaping)"""
+        c.literal('"')
+        start = c.pos
+        while True:
+            char = c.next()
+            value = c.text[start:c.pos - 1]
+            if char == '"':
+                if value in options:
+                    return value
+                raise _Invalid
+            if not any(option.startswith(value + char) for option in options):
+                raise _Invalid
+
+    def _string(self, c: _Cursor):
+        c.literal('"')
+        while True:
+            char = c.next()
+            if char == '"':
+                return
+            if char == "\\":
+                escape = c.next()
+                if escape not in _ESCAPES:
+                    raise _Invalid
+                if escape == "u":
+                    for _ in range(4):
+                        if c.next() not in _HEX:
+                            raise _Invalid
+            elif ord(char) < 0x20:
+                raise _Invalid
+
+    def _number(self, c: _Cursor, fraction: bool):
+        if c.peek() == "-":
+            c.next()
+        if c.next() not in _DIGITS:
+            raise _Invalid
+        self._digits(c)
+        if fraction and c.peek() == ".":
+            c.next()
+            if c.next() not in _DIGITS:
+                raise _Invalid
+            self._digits(c)
+        if fraction and c.peek() in "eE":
+            c.next()
+            if c.peek() in "+-":
+                c.next()
+            if c.next() not in _DIGITS:
+                raise _Invalid
+            self._digits(c)
+
+    @staticmethod
+    def _digits(c: _Cursor):
+        # A number only ends at the next character, so running out of text here is a prefix
+        while c.peek() in _DIGITS:
+            c.next()
+
+    @staticmethod
+    def _keyword(c: _Cursor, options):
+        start = c.pos
+        while True:
+            value = c.text[start:c.pos]
+            if value in options:
+                return
+            char = c.next()
+            if not any(option.startswith(value + char) for option in options):
+                raise _Invalid
+
+    def _any(self, c: _Cursor):
+        char = c.peek()
+        if char == '"':
+            self._string(c)
+        elif char == "{":
+            c.next()
+            c.whitespace()
+            if c.peek() == "}":
+                c.next()
+                return
+            while True:
+                self._string(c)
+                c.whitespace()
+                c.literal(":")
+                c.whitespace()
+                self._any(c)
+                c.whitespace()
+                char = c.next()
+                if char == "}":
+                    return
+                if char != ",":
+                    raise _Invalid
+                c.whitespace()
+        elif char == "[":
+            c.next()
+            c.whitespace()
+            if c.peek() == "]":
+                c.next()
+                return
+            while True:
+                self._any(c)
+                c.whitespace()
+                char = c.next()
+                if char == "]":
+                    return
+                if char != ",":
+                    raise _Invalid
+                c.whitespace()
+        elif char == "-" or char in _DIGITS:
+            self._number(c, fraction=True)
+        else:
+            self._keyword(c, ("true", "false", "null"))
+
+
+def open_call_text(text: str) -> Optional[str]:
+    """Text after the last <tool_call> that has not been closed yet, None outside a call"""
+    start = text.rfind(TOOL_CALL_OPEN)
+    if start < 0:
+        return None
+    body = text[start + len(TOOL_CALL_OPEN):]
+    return None if TOOL_CALL_CLOSE in body else body
+
+
+def tool_call_logits_processor(tokenizer, grammar: ToolCallGrammar, prompt_len: int,
+                               max_allowed: int = 1, candidates_per_pass: int = 64):
+    """LogitsProcessor keeping the text inside <tool_call> blocks valid for the grammar.
+
+    Outside a call the scores are left alone. Inside one, candidate tokens are
+    tried in score order and only the best ``max_allowed`` that keep the call a
+    valid prefix are left unmasked (1 is enough for greedy decoding); the
+    vocabulary is scanned ``candidates_per_pass`` tokens at a time, so the
+    usual case costs a couple of prefix checks. Assumes batch size 1.
+    """
+    import torch
+    from transformers import LogitsProcessor
+
+    token_texts: Dict[int, str] = {}
+
+    def token_text(token_id: int) -> str:
+        text = token_texts.get(token_id)
+        if text is None:
+            text = token_texts[token_id] = tokenizer.decode([token_id], skip_special_tokens=False)
+        return text
+
+    class ToolCallLogitsProcessor(LogitsProcessor):
+        def __call__(self, input_ids, scores):
+            generated = tokenizer.decode(input_ids[0, prompt_len:], skip_special_tokens=False)
+            body = open_call_text(generated)
+            if body is None:
+                return scores
+            allowed: List[int] = []
+            order = torch.argsort(scores[0], descending=True)
+            for start in range(0, order.shape[0], candidates_per_pass):
+                for token_id in order[start:start + candidates_per_pass].tolist():
+                    if grammar.check(body + token_text(token_id)) != INVALID:
+                        allowed.append(token_id)
+                        if len(allowed) >= max_allowed:
+                            break
+                if allowed:
+                    break
+            if not allowed:
+                return scores
+            mask = torch.full_like(scores, float("-inf"))
+            mask[0, allowed] = 0
+            return scores + mask
+
+    return ToolCallLogitsProcessor()
+
+
+def tool_call_stopping_criteria(tokenizer, prompt_len: int,
+                                on_call_closed: Optional[Callable[[str], bool]] = None):
+    """StoppingCriteria following the decoded stream for closed tool calls.
+
+    Every time a </tool_call> arrives, ``on_call_closed`` receives the text
+    generated so far (e.g. to dispatch the new call while decoding goes on)
+    and may return True to stop. Generation also stops once a call has been
+    closed and the model continues with anything but another <tool_call>.
+    """
+    import torch
+    from transformers import StoppingCriteria
+
+    class ToolCallStop(StoppingCriteria):
+        def __init__(self):
+            self.closed = 0
+            self.stopped = False
+
+        def __call__(self, input_ids, scores, **kwargs):
+            if not self.stopped:
+                self.stopped = self._check(tokenizer.decode(input_ids[0, prompt_len:], skip_special_tokens=True))
+            return torch.full((input_ids.shape[0],), self.stopped, dtype=torch.bool, device=input_ids.device)
+
+        def _check(self, generated: str) -> bool:
+            closed = generated.count(TOOL_CALL_CLOSE)
+            if closed == 0:
+                return False
+            if closed > self.closed:
+                self.closed = closed
+                if on_call_closed is not None and on_call_closed(generated):
+                    return True
+            tail = generated[generated.rfind(TOOL_CALL_CLOSE) + len(TOOL_CALL_CLOSE):].lstrip(_WHITESPACE)
+            return not (tail.startswith(TOOL_CALL_OPEN) or TOOL_CALL_OPEN.startswith(tail))
+
+    return ToolCallStop()
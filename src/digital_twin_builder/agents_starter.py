@@ -1,44 +1,87 @@
-from agents import UserInteractionAgent, DatabaseAgent, DigitalTwinAgent
-from config import API_URL
+import os
+import sys
+import signal
+import threading
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from digital_twin_builder.agents import UserInteractionAgent, DatabaseAgent, DigitalTwinAgent
+from digital_twin_builder.agents.model_registry import stop_engines
+from digital_twin_builder.config import API_URL
 
-def start_agents(api_url=None, models=[]):
+# Roles that can be hosted together; agents with the same model path share
+# the loaded weights, tokenizer and inference engine (see model_registry)
+AGENT_ROLES = {
+    "ui": UserInteractionAgent,
+    "db": DatabaseAgent,
+    "dt": DigitalTwinAgent,
+}
+
+
+def start_agents(api_url=None, roles=("ui", "db", "dt"), poll_interval=2.0):
+    """Create the agents of the given roles and run each poll loop in its own thread"""
     if api_url is None:
         api_url = API_URL
-    ui_agent = UserInteractionAgent(0, api_url)
-    db_agent = DatabaseAgent(1, api_url)
-    dt_agent = DigitalTwinAgent(2, api_url)
+    agents = []
+    for role in roles:
+        agent = AGENT_ROLES[role]()
+        agent.api_url = api_url.rstrip('/')
+        agents.append(agent)
+
+    threads = []
+    for agent in agents:
+        thread = threading.Thread(
+            target=agent.run, kwargs={"interval": poll_interval}, name=agent.name, daemon=True
+        )
+        thread.start()
+        threads.append(thread)
+    return agents, threads
+
+
+def stop_agents(agents):
+    for agent in agents:
+        agent.stop()
+    stop_engines()
+
 
 def main():
     """Main entry point with command-line arguments."""
     import argparse
-    
+
     parser = argparse.ArgumentParser(description="Start all agents for digital twin builder")
-    parser.add_argument("--api-url", default="http://localhost:8000",
-                       help="API server URL (default: http://localhost:8000)")
+    parser.add_argument("--api-url", default=API_URL,
+                       help=f"API server URL (default: {API_URL})")
+    parser.add_argument("--agents", default="ui,db,dt",
+                       help=f"Comma-separated roles to host in this process, of {', '.join(AGENT_ROLES)} (default: ui,db,dt)")
     parser.add_argument("--poll-interval", type=float, default=2.0,
                        help="Polling interval in seconds (default: 2.0)")
     parser.add_argument("--once", action="store_true",
                        help="Run once and exit (useful for testing)")
-    parser.add_argument("--model", type=str, default="abdulmannan-01/qwen-2.5-1.5b-finetuned-for-sql-generation",
-                       help="Model from hugging face or local path to it")
 
     args = parser.parse_args()
-    
-    # Create and run agent
-    agent = DatabaseAgent(args.agent_id, args.api_url, args.model)
-    
+    roles = [role.strip() for role in args.agents.split(",") if role.strip()]
+    unknown = [role for role in roles if role not in AGENT_ROLES]
+    if unknown:
+        parser.error(f"Unknown agent roles: {', '.join(unknown)}")
+
+    if args.once:
+        agents = [AGENT_ROLES[role]() for role in roles]
+        for agent in agents:
+            agent.api_url = args.api_url.rstrip('/')
+            agent.run_once()
+        stop_agents(agents)
+        return
+
+    agents, threads = start_agents(args.api_url, roles, args.poll_interval)
+
     # Handle graceful shutdown
     def signal_handler(sig, frame):
-        agent.stop()
+        stop_agents(agents)
         sys.exit(0)
-    
+
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
-    
-    if args.once:
-        agent.run_once()
-    else:
-        agent.run(interval=args.poll_interval)
+
+    for thread in threads:
+        thread.join()
 
 
 if __name__ == "__main__":
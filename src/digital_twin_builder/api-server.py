@@ -1,100 +1,171 @@
 # api_server.py
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from typing import Optional, Dict, Any
-import uuid
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, ValidationError
+from typing import Optional, Dict, Any, List
 import json
-from datetime import datetime
-import asyncpg
+import time
+import asyncio
+from datetime import datetime, timezone
 import os
+import uuid
 from contextlib import asynccontextmanager
 
-# Configuration
-DB_CONFIG = {
-    "host": os.getenv("DB_HOST", "localhost"),
-    "port": int(os.getenv("DB_PORT", 5432)),
-    "database": os.getenv("DB_NAME", "llm_agents"),
-    "user": os.getenv("DB_USER", "postgres"),
-    "password": os.getenv("DB_PASSWORD", "password")
-}
-
-# Global connection pool
-pool = None
-
-async def init_db_pool():
-    """Initialize database connection pool"""
-    global pool
+import database as db
+
+# Long-poll configuration: upper bound for how long /agent/poll may hold a request
+POLL_MAX_WAIT = float(os.getenv("POLL_MAX_WAIT", 30))
+# Fallback re-check period while waiting, in case a notification is missed
+POLL_RECHECK_INTERVAL = float(os.getenv("POLL_RECHECK_INTERVAL", 5))
+# Upper bound for tasks leased by one /agent/poll?max_tasks=N call
+POLL_MAX_TASKS = int(os.getenv("POLL_MAX_TASKS", 64))
+# Upper bound for the page size of GET /conversations/{id}/messages
+MESSAGES_PAGE_MAX = int(os.getenv("MESSAGES_PAGE_MAX", 1000))
+# Comment line sent on idle task streams so proxies keep the connection open
+STREAM_KEEPALIVE_INTERVAL = float(os.getenv("STREAM_KEEPALIVE_INTERVAL", 15))
+# How often the LISTEN connection is checked and re-established when lost
+LISTENER_CHECK_INTERVAL = float(os.getenv("LISTENER_CHECK_INTERVAL", 10))
+# How often partitions are pre-created and expired ones dropped
+PARTITION_MAINTENANCE_INTERVAL = float(os.getenv("PARTITION_MAINTENANCE_INTERVAL", 3600))
+
+# Dedicated connection for LISTEN and per-agent wakeup events
+listen_conn = None
+task_events: Dict[int, asyncio.Event] = {}
+
+def get_task_event(agent_id: int) -> asyncio.Event:
+    """Get the wakeup event that long-polling requests of an agent wait on"""
+    event = task_events.get(agent_id)
+    if event is None:
+        event = task_events[agent_id] = asyncio.Event()
+    return event
+
+def on_task_created(conn, pid, channel, payload):
+    """LISTEN callback: wake up everyone waiting for tasks of this agent"""
     try:
-        pool = await asyncpg.create_pool(
-            min_size=1,
-            max_size=10,
-            **DB_CONFIG
-        )
-        print("✅ Database pool initialized")
-        
-        # Create tables if they don't exist
-        async with pool.acquire() as conn:
-            # TODO: full database structure with conversation
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS tasks (
-                    id VARCHAR(36) PRIMARY KEY,
-                    agent_id INTEGER NOT NULL,
-                    conversation_id UUID, 
-                    params JSONB DEFAULT '{}',
-                    status VARCHAR(20) NOT NULL DEFAULT 'pending',
-                    result TEXT,
-                    error TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    started_at TIMESTAMP,
-                    completed_at TIMESTAMP,
-                    priority INTEGER DEFAULT 0
-                )
-            ''')
-            
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS agent_status (
-                    agent_id INTEGER PRIMARY KEY,
-                    status VARCHAR(20) DEFAULT 'idle',
-                    last_heartbeat TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    current_task_id VARCHAR(36)
-                )
-            ''')
-            
-            # Create indexes
-            await conn.execute('''
-                CREATE INDEX IF NOT EXISTS idx_tasks_status_agent 
-                ON tasks(agent_id, status)
-            ''')
-            
-            await conn.execute('''
-                CREATE INDEX IF NOT EXISTS idx_tasks_pending 
-                ON tasks(status, priority DESC, created_at) 
-                WHERE status = 'pending'
-            ''')
-            
-        return pool
+        agent_id = int(payload)
+    except ValueError:
+        return
+    # Waiters keep a reference to the old event, new waiters get a fresh one
+    event = task_events.pop(agent_id, None)
+    if event is not None:
+        event.set()
+
+# Per-task wakeup events for /tasks/{id}/stream
+progress_events: Dict[str, asyncio.Event] = {}
+
+def get_progress_event(task_id: str) -> asyncio.Event:
+    """Get the event that streams of a task wait on for new output or completion"""
+    event = progress_events.get(task_id)
+    if event is None:
+        event = progress_events[task_id] = asyncio.Event()
+    return event
+
+def on_task_progress(conn, pid, channel, payload):
+    """LISTEN callback: wake up the streams of this task"""
+    event = progress_events.pop(payload, None)
+    if event is not None:
+        event.set()
+
+# Per-session wakeup events for /sessions/{id}/events
+session_events: Dict[str, asyncio.Event] = {}
+
+def get_session_event(session_id: str) -> asyncio.Event:
+    """Get the event that event streams of a session wait on"""
+    event = session_events.get(session_id)
+    if event is None:
+        event = session_events[session_id] = asyncio.Event()
+    return event
+
+def on_session_event(conn, pid, channel, payload):
+    """LISTEN callback: wake up the event streams of this session"""
+    event = session_events.pop(payload, None)
+    if event is not None:
+        event.set()
+
+async def init_task_listener():
+    """Open a dedicated connection listening for new tasks and task progress"""
+    global listen_conn
+    try:
+        listen_conn = await db.listen(db.TASK_NOTIFY_CHANNEL, on_task_created)
+        await listen_conn.add_listener(db.TASK_PROGRESS_CHANNEL, on_task_progress)
+        await listen_conn.add_listener(db.SESSION_EVENTS_CHANNEL, on_session_event)
+        print("✅ Task listener initialized")
     except Exception as e:
-        print(f"❌ Database initialization failed: {e}")
-        raise
+        # Long-poll still works through periodic re-checks
+        if listen_conn is not None:
+            listen_conn.terminate()
+        listen_conn = None
+        print(f"⚠️ Task listener unavailable: {e}")
+
+def listener_alive() -> bool:
+    return listen_conn is not None and not listen_conn.is_closed()
 
-async def get_db_connection():
-    """Get a database connection from the pool"""
-    global pool
-    if pool is None:
-        raise HTTPException(status_code=503, detail="Database not initialized")
-    return pool
+def wake_all_waiters():
+    """Wake every long-poll and stream, so they re-read what notifications may have missed"""
+    for events in (task_events, progress_events, session_events):
+        for event in events.values():
+            event.set()
+        events.clear()
+
+async def task_listener_loop():
+    """Re-establish the LISTEN connection after a database restart or network failure"""
+    global listen_conn
+    while True:
+        await asyncio.sleep(LISTENER_CHECK_INTERVAL)
+        if listener_alive():
+            try:
+                # A half-open connection is only noticed on use
+                await asyncio.wait_for(listen_conn.execute("SELECT 1"), LISTENER_CHECK_INTERVAL)
+                continue
+            except Exception as e:
+                print(f"⚠️ Task listener lost: {e}")
+                listen_conn.terminate()
+        listen_conn = None
+        await init_task_listener()
+        if listener_alive():
+            wake_all_waiters()
+
+async def partition_maintenance_loop():
+    """Keep partitions ahead of time and apply retention in the background"""
+    while True:
+        await asyncio.sleep(PARTITION_MAINTENANCE_INTERVAL)
+        try:
+            await db.maintain_partitions()
+        except Exception as e:
+            print(f"⚠️ Partition maintenance failed: {e}")
+
+def database_error(e: Exception) -> HTTPException:
+    if not db.is_initialized():
+        return HTTPException(status_code=503, detail="Database not initialized")
+    return HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+def sse_event(event: str, data: Dict, event_id: Any = None) -> str:
+    """Format one server-sent event"""
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{head}event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
 
 # Lifespan context manager for FastAPI
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
     print("🚀 Starting API server...")
-    await init_db_pool()
+    try:
+        await db.init_pool()
+        print("✅ Database pool initialized")
+    except Exception as e:
+        print(f"❌ Database initialization failed: {e}")
+        raise
+    await init_task_listener()
+    listener = asyncio.create_task(task_listener_loop())
+    maintenance = asyncio.create_task(partition_maintenance_loop())
     yield
     # Shutdown
-    if pool:
-        await pool.close()
-        print("👋 Database pool closed")
+    listener.cancel()
+    maintenance.cancel()
+    if listen_conn:
+        await listen_conn.close()
+    await db.close_pool()
+    print("👋 Database pool closed")
 
 app = FastAPI(
     title="LLM Agent API",
@@ -111,24 +182,42 @@ class TaskRequest(BaseModel):
 
 class AgentPollRequest(BaseModel):
     agent_id: int
+    wait: float = 0  # seconds to hold the request open if no task is pending
 
 class ResultSubmission(BaseModel):
     result: str
     error: Optional[str] = None
 
+class TaskCompletion(BaseModel):
+    content: str
+    content_type: str = "text"
+    metadata: Dict[str, Any] = {}
+    # Agent completing the task; a task of another agent is not completed
+    agent_id: Optional[int] = None
+
+class ProgressChunk(BaseModel):
+    delta: str
+
+class MessageItem(BaseModel):
+    role: str
+    content: str
+    content_type: str = "text"
+    metadata: Dict[str, Any] = {}
+
+
+def with_conv_idx(conversation: Dict) -> Dict:
+    """Fill conv_idx from metadata for conversations created before the column existed"""
+    if conversation.get("conv_idx") is None:
+        metadata = conversation.get("metadata") or {}
+        conversation["conv_idx"] = metadata.get("conv_idx", 0)
+    return conversation
 
 @app.post("/sessions")
 async def create_session(
-    user_id: str = "default", 
+    user_id: str = "default",
     title: Optional[str] = None
 ):
-    session_id = str(uuid.uuid4())
-    async with pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO sessions (id, user_id, title)
-            VALUES ($1, $2, $3)
-        """, session_id, user_id, title)
-
+    session_id = await db.create_session(user_id, title)
     return {"session_id": session_id}
 
 @app.get("/sessions")
@@ -137,47 +226,89 @@ async def get_sessions(
     limit: int = 50,
     offset: int = 0
 ):
-    async with pool.acquire() as conn:
-        sessions = await conn.fetch("""
-            SELECT id, title, user_id
-            FROM sessions 
-            WHERE user_id = $1
-            ORDER BY updated_at DESC
-            LIMIT $2 OFFSET $3
-        """, user_id, limit, offset)
-    
+    sessions = await db.list_sessions(user_id, limit, offset)
     return {
-        "sessions": [dict(c) for c in sessions],
+        "sessions": sessions,
     }
 
 @app.get("/sessions/{session_id}")
 async def get_session(session_id: str):
-    async with pool.acquire() as conn:
-        session = await conn.fetchrow("""
-            SELECT id, title, user_id
-            FROM sessions 
-            WHERE id = $1
-        """, session_id)
-                
-        if not session:
-            raise HTTPException(status_code=404, detail="Session not found")
-        
-        # Get conversations
-        conversations = await conn.fetch("""
-            SELECT id, session_id, agent_id, conv_idx, created_at, metadata
-            FROM conversations 
-            WHERE session_id = $1
-            ORDER BY created_at ASC
-        """, session_id)
-    
+    found = await db.get_session(session_id)
+    if not found:
+        raise HTTPException(status_code=404, detail="Session not found")
+    session, conversations = found
+
     return {
-        "session": dict(session),
-        "conversations": [
-            {**dict(c), "conv_idx": c["conv_idx"] if "conv_idx" in c else (c["metadata"].get("conv_idx", 0) if c["metadata"] else 0)}
-            for c in conversations
-        ]
+        "session": session,
+        "conversations": [with_conv_idx(c) for c in conversations]
     }
 
+@app.get("/sessions/{session_id}/events")
+async def stream_session_events(session_id: str, request: Request, since: Optional[str] = None):
+    """Server-sent events for all tasks of a session's conversations.
+
+    ``token`` events carry streamed output ``{task_id, agent_id, conv_idx, offset, delta}``,
+    ``task`` events a finished task. Event ids are ``<completed_xid>:<task_id>``
+    cursors, ordered by the transaction that finished the task; a fresh
+    subscription gets one first in a ``ready`` event. Reconnects resume after
+    Last-Event-ID (or ``since``) without skipping late commits.
+    """
+    cursor_text = request.headers.get("last-event-id") or since
+    if cursor_text:
+        cursor_xid, _, cursor_id = cursor_text.partition(":")
+        if not cursor_xid.isdigit():
+            raise HTTPException(status_code=400, detail="since must be an event id")
+    else:
+        try:
+            cursor_xid, cursor_id = await db.session_events_start(), ""
+        except Exception as e:
+            raise database_error(e)
+
+    async def events():
+        nonlocal cursor_xid, cursor_id
+        # task_id -> length of its output sent so far
+        sent: Dict[str, int] = {}
+        if not cursor_text:
+            yield sse_event("ready", {}, f"{cursor_xid}:{cursor_id}")
+        while True:
+            # Take the event before reading, so changes in between wake us up
+            event = get_session_event(session_id)
+            try:
+                finished, progress = await db.get_session_events(session_id, cursor_xid, cursor_id)
+            except Exception as e:
+                yield sse_event("error", {"detail": f"Database error: {str(e)}"})
+                return
+            for p in progress:
+                offset = sent.get(p["task_id"], 0)
+                if len(p["content"]) > offset:
+                    yield sse_event("token", {
+                        "task_id": p["task_id"],
+                        "agent_id": p["agent_id"],
+                        "conv_idx": p["conv_idx"],
+                        "offset": offset,
+                        "delta": p["content"][offset:],
+                    })
+                    sent[p["task_id"]] = len(p["content"])
+            for task in finished:
+                sent.pop(task["id"], None)
+                cursor_xid, cursor_id = task.pop("completed_xid"), task["id"]
+                yield sse_event("task", task, f"{cursor_xid}:{cursor_id}")
+            if len(finished) == db.SESSION_EVENTS_PAGE_SIZE:
+                continue  # more finished tasks than one page
+            if await request.is_disconnected():
+                return
+            timeout = STREAM_KEEPALIVE_INTERVAL if listener_alive() else POLL_RECHECK_INTERVAL
+            try:
+                await asyncio.wait_for(event.wait(), timeout)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # API endpoints for chat history
 @app.post("/conversations")
 async def create_conversation(
@@ -186,13 +317,7 @@ async def create_conversation(
     conv_idx: int = 0
 ):
     """Create a new conversation"""
-    conversation_id = str(uuid.uuid4())
-    async with pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO conversations (id, session_id, agent_id, conv_idx, metadata)
-            VALUES ($1, $2, $3, $4, $5)
-        """, conversation_id, session_id, agent_id, conv_idx, json.dumps({"conv_idx": conv_idx}))
-    
+    conversation_id = await db.create_conversation(session_id, agent_id, conv_idx)
     return {"conversation_id": conversation_id, "conv_idx": conv_idx}
 
 @app.get("/conversations")
@@ -202,63 +327,62 @@ async def get_conversations(
     offset: int = 0
 ):
     """Get list of conversations for a user"""
-    async with pool.acquire() as conn:
-        conversations = await conn.fetch("""
-            SELECT id, created_at, updated_at, conv_idx, metadata
-            FROM conversations 
-            WHERE agent_id = $3
-            ORDER BY updated_at DESC
-            LIMIT $1 OFFSET $2
-        """, limit, offset, agent_id)
-    
+    conversations = await db.list_conversations(agent_id, limit, offset)
     return {
-        "conversations": [
-            {**dict(c), "conv_idx": c["conv_idx"] if "conv_idx" in c else (c["metadata"].get("conv_idx", 0) if c["metadata"] else 0)}
-            for c in conversations
-        ]
+        "conversations": [with_conv_idx(c) for c in conversations]
     }
 
 @app.get("/conversations/{conversation_id}")
 async def get_conversation(conversation_id: str):
     """Get full conversation with messages"""
-    async with pool.acquire() as conn:
-        # Get conversation info
-        conversation = await conn.fetchrow("""
-            SELECT id, created_at, updated_at, metadata
-            FROM conversations 
-            WHERE id = $1
-            """, conversation_id)
-        
-        if not conversation:
-            raise HTTPException(status_code=404, detail="Conversation not found")
-        
-        # Get messages
-        messages = await conn.fetch("""
-            SELECT id, role, content, content_type,
-                   metadata, created_at, tokens
-            FROM messages 
-            WHERE conversation_id = $1
-            ORDER BY created_at ASC
-        """, conversation_id)
-    
+    found = await db.get_conversation(conversation_id)
+    if not found:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    conversation, messages = found
+
+    return {
+        "conversation": conversation,
+        "messages": messages
+    }
+
+@app.get("/conversations/{conversation_id}/messages")
+async def get_conversation_messages(
+    conversation_id: str,
+    after: Optional[str] = None,
+    limit: int = 100,
+    fields: Optional[str] = None
+):
+    """Page of messages after a cursor (message id or ISO timestamp), oldest first"""
+    after_id = after_ts = None
+    if after:
+        try:
+            after_id = str(uuid.UUID(after))
+        except ValueError:
+            try:
+                after_ts = datetime.fromisoformat(after)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="after must be a message id or an ISO timestamp")
+            if after_ts.tzinfo is None:
+                after_ts = after_ts.replace(tzinfo=timezone.utc)
+
+    requested = [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+    unknown = set(requested or []) - set(db.MESSAGE_FIELDS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+
+    messages = await db.get_messages_page(
+        conversation_id, after_id, after_ts, max(1, min(limit, MESSAGES_PAGE_MAX)), requested
+    )
     return {
-        "conversation": dict(conversation),
-        "messages": [dict(m) for m in messages]
+        "messages": messages,
+        # Pass back as ?after= to continue from the last returned message
+        "next_after": messages[-1]["id"] if messages else after
     }
 
 @app.get("/conversations/{conversation_id}/last_message")
 async def get_conversation_last_message(conversation_id: str):
     """Get full conversation with messages"""
-    async with pool.acquire() as conn:
-        message = await conn.fetch("""
-            SELECT id, role, content, content_type,
-                   metadata, created_at, tokens
-            FROM messages
-            WHERE conversation_id = $1
-            ORDER BY created_at DESC
-            LIMIT 1
-        """, conversation_id)
-    
+    message = await db.get_last_message(conversation_id)
     return {
         "last_message": message
     }
@@ -272,33 +396,23 @@ async def add_message(
     metadata: Dict = {}
 ):
     """Add a message to conversation"""
-    async with pool.acquire() as conn:
-        # Verify conversation exists
-        conv_exists = await conn.fetchval(
-            "SELECT 1 FROM conversations WHERE id = $1",
-            conversation_id
-        )
-        if not conv_exists:
-            raise HTTPException(status_code=404, detail="Conversation not found")
-        
-        # Add message
-        message_id = str(uuid.uuid4())
-        await conn.execute("""
-            INSERT INTO messages 
-            (id, conversation_id, role, content, content_type, metadata)
-            VALUES ($1, $2, $3, $4, $5, $6)
-        """, message_id, conversation_id, role, 
-            content, content_type, json.dumps(metadata))
-        
-        # Update conversation timestamp
-        await conn.execute("""
-            UPDATE conversations 
-            SET updated_at = CURRENT_TIMESTAMP 
-            WHERE id = $1
-        """, conversation_id)
-    
+    message_id = await db.add_message(conversation_id, role, content, content_type, metadata)
+    if message_id is None:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+
     return {"message_id": message_id}
 
+@app.post("/conversations/{conversation_id}/messages/batch")
+async def add_messages(conversation_id: str, messages: List[MessageItem]):
+    """Add several messages to conversation in order, in one statement"""
+    if not messages:
+        raise HTTPException(status_code=400, detail="No messages provided")
+    message_ids = await db.add_messages(conversation_id, [m.model_dump() for m in messages])
+    if message_ids is None:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+
+    return {"message_ids": message_ids}
+
 @app.post("/conversations/{conversation_id}/agent-chain")
 async def process_agent_chain(
     conversation_id: str,
@@ -313,172 +427,241 @@ async def process_agent_chain(
         content=user_message,
         metadata={"context": context or {}}
     )
-    
+
     # 2. Create task for User Interaction Agent
-    task_id = await create_task({
-        "agent_id": 1,  # UIA
-        "conv_idx": 0,
-        "conversation_id": conversation_id,
-        "params": {
+    task = await create_task(TaskRequest(
+        agent_id=1,  # UIA
+        conv_idx=0,
+        conversation_id=conversation_id,
+        params={
             "user_message_id": user_msg_id["message_id"],
             "context": context
         },
-        "priority": 0,
-    })
-    
-    return {"task_id": task_id, "conversation_id": conversation_id}
+        priority=0,
+    ))
+
+    return {"task_id": task["task_id"], "conversation_id": conversation_id}
 
 # API Endpoints
 @app.post("/tasks")
 async def create_task(task: TaskRequest):
     """Submit a new task from UI"""
-    task_id = str(uuid.uuid4())
-    
     try:
-        async with (await get_db_connection()).acquire() as conn:
-            # Insert task
-            await conn.execute('''
-                INSERT INTO tasks (id, agent_id, conversation_id, params, status, priority)
-                VALUES ($1, $2, $3, $4, 'pending', $5)
-            ''', task_id, task.agent_id, task.conversation_id, 
-                json.dumps(task.params), task.priority)
-            
-            # Get queue position
-            count = await conn.fetchval('''
-                SELECT COUNT(*) FROM tasks 
-                WHERE agent_id = $1 AND status = 'pending'
-            ''', task.agent_id)
+        task_id, count = await db.create_task(
+            task.agent_id, task.conversation_id, task.params, task.priority
+        )
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
-    
+        raise database_error(e)
+
     return {
         "task_id": task_id,
         "status": "pending",
         "position_in_queue": count
     }
 
+async def parse_bulk_tasks(request: Request) -> List[TaskRequest]:
+    """Parse a JSON array or an NDJSON stream (one task per line) of tasks"""
+    try:
+        if "ndjson" in request.headers.get("content-type", ""):
+            tasks = []
+            buffer = b""
+            async for chunk in request.stream():
+                buffer += chunk
+                *lines, buffer = buffer.split(b"\n")
+                tasks.extend(TaskRequest.model_validate_json(line) for line in lines if line.strip())
+            if buffer.strip():
+                tasks.append(TaskRequest.model_validate_json(buffer))
+            return tasks
+
+        items = json.loads(await request.body())
+        if not isinstance(items, list):
+            raise HTTPException(status_code=422, detail="Expected a JSON array of tasks")
+        return [TaskRequest.model_validate(item) for item in items]
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors())
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON: {str(e)}")
+
+@app.post("/tasks/bulk")
+async def create_tasks_bulk(request: Request):
+    """Submit many tasks at once (JSON array or application/x-ndjson).
+
+    Rows are ingested with COPY in one transaction and queue positions are
+    read from task_queue_stats once afterwards.
+    """
+    tasks = await parse_bulk_tasks(request)
+    if not tasks:
+        return {"tasks": [], "count": 0}
+
+    try:
+        created = await db.create_tasks_bulk([task.model_dump() for task in tasks])
+    except Exception as e:
+        raise database_error(e)
+
+    result = [
+        {
+            "task_id": task_id,
+            "status": "pending",
+            "position_in_queue": position
+        }
+        for task_id, position in created
+    ]
+    return {"tasks": result, "count": len(result)}
+
 @app.post("/agent/poll")
-async def poll_for_tasks(poll: AgentPollRequest):
-    """Agent polls for available tasks"""
+async def poll_for_tasks(poll: AgentPollRequest, max_tasks: Optional[int] = None):
+    """Agent polls for available tasks.
+
+    With ``wait > 0`` the request is held open (up to ``POLL_MAX_WAIT`` seconds)
+    until a task for the agent is inserted, so idle agents do not hammer the database.
+    Without ``max_tasks`` a single task (or null) is returned; with ``max_tasks=N``
+    up to N tasks are leased at once and returned as a list.
+    """
+    limit = min(max(max_tasks or 1, 1), POLL_MAX_TASKS)
+    wait = min(max(poll.wait, 0), POLL_MAX_WAIT)
+    deadline = time.monotonic() + wait
     try:
-        async with (await get_db_connection()).acquire() as conn:
-            # Update agent heartbeat
-            await conn.execute('''
-                INSERT INTO agent_status (agent_id, last_heartbeat, status)
-                VALUES ($1, NOW(), 'active')
-                ON CONFLICT (agent_id) DO UPDATE 
-                SET last_heartbeat = NOW(), status = 'active'
-            ''', poll.agent_id)
-            
-            # Get highest priority pending task with SKIP LOCKED
-            task = await conn.fetchrow('''
-                SELECT id, conversation_id, params 
-                FROM tasks 
-                WHERE agent_id = $1 AND status = 'pending'
-                ORDER BY priority DESC, created_at ASC
-                LIMIT 1
-                FOR UPDATE SKIP LOCKED
-            ''', poll.agent_id)
-            
-            if task:
-                # Mark as processing
-                await conn.execute('''
-                    UPDATE tasks 
-                    SET status = 'processing', started_at = NOW()
-                    WHERE id = $1
-                ''', task['id'])
-                
-                # Update agent status
-                await conn.execute('''
-                    UPDATE agent_status 
-                    SET status = 'busy', current_task_id = $1
-                    WHERE agent_id = $2
-                ''', task['id'], poll.agent_id)
-                
-                return {
-                    "task_id": task['id'],
-                    "conversation_id": task['conversation_id'],
-                    "params": json.loads(task['params'])
-                }
-            
-            return None
+        # Take the event before querying, so a task inserted in between is not missed
+        event = get_task_event(poll.agent_id)
+        tasks = await db.claim_tasks(poll.agent_id, limit)
+        while not tasks:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(event.wait(), timeout=min(remaining, POLL_RECHECK_INTERVAL))
+            except asyncio.TimeoutError:
+                # No notification: re-check only if the listener is down
+                if listener_alive():
+                    continue
+            event = get_task_event(poll.agent_id)
+            tasks = await db.claim_tasks(poll.agent_id, limit)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+        raise database_error(e)
+
+    if max_tasks is None:
+        return tasks[0] if tasks else None
+    return tasks
 
 @app.post("/tasks/{task_id}/result")
 async def submit_result(task_id: str, result: ResultSubmission):
     """Agent submits task result"""
     try:
-        async with (await get_db_connection()).acquire() as conn:
-            # Update task with result
-            row = await conn.fetchrow('''
-                UPDATE tasks 
-                SET status = $1, 
-                    result = $2, 
-                    error = $3, 
-                    completed_at = NOW()
-                WHERE id = $4
-                RETURNING agent_id
-            ''', 'failed' if result.error else 'completed',
-                result.result, result.error, task_id)
-            
-            if row:
-                # Update agent status back to idle
-                await conn.execute('''
-                    UPDATE agent_status 
-                    SET status = 'idle', current_task_id = NULL
-                    WHERE agent_id = $1
-                ''', row['agent_id'])
+        await db.submit_result(task_id, result.result, result.error)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
-    
+        raise database_error(e)
+
     return {"status": "success"}
 
+@app.post("/tasks/{task_id}/complete")
+async def complete_task(task_id: str, completion: TaskCompletion):
+    """Agent appends its answer to the task conversation and completes the task atomically.
+
+    Retries are idempotent: completing a completed task returns its message.
+    """
+    try:
+        completed = await db.complete_task(
+            task_id, completion.content, completion.content_type, completion.metadata,
+            completion.agent_id
+        )
+    except Exception as e:
+        raise database_error(e)
+
+    if completed is None:
+        raise HTTPException(status_code=404, detail="Task not found")
+    if not completed["completed"]:
+        raise HTTPException(status_code=409, detail=f"Task is {completed['status']}, not processing")
+    return {"status": "success", "message_id": completed["message_id"]}
+
+@app.post("/tasks/{task_id}/progress")
+async def append_task_progress(task_id: str, chunk: ProgressChunk):
+    """Agent appends streamed output of a task it is processing"""
+    try:
+        length = await db.append_progress(task_id, chunk.delta)
+    except Exception as e:
+        raise database_error(e)
+
+    if length is None:
+        raise HTTPException(status_code=409, detail="Task is not processing")
+    return {"length": length}
+
+@app.get("/tasks/{task_id}/stream")
+async def stream_task(task_id: str, request: Request, offset: int = 0):
+    """Server-sent events with the output of a task as it is generated.
+
+    ``token`` events carry new text (the event id is the output length so far,
+    reconnects resume from Last-Event-ID), a final ``done`` event carries the task.
+    """
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id and last_event_id.isdigit():
+        offset = int(last_event_id)
+
+    async def events():
+        sent = offset
+        while True:
+            # Take the event before reading, so output written in between wakes us up
+            event = get_progress_event(task_id)
+            try:
+                progress = await db.get_task_progress(task_id, sent)
+            except Exception as e:
+                yield sse_event("error", {"detail": f"Database error: {str(e)}"})
+                return
+            if progress is None:
+                yield sse_event("error", {"detail": "Task not found"})
+                return
+            if progress["delta"]:
+                sent += len(progress["delta"])
+                yield sse_event("token", {"delta": progress["delta"]}, sent)
+            if progress["status"] in ("completed", "failed", "cancelled"):
+                yield sse_event("done", await db.get_task(task_id))
+                return
+            if await request.is_disconnected():
+                return
+            # Without the listener only periodic re-reads notice new output
+            timeout = STREAM_KEEPALIVE_INTERVAL if listener_alive() else POLL_RECHECK_INTERVAL
+            try:
+                await asyncio.wait_for(event.wait(), timeout)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/tasks/{task_id}")
 async def get_task_status(task_id: str):
     """Get task status and result"""
     try:
-        async with (await get_db_connection()).acquire() as conn:
-            task = await conn.fetchrow('''
-                SELECT t.id, t.agent_id, c.conv_idx, t.conversation_id, t.status, t.result, t.error,
-                       t.created_at, t.started_at, t.completed_at
-                FROM tasks t, conversations c WHERE t.id = $1 AND c.conversation_id = t.conversation_id;
-            ''', task_id)
-            
-            if not task:
-                raise HTTPException(status_code=404, detail="Task not found")
-            
-            return dict(task)
-    except HTTPException:
-        raise
+        task = await db.get_task(task_id)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+        raise database_error(e)
+
+    if not task:
+        raise HTTPException(status_code=404, detail="Task not found")
+    return task
 
 @app.get("/agents/{agent_id}/status")
 async def get_agent_status(agent_id: int):
     """Get current agent status"""
     try:
-        async with (await get_db_connection()).acquire() as conn:
-            agent = await conn.fetchrow('''
-                SELECT * FROM agent_status WHERE agent_id = $1
-            ''', agent_id)
-            
-            if not agent:
+        agent = await db.get_agent_status(agent_id)
+
+        if not agent:
+            return {"agent_id": agent_id, "status": "offline"}
+
+        # Check if agent is stale (> 5 minutes since heartbeat)
+        if agent['last_heartbeat']:
+            now = datetime.now(timezone.utc)
+            last_heartbeat = agent['last_heartbeat']
+            if last_heartbeat.tzinfo is None:
+                last_heartbeat = last_heartbeat.replace(tzinfo=timezone.utc)
+
+            if (now - last_heartbeat).total_seconds() > 300:
                 return {"agent_id": agent_id, "status": "offline"}
-            
-            # Convert to dict
-            agent_dict = dict(agent)
-            
-            # Check if agent is stale (> 5 minutes since heartbeat)
-            if agent_dict['last_heartbeat']:
-                from datetime import datetime, timezone
-                now = datetime.now(timezone.utc)
-                last_heartbeat = agent_dict['last_heartbeat'].replace(tzinfo=timezone.utc)
-                
-                if (now - last_heartbeat).total_seconds() > 300:
-                    return {"agent_id": agent_id, "status": "offline"}
-            
-            return agent_dict
+
+        return agent
     except Exception as e:
         return {"agent_id": agent_id, "status": "error", "error": str(e)}
 
@@ -486,43 +669,36 @@ async def get_agent_status(agent_id: int):
 async def get_queue_status(agent_id: int):
     """Get queue status for agent"""
     try:
-        async with (await get_db_connection()).acquire() as conn:
-            pending_count = await conn.fetchval('''
-                SELECT COUNT(*) FROM tasks 
-                WHERE agent_id = $1 AND status = 'pending'
-            ''', agent_id)
-            
-            active_task = await conn.fetchrow('''
-                SELECT id, started_at FROM tasks 
-                WHERE agent_id = $1 AND status = 'processing'
-                LIMIT 1
-            ''', agent_id)
+        return await db.get_queue_status(agent_id)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
-    
-    return {
-        "agent_id": agent_id,
-        "pending_count": pending_count or 0,
-        "active_task": dict(active_task) if active_task else None
-    }
+        raise database_error(e)
+
+@app.get("/metrics/system")
+async def get_system_metrics():
+    """Get system-wide task and agent counters"""
+    try:
+        return await db.get_system_metrics()
+    except Exception as e:
+        raise database_error(e)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """Database statement latency histograms and pool wait time (Prometheus text format)"""
+    return PlainTextResponse(db.render_metrics(), media_type="text/plain; version=0.0.4")
 
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
     try:
-        async with (await get_db_connection()).acquire() as conn:
-            # Check database connection
-            db_ok = await conn.fetchval("SELECT 1")
-            
-            # Check pool status
-            pool_status = "healthy" if pool else "uninitialized"
-            
-            return {
-                "status": "healthy",
-                "database": "connected" if db_ok else "disconnected",
-                "pool": pool_status,
-                "timestamp": datetime.now().isoformat()
-            }
+        # Check database connection
+        db_ok = await db.ping()
+
+        return {
+            "status": "healthy",
+            "database": "connected" if db_ok else "disconnected",
+            "pool": "healthy" if db.is_initialized() else "uninitialized",
+            "timestamp": datetime.now().isoformat()
+        }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -534,11 +710,18 @@ async def root():
         "version": "1.0.0",
         "endpoints": {
             "submit_task": "POST /tasks",
+            "submit_tasks_bulk": "POST /tasks/bulk",
             "poll_task": "POST /agent/poll",
             "submit_result": "POST /tasks/{task_id}/result",
+            "complete_task": "POST /tasks/{task_id}/complete",
+            "task_progress": "POST /tasks/{task_id}/progress",
+            "stream_task": "GET /tasks/{task_id}/stream",
+            "session_events": "GET /sessions/{session_id}/events",
             "get_task": "GET /tasks/{task_id}",
             "get_agent": "GET /agents/{agent_id}/status",
             "get_queue": "GET /queue/{agent_id}",
+            "system_metrics": "GET /metrics/system",
+            "prometheus_metrics": "GET /metrics",
             "health": "GET /health"
         }
     }
@@ -5,6 +5,7 @@ Used by both streamlit-app and other agents.
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
+import json
 import time
 import logging
 from config import API_URL
@@ -73,6 +74,34 @@ def submit_task(agent_id, conversation_id, params, conv_idx=0):
         return None
 
 
+def submit_tasks_bulk(tasks):
+    """Submit many tasks to API in one request
+    
+    Args:
+        tasks: List of dicts with agent_id, conv_idx, conversation_id, params
+            and optionally priority (default 5, as in submit_task)
+    
+    Returns:
+        list: One dict with task_id and position_in_queue per task, or None if error
+    """
+    try:
+        session = get_session()
+        payload = [{"priority": 5, "conv_idx": 0, **task} for task in tasks]
+        response = session.post(
+            f"{API_URL}/tasks/bulk",
+            json=payload,
+            timeout=60,
+        )
+        if response.status_code == 200:
+            return response.json()["tasks"]
+        else:
+            logger.error(f"API Error: {response.status_code}")
+            return None
+    except Exception as e:
+        logger.error(f"Connection error: {str(e)}")
+        return None
+
+
 def add_message_to_conversation(conversation_id, role, content):
     """Add a message to a conversation
     
@@ -105,6 +134,33 @@ def add_message_to_conversation(conversation_id, role, content):
     return None
 
 
+def add_messages_to_conversation(conversation_id, messages):
+    """Add several messages to a conversation in one request
+    
+    Args:
+        conversation_id: ID of the conversation
+        messages: List of dicts with role and content, written in order
+    
+    Returns:
+        list: Message IDs or None if error
+    """
+    try:
+        session = get_session()
+        response = session.post(
+            f"{API_URL}/conversations/{conversation_id}/messages/batch",
+            json=messages,
+            timeout=10,
+        )
+        if response.status_code == 200:
+            return response.json()["message_ids"]
+        else:
+            logger.error(f"API Error: {response.status_code}")
+            return None
+    except Exception as e:
+        logger.error(f"Connection error: {str(e)}")
+    return None
+
+
 def get_task_status(task_id):
     """Get task status from API
     
@@ -143,34 +199,133 @@ def get_agent_status(agent_id):
     return {"status": "offline"}
 
 
+def _iter_sse(response):
+    """Yield (event, data, id) triples from a server-sent events response"""
+    event, data, event_id = "message", [], None
+    for line in response.iter_lines(decode_unicode=True):
+        if line is None:
+            continue
+        if not line:
+            if data:
+                yield event, "\n".join(data), event_id
+            event, data, event_id = "message", [], None
+            continue
+        if line.startswith(":"):  # keepalive comment
+            yield "keepalive", None, None
+            continue
+        field, _, value = line.partition(":")
+        value = value[1:] if value.startswith(" ") else value
+        if field == "event":
+            event = value
+        elif field == "data":
+            data.append(value)
+        elif field == "id":
+            event_id = value
+
+
+def stream_task_result(task_id, on_delta=None, timeout=1200):
+    """Follow a task over GET /tasks/{id}/stream until it finishes
+    
+    Args:
+        task_id: ID of the task
+        on_delta: Optional callback receiving generated text as it arrives
+        timeout: Maximum number of seconds to wait for the task
+    
+    Returns:
+        dict: Finished task or None if error or timeout
+    """
+    deadline = time.monotonic() + timeout
+    try:
+        session = get_session()
+        # Read timeout only has to outlast the server keepalive interval
+        with session.get(f"{API_URL}/tasks/{task_id}/stream", stream=True, timeout=(5, 60)) as response:
+            if response.status_code != 200:
+                logger.error(f"API Error: {response.status_code}")
+                return None
+            response.encoding = "utf-8"
+            for event, data, _ in _iter_sse(response):
+                if time.monotonic() > deadline:
+                    break
+                if data is None:
+                    continue
+                payload = json.loads(data)
+                if event == "token" and on_delta is not None:
+                    on_delta(payload["delta"])
+                elif event == "done":
+                    return payload
+                elif event == "error":
+                    logger.error(f"Stream error: {payload.get('detail')}")
+                    return None
+    except Exception as e:
+        logger.error(f"Connection error: {str(e)}")
+    return None
+
+
+def follow_session_events(session_id, on_event, stop_event=None):
+    """Follow GET /sessions/{id}/events, reconnecting where the stream left off
+    
+    Args:
+        session_id: ID of the session
+        on_event: Callback receiving (event, payload) for token and task events
+        stop_event: Optional threading.Event that ends following
+    """
+    last_event_id = None
+    failures = 0
+    while stop_event is None or not stop_event.is_set():
+        headers = {"Last-Event-ID": last_event_id} if last_event_id else {}
+        try:
+            session = get_session()
+            with session.get(
+                f"{API_URL}/sessions/{session_id}/events",
+                headers=headers,
+                stream=True,
+                timeout=(5, 60),
+            ) as response:
+                if response.status_code != 200:
+                    raise RuntimeError(f"API Error: {response.status_code}")
+                failures = 0
+                response.encoding = "utf-8"
+                for event, data, event_id in _iter_sse(response):
+                    if stop_event is not None and stop_event.is_set():
+                        return
+                    if data is None:
+                        continue
+                    if event == "error":
+                        raise RuntimeError(json.loads(data).get("detail"))
+                    if event != "ready":
+                        on_event(event, json.loads(data))
+                    if event_id:
+                        last_event_id = event_id
+        except Exception as e:
+            logger.error(f"Session events error: {str(e)}")
+            failures += 1
+        time.sleep(min(30, failures))
+
+
 def poll_task_result(task_id, max_poll=30):
-    """Poll for task result until completion
+    """Wait for task result until completion
     
     Args:
         task_id: ID of the task
-        max_poll: Maximum number of polls (default 30, 1 poll per second)
+        max_poll: Maximum number of seconds to wait (default 30)
     
     Returns:
         dict: Completed task or partial result if timeout
     """
-    poll = 0
-    while poll < max_poll:
-        task = get_task_status(task_id)
-        if task and task["status"] == "completed":
-            return task
-        else:
-            time.sleep(1)
-        poll += 1
+    task = stream_task_result(task_id, timeout=max_poll)
+    if task and task["status"] == "completed":
+        return task
     return {"task_id": task_id}
 
 
-def create_new_conversation(session_id, agent_id, system_prompt, conv_idx = 0):
+def create_new_conversation(session_id, agent_id, system_prompt, conv_idx = 0, messages=None):
     """Create a new conversation
     
     Args:
         session_id: ID of the session
         agent_id: ID of the agent
         system_prompt: System prompt for the conversation
+        messages: Optional messages written right after the system prompt
     
     Returns:
         str: Conversation ID or None if error
@@ -190,8 +345,9 @@ def create_new_conversation(session_id, agent_id, system_prompt, conv_idx = 0):
             )
             return None
             
-        response_message = add_message_to_conversation(
-            conversation_id, "system", system_prompt
+        response_message = add_messages_to_conversation(
+            conversation_id,
+            [{"role": "system", "content": system_prompt}] + list(messages or []),
         )
         if response_message is not None:
             return conversation_id
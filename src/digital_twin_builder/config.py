@@ -24,6 +24,19 @@ DT_AGENT_INDEX = int(os.getenv("DT_AGENT_INDEX", "2"))
 UI_AGENT_MODEL = os.getenv("UI_AGENT_MODEL", "")
 DB_AGENT_MODEL = os.getenv("DB_AGENT_MODEL", "")
 DT_AGENT_MODEL = os.getenv("DT_AGENT_MODEL", "")
+# Memory budget of the per-agent conversation context cache
+AGENT_CONTEXT_CACHE_MB = float(os.getenv("AGENT_CONTEXT_CACHE_MB", "64"))
+# Per-conversation KV cache budgets: model device, then CPU offload (0 disables)
+AGENT_KV_CACHE_MB = float(os.getenv("AGENT_KV_CACHE_MB", "2048"))
+AGENT_KV_CACHE_CPU_MB = float(os.getenv("AGENT_KV_CACHE_CPU_MB", "4096"))
+# Tasks an agent leases and generates as one batch (1 disables batching)
+AGENT_MAX_BATCH_SIZE = int(os.getenv("AGENT_MAX_BATCH_SIZE", "1"))
+# Model loading on the first task: "" (checkpoint precision), "int8" or "4bit"
+AGENT_MODEL_QUANTIZATION = os.getenv("AGENT_MODEL_QUANTIZATION", "")
+# Only load safetensors weights (memory-mapped); checkpoints with only .bin weights then fail
+AGENT_MODEL_MMAP = os.getenv("AGENT_MODEL_MMAP", "False").lower() == "true"
+# Run a short generation after loading and log its time
+AGENT_MODEL_WARMUP = os.getenv("AGENT_MODEL_WARMUP", "True").lower() == "true"
 
 # Database Configuration
 POSTGRES_USER = os.getenv("POSTGRES_USER", "postgres")
@@ -31,6 +44,11 @@ POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD", "admin")
 POSTGRES_DB = os.getenv("POSTGRES_DB", "llm_agents")
 POSTGRES_HOST = os.getenv("POSTGRES_HOST", "localhost")
 POSTGRES_PORT = os.getenv("POSTGRES_PORT", "5432")
+DB_MIN_CONNECTIONS = int(os.getenv("DB_MIN_CONNECTIONS", "1"))
+DB_MAX_CONNECTIONS = int(os.getenv("DB_MAX_CONNECTIONS", "10"))
+DB_PARTITION_DAYS_AHEAD = int(os.getenv("DB_PARTITION_DAYS_AHEAD", "7"))
+DB_TASKS_RETENTION_DAYS = int(os.getenv("DB_TASKS_RETENTION_DAYS", "30"))
+DB_MESSAGES_RETENTION_DAYS = int(os.getenv("DB_MESSAGES_RETENTION_DAYS", "90"))
 
 # Grafana Configuration
 GRAFANA_ADMIN_PASSWORD = os.getenv("GRAFANA_ADMIN_PASSWORD", "admin")
@@ -51,11 +69,23 @@ __all__ = [
     "UI_AGENT_MODEL",
     "DB_AGENT_MODEL",
     "DT_AGENT_MODEL",
+    "AGENT_CONTEXT_CACHE_MB",
+    "AGENT_KV_CACHE_MB",
+    "AGENT_KV_CACHE_CPU_MB",
+    "AGENT_MAX_BATCH_SIZE",
+    "AGENT_MODEL_QUANTIZATION",
+    "AGENT_MODEL_MMAP",
+    "AGENT_MODEL_WARMUP",
     "POSTGRES_USER",
     "POSTGRES_PASSWORD",
     "POSTGRES_DB",
     "POSTGRES_HOST",
     "POSTGRES_PORT",
+    "DB_MIN_CONNECTIONS",
+    "DB_MAX_CONNECTIONS",
+    "DB_PARTITION_DAYS_AHEAD",
+    "DB_TASKS_RETENTION_DAYS",
+    "DB_MESSAGES_RETENTION_DAYS",
     "GRAFANA_ADMIN_PASSWORD",
     "GRAFANA_ADMIN_USER",
     "LOG_LEVEL",
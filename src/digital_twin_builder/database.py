@@ -1,19 +1,23 @@
 # database.py
-import os
+"""
+Async data-access layer (repository) shared by the API server.
+
+Holds the single PostgreSQL schema, one asyncpg pool sized from config and the
+catalog of hot statements. Every pooled connection prepares the catalog once in
+the pool ``init`` hook, so requests skip parse/plan and just bind + execute.
+Agents and the Streamlit app reach the database only through the HTTP API.
+"""
+import re
 import json
+import time
+import uuid
 import logging
-from datetime import datetime, timezone
-from typing import Dict, List, Optional, Any, Iterator
-from contextlib import contextmanager
-from dataclasses import dataclass
-import asyncio
+from contextlib import asynccontextmanager, contextmanager
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, List, Optional, Any, AsyncIterator, Callable, Tuple
 
 import asyncpg
-from asyncpg import Connection, Pool
-import psycopg2
-from psycopg2.extras import RealDictCursor, Json
-from psycopg2.pool import ThreadedConnectionPool
-import psycopg2.extensions
+from asyncpg.prepared_stmt import PreparedStatement
 
 from config import (
     POSTGRES_HOST,
@@ -21,528 +25,1145 @@ from config import (
     POSTGRES_DB,
     POSTGRES_USER,
     POSTGRES_PASSWORD,
+    DB_MIN_CONNECTIONS,
+    DB_MAX_CONNECTIONS,
+    DB_PARTITION_DAYS_AHEAD,
+    DB_TASKS_RETENTION_DAYS,
+    DB_MESSAGES_RETENTION_DAYS,
 )
+from metrics import STATEMENT_DURATION, POOL_ACQUIRE_DURATION, render_gauge
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Database configuration from environment
+# Database configuration
 DB_CONFIG = {
     "host": POSTGRES_HOST,
-    "port": POSTGRES_PORT,
+    "port": int(POSTGRES_PORT),
     "database": POSTGRES_DB,
     "user": POSTGRES_USER,
     "password": POSTGRES_PASSWORD,
-    "min_connections": int(os.getenv("DB_MIN_CONNECTIONS", "1")),
-    "max_connections": int(os.getenv("DB_MAX_CONNECTIONS", "10")),
 }
 
-# Synchronous connection pool for Streamlit
-_sync_pool = None
-
-# Async connection pool for FastAPI
-_async_pool = None
-
-def get_sync_connection_string():
-    """Get synchronous PostgreSQL connection string"""
-    return f"postgresql://{DB_CONFIG['user']}:{DB_CONFIG['password']}@{DB_CONFIG['host']}:{DB_CONFIG['port']}/{DB_CONFIG['database']}"
-
-def get_async_connection_string():
-    """Get async PostgreSQL connection string"""
-    return f"postgresql://{DB_CONFIG['user']}:{DB_CONFIG['password']}@{DB_CONFIG['host']}:{DB_CONFIG['port']}/{DB_CONFIG['database']}"
-
-# Data models
-@dataclass
-class Task:
-    id: str
-    agent_id: int
-    prompt: str
-    params: Dict[str, Any]
-    status: str  # pending, processing, completed, failed, cancelled
-    result: Optional[str]
-    error: Optional[str]
-    created_at: datetime
-    started_at: Optional[datetime]
-    completed_at: Optional[datetime]
-    priority: int
-    metadata: Dict[str, Any]
-    queue_position: Optional[int] = None
-
-@dataclass
-class AgentStatus:
-    agent_id: int
-    status: str  # idle, busy, offline
-    last_heartbeat: datetime
-    current_task_id: Optional[str]
-    capabilities: List[str]
-    performance_metrics: Optional[Dict[str, Any]]
-    last_error: Optional[str]
+TASK_NOTIFY_CHANNEL = "task_created"
+# Payload is the task id; sent on streamed output and on completion
+TASK_PROGRESS_CHANNEL = "task_progress"
+# Payload is the session id; same events for all tasks of a session's conversations
+SESSION_EVENTS_CHANNEL = "session_events"
+# Columns a client may request from GET /conversations/{id}/messages
+MESSAGE_FIELDS = ("id", "role", "content", "content_type", "metadata", "created_at", "tokens")
+PARTITIONED_TABLES = ("tasks", "messages")
+# Finished tasks returned per session_finished_tasks query; a full page means there may be more
+SESSION_EVENTS_PAGE_SIZE = 100
+
+# The one connection pool of the process
+_pool: Optional[asyncpg.Pool] = None
+
 
 class DatabaseError(Exception):
     """Custom database exception"""
     pass
 
-# Synchronous functions for Streamlit
-def init_sync_pool():
-    """Initialize synchronous connection pool"""
-    global _sync_pool
-    try:
-        _sync_pool = ThreadedConnectionPool(
-            minconn=DB_CONFIG['min_connections'],
-            maxconn=DB_CONFIG['max_connections'],
-            host=DB_CONFIG['host'],
-            port=DB_CONFIG['port'],
-            database=DB_CONFIG['database'],
-            user=DB_CONFIG['user'],
-            password=DB_CONFIG['password'],
-            cursor_factory=RealDictCursor
+
+# Database schema
+SCHEMA_SQL = """
+-- Sessions of the control panel
+CREATE TABLE IF NOT EXISTS sessions (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    user_id VARCHAR(255) NOT NULL,
+    title VARCHAR(500),
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Conversations with agents, conversations[agent_id][conv_idx]
+CREATE TABLE IF NOT EXISTS conversations (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    session_id UUID REFERENCES sessions(id) ON DELETE CASCADE,
+    agent_id INTEGER,
+    conv_idx INTEGER DEFAULT 0,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    metadata JSONB DEFAULT '{}'::jsonb
+);
+
+-- Messages, partitioned by date (daily partitions, see ensure_partitions)
+CREATE TABLE IF NOT EXISTS messages (
+    id UUID NOT NULL DEFAULT gen_random_uuid(),
+    conversation_id UUID REFERENCES conversations(id) ON DELETE CASCADE,
+    role VARCHAR(50) NOT NULL,  -- 'user', 'assistant', 'system'
+    content TEXT NOT NULL,
+    content_type VARCHAR(50) DEFAULT 'text',  -- 'text', 'image', 'data'
+    metadata JSONB DEFAULT '{}'::jsonb,
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    tokens INTEGER DEFAULT 0,
+    parent_message_id UUID,
+    -- The partition key has to be part of the primary key
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+-- Tasks, partitioned by date like messages
+CREATE TABLE IF NOT EXISTS tasks (
+    id VARCHAR(36) NOT NULL,
+    agent_id INTEGER NOT NULL,
+    conversation_id UUID,
+    params JSONB NOT NULL DEFAULT '{}'::jsonb,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending'
+        CHECK (status IN ('pending', 'processing', 'completed', 'failed', 'cancelled')),
+    result TEXT,
+    -- Assistant message holding the result, instead of a copy in result
+    result_message_id UUID,
+    error TEXT,
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMP WITH TIME ZONE,
+    completed_at TIMESTAMP WITH TIME ZONE,
+    -- Transaction that finished the task, the session events cursor
+    completed_xid xid8,
+    priority INTEGER NOT NULL DEFAULT 0,
+    metadata JSONB NOT NULL DEFAULT '{}'::jsonb,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+-- Added after the first deployments
+ALTER TABLE tasks ADD COLUMN IF NOT EXISTS result_message_id UUID;
+ALTER TABLE tasks ADD COLUMN IF NOT EXISTS completed_xid xid8;
+
+-- Output streamed by agents while a task is processing, removed on completion
+CREATE TABLE IF NOT EXISTS task_progress (
+    task_id VARCHAR(36) PRIMARY KEY,
+    -- created_at of the task, so joins to tasks are pruned to one partition
+    task_created_at TIMESTAMP WITH TIME ZONE,
+    session_id UUID,
+    content TEXT NOT NULL DEFAULT '',
+    updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+ALTER TABLE task_progress ADD COLUMN IF NOT EXISTS session_id UUID;
+ALTER TABLE task_progress ADD COLUMN IF NOT EXISTS task_created_at TIMESTAMP WITH TIME ZONE;
+
+-- Agent status table
+-- (no foreign key to tasks: id alone is not unique across partitions)
+CREATE TABLE IF NOT EXISTS agent_status (
+    agent_id INTEGER PRIMARY KEY,
+    status VARCHAR(20) NOT NULL DEFAULT 'idle',
+    last_heartbeat TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    current_task_id VARCHAR(36),
+    capabilities JSONB NOT NULL DEFAULT '[]'::jsonb
+);
+
+-- Indexes for performance
+-- Keyset pagination of a conversation, (created_at, id) is the cursor
+DROP INDEX IF EXISTS idx_messages_conversation_created;
+CREATE INDEX IF NOT EXISTS idx_messages_conversation_keyset ON messages(conversation_id, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_conversations_session ON conversations(session_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_sessions_user_updated ON sessions(user_id, updated_at DESC);
+-- Lookups by id also carry created_at (derived from the id, see task_created_at),
+-- so they are pruned to one partition and use its primary key (id, created_at)
+DROP INDEX IF EXISTS idx_tasks_id;
+CREATE INDEX IF NOT EXISTS idx_tasks_agent_status ON tasks(agent_id, status);
+CREATE INDEX IF NOT EXISTS idx_tasks_created_at ON tasks(created_at DESC);
+DROP INDEX IF EXISTS idx_tasks_conversation_completed;
+CREATE INDEX IF NOT EXISTS idx_tasks_conversation_completed_xid ON tasks(conversation_id, completed_xid, id);
+CREATE INDEX IF NOT EXISTS idx_tasks_pending_queue ON tasks(agent_id, priority DESC, created_at)
+    WHERE status = 'pending';
+
+-- Incrementally maintained per-agent/per-status task counters
+CREATE TABLE IF NOT EXISTS task_queue_stats (
+    agent_id INTEGER NOT NULL,
+    status VARCHAR(20) NOT NULL,
+    task_count BIGINT NOT NULL DEFAULT 0,
+    total_processing_seconds DOUBLE PRECISION NOT NULL DEFAULT 0,
+    PRIMARY KEY (agent_id, status)
+);
+
+CREATE OR REPLACE FUNCTION update_task_queue_stats()
+RETURNS TRIGGER AS $$
+BEGIN
+    -- Statement-level: one upsert per (agent_id, status) group, also for COPY
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO task_queue_stats AS s (agent_id, status, task_count, total_processing_seconds)
+        SELECT agent_id, status, -COUNT(*),
+               -COALESCE(SUM(EXTRACT(EPOCH FROM (completed_at - started_at))), 0)
+        FROM old_rows
+        GROUP BY agent_id, status
+        ORDER BY agent_id, status
+        ON CONFLICT (agent_id, status) DO UPDATE
+        SET task_count = s.task_count + EXCLUDED.task_count,
+            total_processing_seconds = s.total_processing_seconds + EXCLUDED.total_processing_seconds;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO task_queue_stats AS s (agent_id, status, task_count, total_processing_seconds)
+        SELECT agent_id, status, COUNT(*),
+               COALESCE(SUM(EXTRACT(EPOCH FROM (completed_at - started_at))), 0)
+        FROM new_rows
+        GROUP BY agent_id, status
+        ORDER BY agent_id, status
+        ON CONFLICT (agent_id, status) DO UPDATE
+        SET task_count = s.task_count + EXCLUDED.task_count,
+            total_processing_seconds = s.total_processing_seconds + EXCLUDED.total_processing_seconds;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS tasks_stats_insert ON tasks;
+CREATE TRIGGER tasks_stats_insert
+    AFTER INSERT ON tasks
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION update_task_queue_stats();
+
+DROP TRIGGER IF EXISTS tasks_stats_update ON tasks;
+CREATE TRIGGER tasks_stats_update
+    AFTER UPDATE ON tasks
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION update_task_queue_stats();
+
+DROP TRIGGER IF EXISTS tasks_stats_delete ON tasks;
+CREATE TRIGGER tasks_stats_delete
+    AFTER DELETE ON tasks
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION update_task_queue_stats();
+
+-- Notify long-polling agents about new tasks
+CREATE OR REPLACE FUNCTION notify_task_created()
+RETURNS TRIGGER AS $$
+BEGIN
+    -- Statement-level: one notification per agent, also for COPY
+    PERFORM pg_notify('task_created', agent_id::text)
+    FROM (SELECT DISTINCT agent_id FROM new_rows) agents;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS tasks_notify_created ON tasks;
+CREATE TRIGGER tasks_notify_created
+    AFTER INSERT ON tasks
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION notify_task_created();
+
+-- Task monitoring view
+CREATE OR REPLACE VIEW task_monitor AS
+SELECT
+    t.id,
+    t.agent_id,
+    t.conversation_id,
+    t.status,
+    t.created_at,
+    t.started_at,
+    t.completed_at,
+    a.status AS agent_status,
+    EXTRACT(EPOCH FROM (t.completed_at - t.started_at)) AS processing_time_seconds
+FROM tasks t
+LEFT JOIN agent_status a ON t.agent_id = a.agent_id;
+"""
+
+RECONCILE_QUEUE_STATS_SQL = """
+-- Rebuild counters from scratch; blocks task writes for the duration of one scan
+LOCK TABLE tasks IN SHARE ROW EXCLUSIVE MODE;
+DELETE FROM task_queue_stats;
+INSERT INTO task_queue_stats (agent_id, status, task_count, total_processing_seconds)
+SELECT agent_id, status, COUNT(*),
+       COALESCE(SUM(EXTRACT(EPOCH FROM (completed_at - started_at))), 0)
+FROM tasks
+GROUP BY agent_id, status;
+"""
+
+# Hot statements, prepared once per pooled connection
+STATEMENTS = {
+    "create_session": """
+        INSERT INTO sessions (id, user_id, title)
+        VALUES ($1, $2, $3)
+    """,
+    "list_sessions": """
+        SELECT id, title, user_id
+        FROM sessions
+        WHERE user_id = $1
+        ORDER BY updated_at DESC
+        LIMIT $2 OFFSET $3
+    """,
+    "get_session": """
+        SELECT id, title, user_id
+        FROM sessions
+        WHERE id = $1
+    """,
+    "session_conversations": """
+        SELECT id, session_id, agent_id, conv_idx, created_at, metadata
+        FROM conversations
+        WHERE session_id = $1
+        ORDER BY created_at ASC
+    """,
+    "create_conversation": """
+        INSERT INTO conversations (id, session_id, agent_id, conv_idx, metadata)
+        VALUES ($1, $2, $3, $4, $5)
+    """,
+    "list_conversations": """
+        SELECT id, created_at, updated_at, conv_idx, metadata
+        FROM conversations
+        WHERE agent_id = $1
+        ORDER BY updated_at DESC
+        LIMIT $2 OFFSET $3
+    """,
+    "get_conversation": """
+        SELECT id, created_at, updated_at, metadata
+        FROM conversations
+        WHERE id = $1
+    """,
+    "conversation_messages": """
+        SELECT id, role, content, content_type,
+               metadata, created_at, tokens
+        FROM messages
+        WHERE conversation_id = $1
+        ORDER BY created_at ASC
+    """,
+    "last_message": """
+        SELECT id, role, content, content_type,
+               metadata, created_at, tokens
+        FROM messages
+        WHERE conversation_id = $1
+        ORDER BY created_at DESC
+        LIMIT 1
+    """,
+    # Insert and conversation touch in one statement: no row is inserted
+    # when the conversation does not exist
+    "insert_message": """
+        WITH conversation AS (
+            UPDATE conversations
+            SET updated_at = CURRENT_TIMESTAMP
+            WHERE id = $2
+            RETURNING id
         )
-        logger.info("Synchronous PostgreSQL connection pool initialized")
-        return _sync_pool
-    except Exception as e:
-        logger.error(f"Failed to initialize sync pool: {str(e)}")
-        raise DatabaseError(f"Database connection failed: {str(e)}")
+        INSERT INTO messages
+        (id, conversation_id, role, content, content_type, metadata)
+        SELECT $1, conversation.id, $3, $4, $5, $6
+        FROM conversation
+        RETURNING id
+    """,
+    # Batch variant; rows of one statement share CURRENT_TIMESTAMP, so the
+    # position is added in microseconds to keep created_at ordering stable
+    "insert_messages": """
+        WITH conversation AS (
+            UPDATE conversations
+            SET updated_at = CURRENT_TIMESTAMP
+            WHERE id = $1
+            RETURNING id
+        )
+        INSERT INTO messages
+        (id, conversation_id, role, content, content_type, metadata, created_at)
+        SELECT m.id, conversation.id, m.role, m.content, m.content_type, m.metadata::jsonb,
+               CURRENT_TIMESTAMP + m.position * INTERVAL '1 microsecond'
+        FROM conversation,
+             unnest($2::uuid[], $3::text[], $4::text[], $5::text[], $6::text[])
+                 WITH ORDINALITY AS m(id, role, content, content_type, metadata, position)
+        ORDER BY m.position
+        RETURNING id
+    """,
+    "insert_task": """
+        INSERT INTO tasks (id, agent_id, conversation_id, params, status, priority, created_at)
+        VALUES ($1, $2, $3, $4, 'pending', $5, $6)
+    """,
+    "pending_count": """
+        SELECT task_count FROM task_queue_stats
+        WHERE agent_id = $1 AND status = 'pending'
+    """,
+    "pending_counts": """
+        SELECT agent_id, task_count FROM task_queue_stats
+        WHERE agent_id = ANY($1::int[]) AND status = 'pending'
+    """,
+    # Lease + heartbeat in a single statement, i.e. one transaction and one round trip
+    "claim_tasks": """
+        WITH claimed AS (
+            UPDATE tasks
+            SET status = 'processing', started_at = NOW()
+            WHERE (id, created_at) IN (
+                SELECT id, created_at FROM tasks
+                WHERE agent_id = $1 AND status = 'pending'
+                ORDER BY priority DESC, created_at ASC
+                LIMIT $2
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, conversation_id, params, priority, created_at
+        ), heartbeat AS (
+            INSERT INTO agent_status (agent_id, last_heartbeat, status, current_task_id)
+            SELECT $1, NOW(),
+                   CASE WHEN EXISTS (SELECT 1 FROM claimed) THEN 'busy' ELSE 'active' END,
+                   (SELECT id FROM claimed ORDER BY priority DESC, created_at ASC LIMIT 1)
+            ON CONFLICT (agent_id) DO UPDATE
+            SET last_heartbeat = NOW(),
+                status = EXCLUDED.status,
+                current_task_id = EXCLUDED.current_task_id
+        )
+        SELECT id, conversation_id, params FROM claimed
+        ORDER BY priority DESC, created_at ASC
+    """,
+    # Result and agent idle state in one statement
+    "complete_task": """
+        WITH completed AS (
+            UPDATE tasks
+            SET status = $1,
+                result = $2,
+                error = $3,
+                completed_at = NOW(),
+                completed_xid = pg_current_xact_id()
+            WHERE id = $4
+              AND created_at BETWEEN COALESCE($5::timestamptz, '-infinity') AND COALESCE($5::timestamptz, 'infinity')
+            RETURNING agent_id, conversation_id
+        ), idle AS (
+            UPDATE agent_status
+            SET status = 'idle', current_task_id = NULL
+            WHERE agent_id IN (SELECT agent_id FROM completed)
+        ), progress AS (
+            DELETE FROM task_progress WHERE task_id = $4
+        )
+        SELECT agent_id,
+               pg_notify('task_progress', $4),
+               pg_notify('session_events', COALESCE(
+                   (SELECT session_id::text FROM conversations WHERE id = completed.conversation_id), ''
+               ))
+        FROM completed
+    """,
+    # Assistant message, task result and agent idle state in one statement.
+    # The task references the message; the result text is only stored on the
+    # task when its conversation no longer exists.
+    "complete_task_with_message": """
+        WITH task AS (
+            -- Only a processing task, locked: a retried or late completion
+            -- waits for the first one, then finds it completed and adds nothing
+            SELECT conversation_id FROM tasks
+            WHERE id = $1 AND status = 'processing' AND ($6::int IS NULL OR agent_id = $6)
+              AND created_at BETWEEN COALESCE($7::timestamptz, '-infinity') AND COALESCE($7::timestamptz, 'infinity')
+            FOR UPDATE
+        ), conversation AS (
+            UPDATE conversations
+            SET updated_at = CURRENT_TIMESTAMP
+            WHERE id = (SELECT conversation_id FROM task)
+            RETURNING id, session_id
+        ), message AS (
+            INSERT INTO messages
+            (id, conversation_id, role, content, content_type, metadata)
+            SELECT $2, conversation.id, 'assistant', $3, $4, $5
+            FROM conversation
+            RETURNING id
+        ), completed AS (
+            UPDATE tasks
+            SET status = 'completed',
+                result_message_id = (SELECT id FROM message),
+                result = CASE WHEN EXISTS (SELECT 1 FROM message) THEN NULL ELSE $3 END,
+                error = NULL,
+                completed_at = NOW(),
+                completed_xid = pg_current_xact_id()
+            WHERE id = $1 AND status = 'processing' AND ($6::int IS NULL OR agent_id = $6)
+              AND created_at BETWEEN COALESCE($7::timestamptz, '-infinity') AND COALESCE($7::timestamptz, 'infinity')
+            RETURNING agent_id
+        ), idle AS (
+            UPDATE agent_status
+            SET status = 'idle', current_task_id = NULL
+            WHERE agent_id IN (SELECT agent_id FROM completed)
+        ), progress AS (
+            DELETE FROM task_progress WHERE task_id = $1 AND EXISTS (SELECT 1 FROM completed)
+        )
+        SELECT (SELECT id FROM message) AS message_id,
+               EXISTS (SELECT 1 FROM completed) AS completed,
+               pg_notify('task_progress', $1),
+               pg_notify('session_events', COALESCE((SELECT session_id::text FROM conversation), ''))
+    """,
+    # Appends only while the task is processing, late chunks are dropped
+    "append_progress": """
+        INSERT INTO task_progress AS p (task_id, task_created_at, session_id, content)
+        SELECT $1, t.created_at, c.session_id, $2
+        FROM tasks t
+        LEFT JOIN conversations c ON c.id = t.conversation_id
+        WHERE t.id = $1 AND t.status = 'processing'
+          AND t.created_at BETWEEN COALESCE($3::timestamptz, '-infinity') AND COALESCE($3::timestamptz, 'infinity')
+        LIMIT 1
+        ON CONFLICT (task_id) DO UPDATE
+        SET content = p.content || EXCLUDED.content,
+            updated_at = CURRENT_TIMESTAMP
+        RETURNING length(p.content) AS length,
+                  pg_notify('task_progress', $1),
+                  pg_notify('session_events', COALESCE(p.session_id::text, ''))
+    """,
+    "task_progress": """
+        SELECT t.status, substr(COALESCE(p.content, ''), $2 + 1) AS delta
+        FROM tasks t
+        LEFT JOIN task_progress p ON p.task_id = t.id
+        WHERE t.id = $1
+          AND t.created_at BETWEEN COALESCE($3::timestamptz, '-infinity') AND COALESCE($3::timestamptz, 'infinity')
+    """,
+    # Tasks of a session finished after a (completed_xid, id) cursor, in cursor
+    # order. Only transactions older than every running one are read: a
+    # completion that commits later always sorts after the returned rows.
+    "session_finished_tasks": """
+        SELECT t.id, t.agent_id, c.conv_idx, t.conversation_id, t.status,
+               COALESCE(t.result, m.content) AS result, t.result_message_id, t.error,
+               t.created_at, t.started_at, t.completed_at,
+               t.completed_xid::text AS completed_xid
+        FROM conversations c
+        JOIN tasks t ON t.conversation_id = c.id
+        LEFT JOIN messages m ON m.id = t.result_message_id AND m.conversation_id = t.conversation_id
+        WHERE c.session_id = $1
+          AND (t.completed_xid, t.id) > ($2::text::xid8, $3::text)
+          AND t.completed_xid < pg_snapshot_xmin(pg_current_snapshot())
+          AND t.status IN ('completed', 'failed', 'cancelled')
+        ORDER BY t.completed_xid, t.id
+        LIMIT $4
+    """,
+    # Cursor before every completion not yet visible to a new reader
+    "session_events_start": """
+        SELECT pg_snapshot_xmin(pg_current_snapshot())::text
+    """,
+    # Output streamed so far by the processing tasks of a session
+    "session_progress": """
+        SELECT p.task_id, t.agent_id, c.conv_idx, p.content
+        FROM task_progress p
+        JOIN tasks t ON t.id = p.task_id AND t.created_at = p.task_created_at
+        LEFT JOIN conversations c ON c.id = t.conversation_id
+        WHERE p.session_id = $1
+    """,
+    "get_task": """
+        SELECT t.id, t.agent_id, c.conv_idx, t.conversation_id, t.status,
+               COALESCE(t.result, m.content) AS result, t.result_message_id, t.error,
+               t.created_at, t.started_at, t.completed_at
+        FROM tasks t
+        LEFT JOIN conversations c ON c.id = t.conversation_id
+        LEFT JOIN messages m ON m.id = t.result_message_id AND m.conversation_id = t.conversation_id
+        WHERE t.id = $1
+          AND t.created_at BETWEEN COALESCE($2::timestamptz, '-infinity') AND COALESCE($2::timestamptz, 'infinity')
+    """,
+    "get_agent_status": """
+        SELECT agent_id, status, last_heartbeat, current_task_id
+        FROM agent_status WHERE agent_id = $1
+    """,
+    "active_task": """
+        SELECT id, started_at FROM tasks
+        WHERE agent_id = $1 AND status = 'processing'
+        LIMIT 1
+    """,
+    # Task counters come from the trigger-maintained task_queue_stats table
+    "system_metrics": """
+        SELECT
+            COALESCE(SUM(s.task_count), 0) as total_tasks,
+            COALESCE(SUM(s.task_count) FILTER (WHERE s.status = 'pending'), 0) as pending_tasks,
+            COALESCE(SUM(s.task_count) FILTER (WHERE s.status = 'processing'), 0) as processing_tasks,
+            COALESCE(SUM(s.task_count) FILTER (WHERE s.status = 'completed'), 0) as completed_tasks,
+            a.idle_agents,
+            a.busy_agents,
+            SUM(s.total_processing_seconds) FILTER (WHERE s.status = 'completed')
+                / NULLIF(SUM(s.task_count) FILTER (WHERE s.status = 'completed'), 0) as avg_processing_time
+        FROM (
+            SELECT
+                COUNT(*) FILTER (WHERE status = 'idle') as idle_agents,
+                COUNT(*) FILTER (WHERE status = 'busy') as busy_agents
+            FROM agent_status
+        ) a
+        LEFT JOIN task_queue_stats s ON TRUE
+        GROUP BY a.idle_agents, a.busy_agents
+    """,
+}
+
+
+class InstrumentedStatement:
+    """Prepared statement that records its execution time per statement name"""
+
+    def __init__(self, name: str, statement: PreparedStatement):
+        self.name = name
+        self.statement = statement
+
+    async def fetch(self, *args):
+        with observe(self.name):
+            return await self.statement.fetch(*args)
+
+    async def fetchrow(self, *args):
+        with observe(self.name):
+            return await self.statement.fetchrow(*args)
+
+    async def fetchval(self, *args):
+        with observe(self.name):
+            return await self.statement.fetchval(*args)
+
+    async def executemany(self, args):
+        with observe(self.name):
+            return await self.statement.executemany(args)
+
+
+class RepositoryConnection(asyncpg.Connection):
+    """Pooled connection carrying the statements prepared for it in the init hook"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.statements: Dict[str, InstrumentedStatement] = {}
+
 
 @contextmanager
-def get_sync_connection():
-    """Get synchronous database connection from pool"""
-    conn = None
+def observe(name: str):
+    """Record the duration of an ad-hoc statement under the given name"""
+    start = time.perf_counter()
     try:
-        if _sync_pool is None:
-            init_sync_pool()
-        
-        conn = _sync_pool.getconn()
-        yield conn
-        conn.commit()
-    except Exception as e:
-        if conn:
-            conn.rollback()
-        logger.error(f"Database error: {str(e)}")
-        raise DatabaseError(str(e))
+        yield
     finally:
-        if conn:
-            _sync_pool.putconn(conn)
-
-def close_sync_pool():
-    """Close the synchronous connection pool"""
-    if _sync_pool:
-        _sync_pool.closeall()
-        logger.info("Synchronous PostgreSQL connection pool closed")
-
-# Async functions for FastAPI
-async def init_async_pool():
-    """Initialize async connection pool"""
-    global _async_pool
-    try:
-        _async_pool = await asyncpg.create_pool(
-            host=DB_CONFIG['host'],
-            port=DB_CONFIG['port'],
-            database=DB_CONFIG['database'],
-            user=DB_CONFIG['user'],
-            password=DB_CONFIG['password'],
-            min_size=DB_CONFIG['min_connections'],
-            max_size=DB_CONFIG['max_connections'],
-            command_timeout=60
+        STATEMENT_DURATION.observe(time.perf_counter() - start, name)
+
+
+async def _set_codecs(conn: asyncpg.Connection):
+    """Exchange JSONB as Python objects (binary format, so COPY works too)"""
+    await conn.set_type_codec(
+        "jsonb",
+        schema="pg_catalog",
+        encoder=lambda value: b"\x01" + json.dumps(value).encode("utf-8"),
+        decoder=lambda data: json.loads(data[1:].decode("utf-8")),
+        format="binary",
+    )
+
+async def _init_connection(conn: RepositoryConnection):
+    """Pool init hook: codecs and prepared statements, once per connection"""
+    await _set_codecs(conn)
+    for name, query in STATEMENTS.items():
+        conn.statements[name] = InstrumentedStatement(name, await conn.prepare(query))
+
+
+# Partitioning and retention
+def _partition_name(table: str, day: date) -> str:
+    return f"{table}_p{day:%Y%m%d}"
+
+def _partition_day(table: str, partition: str) -> Optional[date]:
+    """Parse the day back from a partition name, None for foreign partitions"""
+    match = re.fullmatch(rf"{table}_p(\d{{8}})", partition)
+    if not match:
+        return None
+    return datetime.strptime(match.group(1), "%Y%m%d").date()
+
+def _partition_days(days_ahead: int = DB_PARTITION_DAYS_AHEAD) -> List[date]:
+    today = datetime.now(timezone.utc).date()
+    return [today + timedelta(days=i) for i in range(days_ahead + 1)]
+
+def _partition_range(day: date) -> Tuple[datetime, datetime]:
+    """Bounds [start, end) of the daily (UTC) partition of day"""
+    start = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+    return start, start + timedelta(days=1)
+
+def _partition_bounds(day: date) -> str:
+    start, end = _partition_range(day)
+    return f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+
+def _partition_ddl(table: str, day: date) -> str:
+    """DDL for the daily (UTC) partition [day, day + 1) of a partitioned table"""
+    return f"CREATE TABLE IF NOT EXISTS {_partition_name(table, day)} PARTITION OF {table} {_partition_bounds(day)}"
+
+def _default_partition(table: str) -> str:
+    return f"{table}_default"
+
+async def _create_partition(conn: asyncpg.Connection, table: str, day: date):
+    """Create the partition of a day, moving its rows out of the default partition"""
+    partition = _partition_name(table, day)
+    if await conn.fetchval("SELECT to_regclass($1) IS NOT NULL", partition):
+        return
+    default = _default_partition(table)
+    start, end = _partition_range(day)
+    async with conn.transaction():
+        # Parent before partition, the order of every query routed through the
+        # parent; creating the partition needs the parent exclusively anyway
+        await conn.execute(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE")
+        await conn.execute(f"LOCK TABLE {default} IN ACCESS EXCLUSIVE MODE")
+        stray = await conn.fetchval(
+            f"SELECT EXISTS (SELECT 1 FROM {default} WHERE created_at >= $1 AND created_at < $2)", start, end
         )
-        logger.info("Async PostgreSQL connection pool initialized")
-        return _async_pool
-    except Exception as e:
-        logger.error(f"Failed to initialize async pool: {str(e)}")
-        raise DatabaseError(f"Async database connection failed: {str(e)}")
-
-async def get_async_connection() -> Connection:
-    """Get async database connection from pool"""
-    if _async_pool is None:
-        await init_async_pool()
-    
-    try:
-        return await _async_pool.acquire()
-    except Exception as e:
-        logger.error(f"Failed to acquire async connection: {str(e)}")
-        raise DatabaseError(str(e))
+        if not stray:
+            await conn.execute(_partition_ddl(table, day))
+            return
+        # Rows inserted while no partition covered the day: attaching a
+        # partition over them would fail, so they are moved into it first.
+        # Statement triggers of the parent do not fire, queue stats stay valid.
+        await conn.execute(f"CREATE TABLE {partition} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+        moved = await conn.execute(f"""
+            WITH moved AS (
+                DELETE FROM {default} WHERE created_at >= $1 AND created_at < $2 RETURNING *
+            )
+            INSERT INTO {partition} SELECT * FROM moved
+        """, start, end)
+        await conn.execute(f"ALTER TABLE {table} ATTACH PARTITION {partition} {_partition_bounds(day)}")
+    logger.info(f"Partition {partition} created, {moved.split()[-1]} rows moved from {default}")
 
-async def release_async_connection(conn):
-    """Release async connection back to pool"""
-    try:
-        await _async_pool.release(conn)
-    except Exception as e:
-        logger.warning(f"Error releasing connection: {str(e)}")
+async def _ensure_partitions(conn: asyncpg.Connection, days_ahead: int = DB_PARTITION_DAYS_AHEAD):
+    for table in PARTITIONED_TABLES:
+        relkind = await conn.fetchval(
+            "SELECT relkind FROM pg_class WHERE oid = to_regclass($1)", table
+        )
+        if relkind != "p":
+            logger.warning(f"Table {table} exists and is not partitioned, migrate it manually")
+            continue
+        # Inserts outside the pre-created days (e.g. maintenance was down) land
+        # here instead of failing, and get their own partitions on the next run
+        default = _default_partition(table)
+        await conn.execute(f"CREATE TABLE IF NOT EXISTS {default} PARTITION OF {table} DEFAULT")
+        stray_days = await conn.fetch(
+            f"SELECT DISTINCT (created_at AT TIME ZONE 'UTC')::date AS day FROM {default}"
+        )
+        days = set(_partition_days(days_ahead)) | {row["day"] for row in stray_days}
+        for day in sorted(days):
+            await _create_partition(conn, table, day)
 
-@contextmanager
-def sync_cursor():
-    """Context manager for synchronous cursor operations"""
-    with get_sync_connection() as conn:
-        cursor = conn.cursor()
+
+# Pool lifecycle
+async def init_schema(conn: asyncpg.Connection):
+    """Create the schema, upcoming partitions and rebuild queue counters"""
+    await conn.execute(SCHEMA_SQL)
+    await _ensure_partitions(conn)
+    async with conn.transaction():
+        await conn.execute(RECONCILE_QUEUE_STATS_SQL)
+    logger.info("PostgreSQL schema initialized")
+
+async def init_pool() -> asyncpg.Pool:
+    """Initialize the schema and the process-wide connection pool"""
+    global _pool
+    try:
+        # Statements are prepared against the schema, so it has to exist first
+        conn = await asyncpg.connect(**DB_CONFIG)
         try:
-            yield cursor
+            await init_schema(conn)
         finally:
-            cursor.close()
+            await conn.close()
 
-async def execute_query(query: str, params: tuple = None):
-    """Execute a query and return results"""
-    conn = await get_async_connection()
-    try:
-        if params:
-            return await conn.fetch(query, *params)
-        else:
-            return await conn.fetch(query)
-    finally:
-        await release_async_connection(conn)
-
-# Database schema initialization
-def init_database_schema():
-    """Initialize PostgreSQL database schema"""
-    schema_sql = """
-    -- Enable UUID extension
-    CREATE EXTENSION IF NOT EXISTS "uuid-ossp";
-    
-    -- Enable JSONB for better performance
-    CREATE EXTENSION IF NOT EXISTS "pg_trgm";
-    CREATE EXTENSION IF NOT EXISTS "btree_gin";
-    
-    -- Tasks table with partitioning by date (for large scale)
-    CREATE TABLE IF NOT EXISTS tasks (
-        id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
-        agent_id INTEGER NOT NULL,
-        prompt TEXT NOT NULL,
-        params JSONB NOT NULL DEFAULT '{}'::jsonb,
-        status VARCHAR(20) NOT NULL 
-            CHECK (status IN ('pending', 'processing', 'completed', 'failed', 'cancelled')),
-        result TEXT,
-        error TEXT,
-        created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-        started_at TIMESTAMP WITH TIME ZONE,
-        completed_at TIMESTAMP WITH TIME ZONE,
-        priority INTEGER NOT NULL DEFAULT 0,
-        metadata JSONB NOT NULL DEFAULT '{}'::jsonb,
-        
-        -- Indexes for performance
-        CONSTRAINT valid_status CHECK (status IN ('pending', 'processing', 'completed', 'failed', 'cancelled'))
-    );
-    
-    -- Agent status table
-    CREATE TABLE IF NOT EXISTS agent_status (
-        agent_id INTEGER PRIMARY KEY,
-        status VARCHAR(20) NOT NULL DEFAULT 'idle'
-            CHECK (status IN ('idle', 'busy', 'offline', 'maintenance')),
-        last_heartbeat TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-        current_task_id UUID REFERENCES tasks(id) ON DELETE SET NULL,
-        capabilities JSONB NOT NULL DEFAULT '[]'::jsonb,
-        performance_metrics JSONB NOT NULL DEFAULT '{}'::jsonb,
-        last_error TEXT,
-        created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-        updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-    );
-    
-    -- Task queue view (for monitoring)
-    CREATE OR REPLACE VIEW task_queue AS
-    SELECT 
-        agent_id,
-        COUNT(*) as pending_count,
-        AVG(priority) as avg_priority,
-        MIN(created_at) as oldest_task
-    FROM tasks
-    WHERE status = 'pending'
-    GROUP BY agent_id;
-    
-    -- Agent performance view
-    CREATE OR REPLACE VIEW agent_performance AS
-    SELECT 
-        a.agent_id,
-        a.status,
-        COUNT(t.id) as total_tasks,
-        SUM(CASE WHEN t.status = 'completed' THEN 1 ELSE 0 END) as completed_tasks,
-        AVG(EXTRACT(EPOCH FROM (t.completed_at - t.started_at))) as avg_process_time_seconds,
-        MAX(t.completed_at) as last_completed
-    FROM agent_status a
-    LEFT JOIN tasks t ON a.agent_id = t.agent_id
-    GROUP BY a.agent_id, a.status;
-    
-    -- Indexes for performance
-    CREATE INDEX IF NOT EXISTS idx_tasks_status_agent ON tasks(status, agent_id);
-    CREATE INDEX IF NOT EXISTS idx_tasks_priority_created ON tasks(priority DESC, created_at ASC);
-    CREATE INDEX IF NOT EXISTS idx_tasks_created_at ON tasks(created_at DESC);
-    CREATE INDEX IF NOT EXISTS idx_tasks_params_gin ON tasks USING gin(params);
-    CREATE INDEX IF NOT EXISTS idx_tasks_metadata_gin ON tasks USING gin(metadata);
-    
-    -- Triggers for updated_at
-    CREATE OR REPLACE FUNCTION update_updated_at_column()
-    RETURNS TRIGGER AS $$
-    BEGIN
-        NEW.updated_at = CURRENT_TIMESTAMP;
-        RETURN NEW;
-    END;
-    $$ language 'plpgsql';
-    
-    DROP TRIGGER IF EXISTS update_agent_status_updated_at ON agent_status;
-    CREATE TRIGGER update_agent_status_updated_at
-        BEFORE UPDATE ON agent_status
-        FOR EACH ROW
-        EXECUTE FUNCTION update_updated_at_column();
-    """
-    
-    with sync_cursor() as cursor:
-        cursor.execute(schema_sql)
-        logger.info("PostgreSQL schema initialized")
-
-# Table management functions
-async def create_task(task_data: Dict[str, Any]) -> str:
-    """Create a new task in PostgreSQL"""
-    query = """
-    INSERT INTO tasks 
-    (agent_id, prompt, params, status, priority, metadata)
-    VALUES ($1, $2, $3::jsonb, 'pending', $4, $5::jsonb)
-    RETURNING id
-    """
-    
-    conn = await get_async_connection()
-    try:
-        task_id = await conn.fetchval(
-            query,
-            task_data['agent_id'],
-            task_data['prompt'],
-            json.dumps(task_data.get('params', {})),
-            task_data.get('priority', 0),
-            json.dumps(task_data.get('metadata', {}))
+        _pool = await asyncpg.create_pool(
+            min_size=DB_MIN_CONNECTIONS,
+            max_size=DB_MAX_CONNECTIONS,
+            connection_class=RepositoryConnection,
+            init=_init_connection,
+            command_timeout=60,
+            **DB_CONFIG
         )
-        return str(task_id)
-    finally:
-        await release_async_connection(conn)
+        logger.info("PostgreSQL connection pool initialized")
+        return _pool
+    except Exception as e:
+        logger.error(f"Failed to initialize pool: {str(e)}")
+        raise DatabaseError(f"Database connection failed: {str(e)}")
 
-async def get_task(task_id: str) -> Optional[Dict]:
-    """Get task by ID"""
-    query = """
-    SELECT 
-        t.*,
-        (
-            SELECT COUNT(*) 
-            FROM tasks t2 
-            WHERE t2.agent_id = t.agent_id 
-            AND t2.status = 'pending'
-            AND (
-                t2.priority > t.priority 
-                OR (t2.priority = t.priority AND t2.created_at < t.created_at)
+async def close_pool():
+    """Close the connection pool"""
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+        logger.info("PostgreSQL connection pool closed")
+
+def is_initialized() -> bool:
+    return _pool is not None
+
+@asynccontextmanager
+async def connection() -> AsyncIterator[RepositoryConnection]:
+    """Acquire a pooled connection with prepared statements in ``conn.statements``"""
+    if _pool is None:
+        raise DatabaseError("Database pool is not initialized")
+    start = time.perf_counter()
+    async with _pool.acquire() as conn:
+        POOL_ACQUIRE_DURATION.observe(time.perf_counter() - start)
+        yield conn
+
+def render_metrics() -> str:
+    """Statement latency, pool wait and pool size in Prometheus text format"""
+    text = STATEMENT_DURATION.render() + POOL_ACQUIRE_DURATION.render()
+    if _pool is not None:
+        text += render_gauge("db_pool_size", "Open connections in the pool.", _pool.get_size())
+        text += render_gauge("db_pool_idle", "Idle connections in the pool.", _pool.get_idle_size())
+    return text
+
+async def listen(channel: str, callback: Callable) -> asyncpg.Connection:
+    """Open a dedicated (non-pooled) connection listening on a channel"""
+    conn = await asyncpg.connect(**DB_CONFIG)
+    await conn.add_listener(channel, callback)
+    return conn
+
+
+# Sessions and conversations
+async def create_session(user_id: str, title: Optional[str]) -> str:
+    session_id = str(uuid.uuid4())
+    async with connection() as conn:
+        await conn.statements["create_session"].fetch(session_id, user_id, title)
+    return session_id
+
+async def list_sessions(user_id: str, limit: int, offset: int) -> List[Dict]:
+    async with connection() as conn:
+        rows = await conn.statements["list_sessions"].fetch(user_id, limit, offset)
+    return [dict(r) for r in rows]
+
+async def get_session(session_id: str) -> Optional[Tuple[Dict, List[Dict]]]:
+    """Session with its conversations, None if it does not exist"""
+    async with connection() as conn:
+        session = await conn.statements["get_session"].fetchrow(session_id)
+        if not session:
+            return None
+        conversations = await conn.statements["session_conversations"].fetch(session_id)
+    return dict(session), [dict(c) for c in conversations]
+
+async def create_conversation(session_id: str, agent_id: int, conv_idx: int) -> str:
+    conversation_id = str(uuid.uuid4())
+    async with connection() as conn:
+        await conn.statements["create_conversation"].fetch(
+            conversation_id, session_id, agent_id, conv_idx, {"conv_idx": conv_idx}
+        )
+    return conversation_id
+
+async def list_conversations(agent_id: int, limit: int, offset: int) -> List[Dict]:
+    async with connection() as conn:
+        rows = await conn.statements["list_conversations"].fetch(agent_id, limit, offset)
+    return [dict(r) for r in rows]
+
+async def get_conversation(conversation_id: str) -> Optional[Tuple[Dict, List[Dict]]]:
+    """Conversation with all its messages, None if it does not exist"""
+    async with connection() as conn:
+        conversation = await conn.statements["get_conversation"].fetchrow(conversation_id)
+        if not conversation:
+            return None
+        messages = await conn.statements["conversation_messages"].fetch(conversation_id)
+    return dict(conversation), [dict(m) for m in messages]
+
+async def get_messages_page(conversation_id: str,
+                            after_id: Optional[str] = None,
+                            after_ts: Optional[datetime] = None,
+                            limit: int = 100,
+                            fields: Optional[List[str]] = None) -> List[Dict]:
+    """Messages strictly after a cursor, oldest first (keyset pagination).
+
+    The cursor is either a message id or a timestamp; without one the page
+    starts at the beginning of the conversation. ``fields`` is a subset of
+    MESSAGE_FIELDS, ``id`` and ``created_at`` are always returned for the
+    next cursor.
+    """
+    columns = ["id", "created_at"] + [f for f in (fields or MESSAGE_FIELDS)
+                                      if f in MESSAGE_FIELDS and f not in ("id", "created_at")]
+    # Projection varies per request, so these are not in the prepared catalog;
+    # asyncpg's per-connection statement cache keeps each shape prepared
+    select = f"SELECT {', '.join('m.' + c for c in columns)} FROM messages m WHERE m.conversation_id = $1"
+    if after_id is not None:
+        query = select + """
+            AND (m.created_at, m.id) > (
+                SELECT created_at, id FROM messages
+                WHERE id = $2 AND conversation_id = $1
             )
-        ) + 1 as queue_position
-    FROM tasks t
-    WHERE t.id = $1::uuid
+            ORDER BY m.created_at, m.id
+            LIMIT $3
+        """
+        cursor = after_id
+    else:
+        query = select + """
+            AND m.created_at > $2
+            ORDER BY m.created_at, m.id
+            LIMIT $3
+        """
+        cursor = after_ts or datetime.min.replace(tzinfo=timezone.utc)
+    async with connection() as conn:
+        with observe("messages_page"):
+            rows = await conn.fetch(query, conversation_id, cursor, limit)
+    return [dict(r) for r in rows]
+
+async def get_last_message(conversation_id: str) -> List[Dict]:
+    async with connection() as conn:
+        rows = await conn.statements["last_message"].fetch(conversation_id)
+    return [dict(r) for r in rows]
+
+async def add_message(conversation_id: str, role: str, content: str,
+                      content_type: str = "text",
+                      metadata: Optional[Dict] = None) -> Optional[str]:
+    """Append a message, returns its id or None if the conversation does not exist"""
+    async with connection() as conn:
+        return await conn.statements["insert_message"].fetchval(
+            str(uuid.uuid4()), conversation_id, role, content, content_type, metadata or {}
+        )
+
+async def add_messages(conversation_id: str, messages: List[Dict[str, Any]]) -> Optional[List[str]]:
+    """Append several messages in order with one statement.
+
+    Each message is a dict with role, content and optional content_type/metadata.
+    Returns the ids in order, or None if the conversation does not exist.
     """
-    
-    conn = await get_async_connection()
-    try:
-        result = await conn.fetchrow(query, task_id)
-        if result:
-            return dict(result)
+    message_ids = [str(uuid.uuid4()) for _ in messages]
+    async with connection() as conn:
+        rows = await conn.statements["insert_messages"].fetch(
+            conversation_id,
+            message_ids,
+            [m["role"] for m in messages],
+            [m["content"] for m in messages],
+            [m.get("content_type") or "text" for m in messages],
+            [json.dumps(m.get("metadata") or {}) for m in messages],
+        )
+    if not rows:
         return None
-    finally:
-        await release_async_connection(conn)
+    return message_ids
 
-async def update_task_status(task_id: str, status: str, 
-                           result: Optional[str] = None, 
-                           error: Optional[str] = None) -> bool:
-    """Update task status and result"""
-    conn = await get_async_connection()
-    try:
-        if status in ['processing', 'completed', 'failed']:
-            update_query = """
-            UPDATE tasks 
-            SET status = $1,
-                result = $2,
-                error = $3,
-                {time_column} = CURRENT_TIMESTAMP
-            WHERE id = $4::uuid
-            RETURNING id
-            """.format(
-                time_column='started_at' if status == 'processing' else 'completed_at'
-            )
-            
-            await conn.fetchval(update_query, status, result, error, task_id)
-            return True
-        else:
-            update_query = """
-            UPDATE tasks 
-            SET status = $1
-            WHERE id = $2::uuid
-            RETURNING id
-            """
-            await conn.fetchval(update_query, status, task_id)
-            return True
-    except Exception as e:
-        logger.error(f"Failed to update task {task_id}: {str(e)}")
-        return False
-    finally:
-        await release_async_connection(conn)
-
-async def get_next_pending_task(agent_id: int) -> Optional[Dict]:
-    """Get next pending task for an agent with row-level locking"""
-    query = """
-    WITH next_task AS (
-        SELECT id 
-        FROM tasks 
-        WHERE agent_id = $1 
-        AND status = 'pending'
-        ORDER BY priority DESC, created_at ASC
-        LIMIT 1
-        FOR UPDATE SKIP LOCKED
-    )
-    UPDATE tasks t
-    SET status = 'processing',
-        started_at = CURRENT_TIMESTAMP
-    FROM next_task nt
-    WHERE t.id = nt.id
-    RETURNING t.*
+
+# Task queue
+_UUID_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def new_task_id() -> Tuple[str, datetime]:
+    """Time-ordered (version 7) UUID of a new task and its created_at, the millisecond in the id"""
+    ms = time.time_ns() // 1_000_000
+    rand = int.from_bytes(uuid.uuid4().bytes, "big")
+    value = (ms << 80) | (0x7 << 76) | (rand & ((1 << 76) - 1))
+    value = (value & ~(0b11 << 62)) | (0b10 << 62)  # RFC 4122 variant
+    return str(uuid.UUID(int=value)), _UUID_EPOCH + timedelta(milliseconds=ms)
+
+def task_created_at(task_id: str) -> Optional[datetime]:
+    """created_at of a task from its id, the partition key of lookups by id.
+
+    None for ids of tasks created before time-ordered ids (their lookups scan
+    every partition) and for malformed ids.
     """
-    
-    conn = await get_async_connection()
     try:
-        result = await conn.fetchrow(query, agent_id)
-        if result:
-            return dict(result)
+        value = uuid.UUID(task_id)
+    except (ValueError, TypeError, AttributeError):
         return None
-    finally:
-        await release_async_connection(conn)
-
-async def update_agent_status(agent_id: int, status: str, 
-                            current_task_id: Optional[str] = None,
-                            capabilities: Optional[List[str]] = None,
-                            error: Optional[str] = None) -> bool:
-    """Update agent status"""
-    conn = await get_async_connection()
-    try:
-        query = """
-        INSERT INTO agent_status 
-        (agent_id, status, current_task_id, capabilities, last_error, last_heartbeat)
-        VALUES ($1, $2, $3::uuid, $4::jsonb, $5, CURRENT_TIMESTAMP)
-        ON CONFLICT (agent_id) 
-        DO UPDATE SET 
-            status = EXCLUDED.status,
-            current_task_id = EXCLUDED.current_task_id,
-            capabilities = EXCLUDED.capabilities,
-            last_error = EXCLUDED.last_error,
-            last_heartbeat = EXCLUDED.last_heartbeat,
-            updated_at = CURRENT_TIMESTAMP
-        """
-        
-        await conn.execute(
-            query,
-            agent_id,
-            status,
-            current_task_id,
-            json.dumps(capabilities or []),
-            error
+    if value.version != 7:
+        return None
+    return _UUID_EPOCH + timedelta(milliseconds=value.int >> 80)
+
+async def create_task(agent_id: int, conversation_id: Optional[str],
+                      params: Dict[str, Any], priority: int = 0) -> Tuple[str, int]:
+    """Enqueue a task, returns its id and the queue length after the insert"""
+    task_id, created_at = new_task_id()
+    async with connection() as conn:
+        await conn.statements["insert_task"].fetch(
+            task_id, agent_id, conversation_id, params, priority, created_at
         )
-        return True
-    except Exception as e:
-        logger.error(f"Failed to update agent status: {str(e)}")
-        return False
-    finally:
-        await release_async_connection(conn)
+        count = await conn.statements["pending_count"].fetchval(agent_id)
+    return task_id, count or 1
 
-async def get_agent_status(agent_id: int) -> Optional[Dict]:
-    """Get current agent status"""
-    query = """
-    SELECT * FROM agent_status 
-    WHERE agent_id = $1
+async def create_tasks_bulk(tasks: List[Dict[str, Any]]) -> List[Tuple[str, int]]:
+    """Enqueue many tasks with COPY in one transaction.
+
+    Returns (task_id, position_in_queue) per task, positions are derived from
+    a single read of the queue counters.
     """
-    
-    conn = await get_async_connection()
-    try:
-        result = await conn.fetchrow(query, agent_id)
-        if result:
-            return dict(result)
-        return None
-    finally:
-        await release_async_connection(conn)
-
-async def get_queue_status(agent_id: Optional[int] = None) -> Dict:
-    """Get queue status for all agents or specific agent"""
-    if agent_id:
-        query = """
-        SELECT 
-            agent_id,
-            COUNT(*) as pending_count,
-            AVG(priority) as avg_priority,
-            MIN(created_at) as oldest_task,
-            array_agg(
-                json_build_object(
-                    'id', id,
-                    'priority', priority,
-                    'created_at', created_at,
-                    'prompt_preview', LEFT(prompt, 100)
+    new_ids = [new_task_id() for _ in tasks]
+    task_ids = [task_id for task_id, _ in new_ids]
+    records = [
+        (task_id, t["agent_id"], t.get("conversation_id"), t.get("params", {}), 'pending',
+         t.get("priority", 0), created_at)
+        for (task_id, created_at), t in zip(new_ids, tasks)
+    ]
+    agent_ids = list({t["agent_id"] for t in tasks})
+
+    async with connection() as conn:
+        async with conn.transaction():
+            with observe("copy_tasks"):
+                await conn.copy_records_to_table(
+                    'tasks',
+                    records=records,
+                    columns=['id', 'agent_id', 'conversation_id', 'params', 'status', 'priority', 'created_at'],
                 )
-                ORDER BY priority DESC, created_at ASC
-            ) as pending_tasks
-        FROM tasks
-        WHERE status = 'pending'
-        AND agent_id = $1
-        GROUP BY agent_id
-        """
-        conn = await get_async_connection()
-        try:
-            result = await conn.fetchrow(query, agent_id)
-            if result:
-                return dict(result)
-            return {"agent_id": agent_id, "pending_count": 0, "pending_tasks": []}
-        finally:
-            await release_async_connection(conn)
-    else:
-        query = """
-        SELECT 
-            agent_id,
-            COUNT(*) as pending_count,
-            AVG(priority) as avg_priority,
-            MIN(created_at) as oldest_task
-        FROM tasks
-        WHERE status = 'pending'
-        GROUP BY agent_id
-        ORDER BY agent_id
-        """
-        conn = await get_async_connection()
-        try:
-            results = await conn.fetch(query)
-            return [dict(row) for row in results]
-        finally:
-            await release_async_connection(conn)
-
-async def cleanup_old_tasks(days_to_keep: int = 30):
-    """Clean up old completed tasks"""
-    query = """
-    DELETE FROM tasks 
-    WHERE status IN ('completed', 'failed', 'cancelled')
-    AND completed_at < CURRENT_TIMESTAMP - INTERVAL '%s days'
-    RETURNING COUNT(*) as deleted_count
+            counts = await conn.statements["pending_counts"].fetch(agent_ids)
+
+    # Same semantics as create_task: position = queue length right after the insert
+    inserted: Dict[int, int] = {}
+    for t in tasks:
+        inserted[t["agent_id"]] = inserted.get(t["agent_id"], 0) + 1
+    position = {row['agent_id']: row['task_count'] - inserted[row['agent_id']] for row in counts}
+
+    result = []
+    for task_id, t in zip(task_ids, tasks):
+        position[t["agent_id"]] = position.get(t["agent_id"], 0) + 1
+        result.append((task_id, position[t["agent_id"]]))
+    return result
+
+async def claim_tasks(agent_id: int, max_tasks: int = 1) -> List[Dict[str, Any]]:
+    """Lease up to max_tasks highest priority pending tasks and refresh the heartbeat"""
+    async with connection() as conn:
+        rows = await conn.statements["claim_tasks"].fetch(agent_id, max_tasks)
+    return [
+        {
+            "task_id": row['id'],
+            "conversation_id": row['conversation_id'],
+            "params": row['params']
+        }
+        for row in rows
+    ]
+
+async def submit_result(task_id: str, result: str, error: Optional[str] = None) -> bool:
+    """Store a task result and set the agent back to idle, False for unknown tasks"""
+    async with connection() as conn:
+        row = await conn.statements["complete_task"].fetchrow(
+            'failed' if error else 'completed', result, error, task_id, task_created_at(task_id)
+        )
+    return row is not None
+
+async def complete_task(task_id: str, content: str, content_type: str = "text",
+                        metadata: Optional[Dict] = None, agent_id: Optional[int] = None) -> Optional[Dict]:
+    """Append the assistant message of a task and complete it atomically.
+
+    Only a processing task (of agent_id, when given) is completed. Returns
+    ``{"message_id", "completed", "status"}``, None for unknown tasks.
+    message_id is None when the task has no (existing) conversation. A
+    repeated completion of a completed task adds nothing and returns the
+    message stored the first time, so retries are idempotent; other
+    statuses come back with completed False.
     """
-    
-    conn = await get_async_connection()
-    try:
-        result = await conn.fetchval(query, days_to_keep)
-        logger.info(f"Cleaned up {result} old tasks")
-        return result
-    except Exception as e:
-        logger.error(f"Failed to clean up old tasks: {str(e)}")
-        return 0
-    finally:
-        await release_async_connection(conn)
+    async with connection() as conn:
+        row = await conn.statements["complete_task_with_message"].fetchrow(
+            task_id, str(uuid.uuid4()), content, content_type, metadata or {}, agent_id,
+            task_created_at(task_id)
+        )
+        if row["completed"]:
+            return {"message_id": row["message_id"], "completed": True, "status": "completed"}
+        task = await conn.statements["get_task"].fetchrow(task_id, task_created_at(task_id))
+    if task is None:
+        return None
+    return {
+        "message_id": task["result_message_id"],
+        "completed": task["status"] == "completed",
+        "status": task["status"],
+    }
+
+async def append_progress(task_id: str, delta: str) -> Optional[int]:
+    """Append streamed output of a processing task, returns the new length or None"""
+    async with connection() as conn:
+        return await conn.statements["append_progress"].fetchval(task_id, delta, task_created_at(task_id))
+
+async def get_task_progress(task_id: str, offset: int = 0) -> Optional[Dict]:
+    """Status of a task and its streamed output after offset characters, None for unknown tasks"""
+    async with connection() as conn:
+        row = await conn.statements["task_progress"].fetchrow(task_id, offset, task_created_at(task_id))
+    return dict(row) if row else None
+
+async def get_session_events(session_id: str, after_xid: str, after_id: str = "") -> Tuple[List[Dict], List[Dict]]:
+    """Tasks of a session finished after the (completed_xid, id) cursor, and output of its processing tasks"""
+    async with connection() as conn:
+        finished = await conn.statements["session_finished_tasks"].fetch(
+            session_id, after_xid, after_id, SESSION_EVENTS_PAGE_SIZE
+        )
+        progress = await conn.statements["session_progress"].fetch(session_id)
+    return [dict(r) for r in finished], [dict(r) for r in progress]
+
+async def session_events_start() -> str:
+    """Starting completed_xid cursor for a fresh session events subscription"""
+    async with connection() as conn:
+        return await conn.statements["session_events_start"].fetchval()
+
+async def get_task(task_id: str) -> Optional[Dict]:
+    async with connection() as conn:
+        row = await conn.statements["get_task"].fetchrow(task_id, task_created_at(task_id))
+    return dict(row) if row else None
+
+async def get_agent_status(agent_id: int) -> Optional[Dict]:
+    async with connection() as conn:
+        row = await conn.statements["get_agent_status"].fetchrow(agent_id)
+    return dict(row) if row else None
+
+async def get_queue_status(agent_id: int) -> Dict:
+    async with connection() as conn:
+        pending_count = await conn.statements["pending_count"].fetchval(agent_id)
+        active_task = await conn.statements["active_task"].fetchrow(agent_id)
+    return {
+        "agent_id": agent_id,
+        "pending_count": pending_count or 0,
+        "active_task": dict(active_task) if active_task else None
+    }
 
-# Performance monitoring
 async def get_system_metrics() -> Dict:
     """Get system-wide metrics"""
-    query = """
-    SELECT 
-        (SELECT COUNT(*) FROM tasks) as total_tasks,
-        (SELECT COUNT(*) FROM tasks WHERE status = 'pending') as pending_tasks,
-        (SELECT COUNT(*) FROM tasks WHERE status = 'processing') as processing_tasks,
-        (SELECT COUNT(*) FROM tasks WHERE status = 'completed') as completed_tasks,
-        (SELECT COUNT(*) FROM agent_status WHERE status = 'idle') as idle_agents,
-        (SELECT COUNT(*) FROM agent_status WHERE status = 'busy') as busy_agents,
-        (SELECT AVG(EXTRACT(EPOCH FROM (completed_at - started_at))) 
-         FROM tasks WHERE status = 'completed') as avg_processing_time
+    async with connection() as conn:
+        row = await conn.statements["system_metrics"].fetchrow()
+    return dict(row) if row else {}
+
+async def ping() -> bool:
+    async with connection() as conn:
+        with observe("ping"):
+            return bool(await conn.fetchval("SELECT 1"))
+
+
+# Maintenance
+async def reconcile_queue_stats():
+    """Rebuild task_queue_stats from the tasks table (e.g. after manual edits)"""
+    async with connection() as conn:
+        async with conn.transaction():
+            await conn.execute(RECONCILE_QUEUE_STATS_SQL)
+    logger.info("Task queue stats reconciled")
+
+async def ensure_partitions(days_ahead: int = DB_PARTITION_DAYS_AHEAD):
+    """Create daily partitions of tasks and messages for today and the next days"""
+    async with connection() as conn:
+        await _ensure_partitions(conn, days_ahead)
+
+async def drop_old_partitions(table: str, days_to_keep: int) -> List[str]:
+    """Drop daily partitions of a table that lie entirely before the retention window.
+
+    Dropping a partition is a metadata operation, unlike DELETE it leaves no
+    dead tuples behind. Task partitions that still hold pending/processing
+    tasks are kept, and their rows are subtracted from task_queue_stats.
     """
-    
-    conn = await get_async_connection()
+    if table not in PARTITIONED_TABLES:
+        raise DatabaseError(f"Table {table} is not partitioned")
+    cutoff = datetime.now(timezone.utc).date() - timedelta(days=days_to_keep)
+
+    dropped = []
     try:
-        result = await conn.fetchrow(query)
-        return dict(result) if result else {}
-    finally:
-        await release_async_connection(conn)
+        async with connection() as conn:
+            partitions = await conn.fetch("""
+                SELECT c.relname
+                FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = $1::regclass
+                ORDER BY c.relname
+            """, table)
+            for row in partitions:
+                partition = row["relname"]
+                day = _partition_day(table, partition)
+                # A partition covers [day, day + 1)
+                if day is None or day + timedelta(days=1) > cutoff:
+                    continue
+                async with conn.transaction():
+                    # No update may change the counts between reading and dropping them.
+                    # Parent before partition, the order of every query routed through
+                    # the parent; DROP needs the parent exclusively anyway, taking it
+                    # later would be a lock upgrade that can deadlock with readers
+                    await conn.execute(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE")
+                    await conn.execute(f"LOCK TABLE {partition} IN ACCESS EXCLUSIVE MODE")
+                    if table == "tasks":
+                        counts = await conn.fetch(f"""
+                            SELECT agent_id, status, COUNT(*) AS task_count,
+                                   COALESCE(SUM(EXTRACT(EPOCH FROM (completed_at - started_at))), 0) AS seconds
+                            FROM {partition}
+                            GROUP BY agent_id, status
+                        """)
+                        if any(c["status"] in ("pending", "processing") for c in counts):
+                            logger.warning(f"Keeping partition {partition}: it still has active tasks")
+                            continue
+                        await conn.executemany("""
+                            UPDATE task_queue_stats
+                            SET task_count = task_count - $3,
+                                total_processing_seconds = total_processing_seconds - $4
+                            WHERE agent_id = $1 AND status = $2
+                        """, [(c["agent_id"], c["status"], c["task_count"], c["seconds"]) for c in counts])
+                    await conn.execute(f"DROP TABLE {partition}")
+                dropped.append(partition)
+        if dropped:
+            logger.info(f"Dropped {len(dropped)} old partitions of {table}")
+        return dropped
+    except Exception as e:
+        logger.error(f"Failed to drop old partitions of {table}: {str(e)}")
+        return dropped
+
+async def cleanup_old_tasks(days_to_keep: int = DB_TASKS_RETENTION_DAYS):
+    """Clean up old tasks by dropping expired partitions, returns their number"""
+    return len(await drop_old_partitions("tasks", days_to_keep))
+
+async def cleanup_old_messages(days_to_keep: int = DB_MESSAGES_RETENTION_DAYS):
+    """Clean up old messages by dropping expired partitions, returns their number"""
+    return len(await drop_old_partitions("messages", days_to_keep))
+
+async def cleanup_stale_progress(hours_to_keep: int = 24):
+    """Drop streamed output left behind by agents that died mid-task"""
+    async with connection() as conn:
+        with observe("cleanup_stale_progress"):
+            await conn.execute(
+                "DELETE FROM task_progress WHERE updated_at < NOW() - make_interval(hours => $1)",
+                hours_to_keep
+            )
+
+async def maintain_partitions():
+    """Periodic maintenance: pre-create upcoming partitions and apply retention"""
+    await ensure_partitions()
+    await cleanup_old_tasks()
+    await cleanup_old_messages()
+    await cleanup_stale_progress()
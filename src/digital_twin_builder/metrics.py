@@ -0,0 +1,70 @@
+"""
+Minimal in-process metrics rendered in the Prometheus text exposition format.
+
+Used by the API server to expose database statement latencies and pool wait
+time on ``GET /metrics``. Updated from the asyncio event loop only, so no locking.
+"""
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Seconds; tuned for database round trips (sub-millisecond to a few seconds)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _format_labels(labels: Sequence[Tuple[str, str]]) -> str:
+    # Label values are statement names and bucket bounds, nothing to escape
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Histogram:
+    """Cumulative histogram, optionally split by a single label"""
+
+    def __init__(self, name: str, help_text: str, label: Optional[str] = None,
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = tuple(sorted(buckets))
+        # label value -> (per-bucket counts, sum, count)
+        self._series: Dict[Optional[str], List] = {}
+
+    def observe(self, value: float, label_value: Optional[str] = None):
+        series = self._series.get(label_value)
+        if series is None:
+            series = self._series[label_value] = [[0] * len(self.buckets), 0.0, 0]
+        counts = series[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_value, (counts, total, count) in sorted(self._series.items(), key=lambda kv: str(kv[0])):
+            base = [(self.label, label_value)] if self.label else []
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(base + [('le', repr(bound))])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(base + [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(base)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(base)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def render_gauge(name: str, help_text: str, value: float) -> str:
+    return f"# HELP {name} {help_text}\n# TYPE {name} gauge\n{name} {value}\n"
+
+
+STATEMENT_DURATION = Histogram(
+    "db_statement_duration_seconds",
+    "Execution time of database statements, by statement name.",
+    label="statement",
+)
+POOL_ACQUIRE_DURATION = Histogram(
+    "db_pool_acquire_seconds",
+    "Time spent waiting for a connection from the pool.",
+)
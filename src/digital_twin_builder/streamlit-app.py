@@ -18,6 +18,7 @@ from api_utils import (
     submit_task as api_submit_task,
     add_message_to_conversation as api_add_message_to_conversation,
     get_task_status as api_get_task_status,
+    follow_session_events as api_follow_session_events,
     get_agent_status as api_get_agent_status,
     create_new_session as api_create_new_session,
     create_new_conversation as api_create_new_conversation
@@ -80,22 +81,40 @@ def get_agent_status(agent_id):
     return {"status": "offline"}
 
 
-def background_poll_task_result(response_queue, task_id):
-    poll = 0
-    max_poll = 1200
-    while poll < max_poll:
-        task = get_task_status(task_id)
-        if task and task["status"] == "completed":
-            response_queue.put(task)
-            break
-        else:
-            time.sleep(1)
-        poll += 1
+def background_follow_session(response_queue, partial_responses, session_id, stop_event):
+    """Follow the session's events: finished tasks go to response_queue, the text
+    generated so far to partial_responses[(agent_id, conv_idx)]"""
+    def on_event(event, payload):
+        if event == "token":
+            key = (payload["agent_id"], payload["conv_idx"])
+            # offset is where delta starts, so a reconnect overwrites instead of repeating
+            partial_responses[key] = partial_responses.get(key, "")[:payload["offset"]] + payload["delta"]
+        elif event == "task":
+            response_queue.put(payload)
+
+    api_follow_session_events(session_id, on_event, stop_event)
 
 
-def create_new_conversation(session_id, agent_id, system_prompt, conv_idx=0):
-    """Create a new conversation"""
-    conversation_id = api_create_new_conversation(session_id, agent_id, system_prompt, conv_idx)
+def start_session_reader(session_id):
+    """Run one background reader for the current session, replacing the previous one"""
+    reader = st.session_state.get("session_reader")
+    if reader is not None:
+        if reader["session_id"] == session_id:
+            return
+        reader["stop"].set()
+    stop_event = threading.Event()
+    thread = threading.Thread(
+        target=background_follow_session,
+        args=(st.session_state.response_queue, st.session_state.partial_responses, session_id, stop_event),
+        daemon=True,
+    )
+    thread.start()
+    st.session_state.session_reader = {"session_id": session_id, "stop": stop_event}
+
+
+def create_new_conversation(session_id, agent_id, system_prompt, conv_idx=0, messages=None):
+    """Create a new conversation, optionally with its first messages"""
+    conversation_id = api_create_new_conversation(session_id, agent_id, system_prompt, conv_idx, messages)
     if conversation_id:
         st.session_state.conversations[agent_id][conv_idx] = conversation_id
     else:
@@ -127,6 +146,7 @@ def load_session(session_id):
     data = response.json()
     reset_session_state()
     st.session_state.session_id = session_id
+    start_session_reader(session_id)
     for conv in data["conversations"]:
         agent_id = conv["agent_id"]
         conv_idx = conv.get("conv_idx", 0)
@@ -178,16 +198,10 @@ def submit_chat_to_agent(agent_id, conv_idx, conversation_id, params):
         st.success(f"Task submitted! ID: {task_id[:8]}...")
         st.session_state.waiting_for_agent[agent_id][conv_idx] = True
         st.session_state.tasks.append(task_id)
-
-        thread = threading.Thread(
-            target=background_poll_task_result,
-            args=(st.session_state.response_queue, task_id),
-            daemon=True,
-        )
-        thread.start()
+        # The session reader (see start_session_reader) streams the response
 
         # Show immediate feedback
-        st.toast("Task submitted! Polling for response...")
+        st.toast("Task submitted! Streaming the response...")
 
 def contains_json(message: str):
     try:
@@ -216,6 +230,10 @@ def setup_interview_tab():
             continue
         with st.chat_message(message["role"]):
             st.markdown(message["content"])
+    partial = st.session_state.partial_responses.get((UI_AGENT_INDEX, conv_idx))
+    if st.session_state.waiting_for_agent[UI_AGENT_INDEX][conv_idx] and partial:
+        with st.chat_message("assistant"):
+            st.markdown(partial + "▌")
 
     with st.expander("Parameters"):
         temperature = st.slider("Temperature", 0.0, 2.0, 0.7, 0.1)
@@ -258,12 +276,11 @@ def setup_database_tab():
     if db_conversation is None:
         try:
             db_conversation = st.session_state.conversations[DB_AGENT_INDEX][conv_idx] = create_new_conversation(
-                st.session_state.session_id, DB_AGENT_INDEX, system_prompts.DB, conv_idx
-            )
-            add_message_to_conversation(
-                db_conversation,
-                "user",
-                user_prompts.make_db_prompt(st.session_state.interview_result),
+                st.session_state.session_id, DB_AGENT_INDEX, system_prompts.DB, conv_idx,
+                messages=[{
+                    "role": "user",
+                    "content": user_prompts.make_db_prompt(st.session_state.interview_result),
+                }],
             )
             submit_chat_to_agent(
                 DB_AGENT_INDEX, conv_idx, db_conversation, {"max_tokens": 3000}
@@ -292,15 +309,14 @@ def dt_generate_config():
     dt_conversation = st.session_state.conversations[DT_AGENT_INDEX][conv_idx]
     if dt_conversation is None:
         try:
-            dt_conversation = st.session_state.conversations[DT_AGENT_INDEX][conv_idx] = create_new_conversation(
-                st.session_state.session_id, DT_AGENT_INDEX, system_prompts.GenConf, conv_idx
-            )
             prompt = user_prompts.make_gen_conf(
                 st.session_state.interview_result,
                 st.session_state.db_schema
             )
-            add_message_to_conversation(
-                dt_conversation, role="user", content=prompt)
+            dt_conversation = st.session_state.conversations[DT_AGENT_INDEX][conv_idx] = create_new_conversation(
+                st.session_state.session_id, DT_AGENT_INDEX, system_prompts.GenConf, conv_idx,
+                messages=[{"role": "user", "content": prompt}],
+            )
             submit_chat_to_agent(
                 DT_AGENT_INDEX, conv_idx, dt_conversation, {"max_tokens": 3000})
         except Exception:
@@ -324,15 +340,14 @@ def dt_generate_simulation():
     dt_conversation = st.session_state.conversations[DT_AGENT_INDEX][conv_idx]
     if dt_conversation is None:
         try:
-            dt_conversation = st.session_state.conversations[DT_AGENT_INDEX][conv_idx] = create_new_conversation(
-                st.session_state.session_id, DT_AGENT_INDEX, system_prompts.GenSim, conv_idx
-            )
             prompt = user_prompts.make_gen_sim(
                 st.session_state.interview_result,
                 st.session_state.db_schema
             )
-            add_message_to_conversation(
-                dt_conversation, role="user", content=prompt)
+            dt_conversation = st.session_state.conversations[DT_AGENT_INDEX][conv_idx] = create_new_conversation(
+                st.session_state.session_id, DT_AGENT_INDEX, system_prompts.GenSim, conv_idx,
+                messages=[{"role": "user", "content": prompt}],
+            )
             submit_chat_to_agent(
                 DT_AGENT_INDEX, conv_idx, dt_conversation, {})
         except Exception:
@@ -469,6 +484,7 @@ def reset_session_state():
     st.session_state.interview_result = None
     st.session_state.tasks = []
     st.session_state.temperature_history = []
+    st.session_state.partial_responses.clear()
 
 def init_session_state():
     """Initialize session state for chat"""
@@ -492,6 +508,8 @@ def init_session_state():
         st.session_state.temperature_history = []
     if 'response_queue' not in st.session_state:
         st.session_state.response_queue = queue.Queue()
+    if "partial_responses" not in st.session_state:
+        st.session_state.partial_responses = {}
 
 
 def process_interview_task(result):
@@ -530,10 +548,18 @@ def process_dt_sim_task(result):
     st.session_state.simulation_code = result[start + 8:]
 
 def process_incoming_task(task):
-    result = task.get("result", "")
+    result = task.get("result") or ""
     agent_id = task["agent_id"]
     conv_idx = task["conv_idx"]
     st.session_state.waiting_for_agent[agent_id][conv_idx] = False
+    st.session_state.partial_responses.pop((agent_id, conv_idx), None)
+    if task.get("status", "completed") != "completed":
+        # Failed and cancelled tasks leave the stored results as they are;
+        # a toast, unlike st.error, survives the rerun that follows
+        error = task.get("error") or "no error message"
+        print(f"Task {task.get('id')} of agent {agent_id} {task['status']}: {error}")
+        st.toast(f"Agent {agent_id} task {task['status']}: {error}", icon="❌")
+        return
     if agent_id == 0:
         process_interview_task(result)
     elif agent_id == 1:
@@ -573,11 +599,11 @@ def initialize_ui():
             load_session(session_id)
             UI_AGENT_INDEX = 0
             conv_idx = 0
+            # System prompt and init message
             st.session_state.conversations[UI_AGENT_INDEX][conv_idx] = create_new_conversation(
-                st.session_state.session_id, UI_AGENT_INDEX, system_prompts.UI, conv_idx=0
+                st.session_state.session_id, UI_AGENT_INDEX, system_prompts.UI, conv_idx=0,
+                messages=[{"role": "assistant", "content": user_prompts.init_ui_assistant_answer()}],
             )
-            # init message
-            add_message_to_conversation(st.session_state.conversations[UI_AGENT_INDEX][conv_idx], "assistant", user_prompts.init_ui_assistant_answer())
             load_conversation(st.session_state.conversations[UI_AGENT_INDEX][conv_idx], UI_AGENT_INDEX, conv_idx)
             st.rerun()
             # submit_chat_to_agent(UI_AGENT_INDEX, conv_idx, st.session_state.conversations[UI_AGENT_INDEX][conv_idx], {})
@@ -635,8 +661,9 @@ def initialize_ui():
         process_incoming_task(task)
         st.rerun()
 
-    # rerun every 10 seconds
-    time.sleep(10)
+    # rerun every 10 seconds, every second while a response is streaming
+    waiting = any(any(row) for row in st.session_state.waiting_for_agent)
+    time.sleep(1 if waiting else 10)
     st.rerun()
 
 def main():